@@ -468,7 +468,8 @@ class DatasetResource(DojoResource):
             dsargs['path'] = kwargs.get('parent').vol_name
         else:
             dsargs['include_root'] = True
-        zfslist = zfs.list_datasets(**dsargs)
+        # inherit_props needs the source of every property
+        zfslist = zfs.list_datasets(properties=None, **dsargs)
         return zfslist
 
     def obj_get(self, bundle, **kwargs):
@@ -478,7 +479,7 @@ class DatasetResource(DojoResource):
         else:
             dsargs['path'] = kwargs['pk']
             dsargs['include_root'] = True
-        zfslist = zfs.list_datasets(**dsargs)
+        zfslist = zfs.list_datasets(properties=None, **dsargs)
         try:
             return zfslist[dsargs['path']]
         except KeyError:
@@ -555,7 +556,7 @@ class ZVolResource(DojoResource):
         self.is_authenticated(request)
         name = "{}/{}".format(kwargs.get('parent').vol_name, kwargs.get('pk'))
 
-        if not zfs.zfs_list(path=name):
+        if not zfs.zfs_list(path=name, cache=False):
             return HttpNotFound()
 
         deserialized = self._meta.serializer.deserialize(
@@ -597,7 +598,7 @@ class ZVolResource(DojoResource):
         zfslist = zfs.zfs_list(path="%s/%s" % (
             kwargs.get('parent').vol_name,
             kwargs.get('pk'),
-        ), types=["volume"])
+        ), types=["volume"], cache=False)
         try:
             return zfslist['%s/%s' % (
                 kwargs.get('parent').vol_name,
@@ -246,7 +246,18 @@ class DatabaseWrapper(sqlite3base.DatabaseWrapper):
 
 class HASQLiteCursorWrapper(Database.Cursor):
 
-    def execute_passive(self, query, params=None):
+    def is_master(self):
+        try:
+            # FIXME: This is extremely time-consuming (failover.status)
+            from freenasUI.middleware.notifier import notifier
+            return (
+                hasattr(notifier, 'failover_status') and
+                notifier().failover_status() == 'MASTER'
+            )
+        except:
+            return False
+
+    def execute_passive(self, query, params=None, check_master=True):
         """
         Process the query, modify it if necessary based on NO_SYNC_MAP rules
         and execute it on the remote side.
@@ -257,15 +268,7 @@ class HASQLiteCursorWrapper(Database.Cursor):
         if query.lower().startswith('select'):
             return
 
-        try:
-            # FIXME: This is extremely time-consuming (failover.status)
-            from freenasUI.middleware.notifier import notifier
-            if not (
-                hasattr(notifier, 'failover_status') and
-                notifier().failover_status() == 'MASTER'
-            ):
-                return
-        except:
+        if check_master and not self.is_master():
             return
 
         parse = sqlparse.parse(query)
@@ -411,21 +414,23 @@ class HASQLiteCursorWrapper(Database.Cursor):
         query = self.convert_query(query)
         execute = self.locked_retry(Database.Cursor.execute, query, params)
 
+        if not self.skip_passive():
+            self.execute_passive(query, params=params)
+
+        return execute
+
+    def skip_passive(self):
         # Allow sync to be bypassed just to be extra safe on things like
         # database migration.
         # Alternatively a south driver could be written bu the effort would be
         # quite significant.
         skip_passive_sentinel = '/tmp/.sqlite3_ha_skip'
-        skip = False
         if os.path.exists(skip_passive_sentinel):
             try:
-                skip = os.stat(skip_passive_sentinel).st_uid == 0
+                return os.stat(skip_passive_sentinel).st_uid == 0
             except OSError:
                 pass
-        if not skip:
-            self.execute_passive(query, params=params)
-
-        return execute
+        return False
 
     def executelocal(self, query, params=None):
         if params is None:
@@ -435,7 +440,14 @@ class HASQLiteCursorWrapper(Database.Cursor):
 
     def executemany(self, query, param_list):
         query = self.convert_query(query)
-        return self.locked_retry(Database.Cursor.executemany, query, param_list)
+        param_list = list(param_list)
+        executemany = self.locked_retry(Database.Cursor.executemany, query, param_list)
+
+        if param_list and not self.skip_passive() and self.is_master():
+            for params in param_list:
+                self.execute_passive(query, params=params, check_master=False)
+
+        return executemany
 
     def convert_query(self, query):
         return sqlite3base.FORMAT_QMARK_REGEX.sub('?', query).replace(
@@ -787,6 +787,7 @@ def jail_auto_configure():
         datasets = list_datasets(
             path="/mnt/%s" % name,
             recursive=False,
+            cache=False,
         )
         if not datasets:
             break
@@ -121,6 +121,7 @@ from freenasUI.middleware.client import client, ClientException
 from freenasUI.middleware.encryption import random_wipe
 from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.middleware.multipath import Multipath
+from middlewared.geom_index import get_geom_index, invalidate_geom_index
 import sysctl
 
 RE_DSKNAME = re.compile(r'^([a-z]+)([0-9]+)$')
@@ -686,6 +687,7 @@ class notifier(metaclass=HookMetaclass):
                                  swapsize=swapsize)
 
         self.__confxml = None  # Make sure to invalidate cache
+        invalidate_geom_index()
         doc = self._geom_confxml()
         for disk in disks:
             devname = self.part_type_from_device('zfs', disk)
@@ -837,6 +839,7 @@ class notifier(metaclass=HookMetaclass):
         zfsproc = self._pipeopen("/sbin/zfs create %s -V '%s' '%s'" % (options, size, name))
         zfs_err = zfsproc.communicate()[1]
         zfs_error = zfsproc.wait()
+        zfs.zfs_list_cache_clear()
         return zfs_error, zfs_err
 
     def create_zfs_dataset(self, path, props=None):
@@ -850,6 +853,7 @@ class notifier(metaclass=HookMetaclass):
         zfsproc = self._pipeopen("/sbin/zfs create %s '%s'" % (options, path))
         zfs_output, zfs_err = zfsproc.communicate()
         zfs_error = zfsproc.wait()
+        zfs.zfs_list_cache_clear()
         return zfs_error, zfs_err
 
     def list_zfs_vols(self, volname, sort=None):
@@ -928,6 +932,7 @@ class notifier(metaclass=HookMetaclass):
             else:
                 zfsproc = self._pipeopen("zfs destroy '%s'" % (path))
             retval = zfsproc.communicate()[1]
+            zfs.zfs_list_cache_clear()
             if zfsproc.returncode == 0:
                 from freenasUI.storage.models import Task, Replication
                 Task.objects.filter(task_filesystem=path).delete()
@@ -949,6 +954,7 @@ class notifier(metaclass=HookMetaclass):
             str(name),
         ))
         retval = zfsproc.communicate()[1]
+        zfs.zfs_list_cache_clear()
         return retval
 
     def __destroy_zfs_volume(self, volume):
@@ -991,6 +997,7 @@ class notifier(metaclass=HookMetaclass):
             raise MiddlewareError('freebsd-zfs partition could not be found')
 
         self.__confxml = None  # Clear cache
+        invalidate_geom_index()
         doc = self._geom_confxml()
         uuid = doc.xpath(
             "//class[name = 'PART']"
@@ -2979,6 +2986,7 @@ class notifier(metaclass=HookMetaclass):
         else:
             zfsproc = self._pipeopen("/sbin/zfs set '%s'='%s' '%s'" % (item, value, name))
         err = zfsproc.communicate()[1]
+        zfs.zfs_list_cache_clear()
         if zfsproc.returncode == 0:
             return True, None
         return False, err
@@ -3000,6 +3008,7 @@ class notifier(metaclass=HookMetaclass):
             zfscmd = "zfs inherit %s '%s'" % (item, name)
         zfsproc = self._pipeopen(zfscmd)
         err = zfsproc.communicate()[1]
+        zfs.zfs_list_cache_clear()
         if zfsproc.returncode == 0:
             return True, None
         return False, err
@@ -3292,86 +3301,40 @@ class notifier(metaclass=HookMetaclass):
             self.__confxml = etree.fromstring(self.sysctl('kern.geom.confxml'))
         return self.__confxml
 
+    def _geom_index(self):
+        # Shared with middlewared plugins, revalidated against the current
+        # XML as the GUI process does not receive devfs events
+        return get_geom_index(revalidate=True)
+
     def label_to_disk(self, name):
         """
         Given a label go through the geom tree to find out the disk name
         label = a geom label or a disk partition
         """
-        doc = self._geom_confxml()
-
-        # try to find the provider from GEOM_LABEL
-        search = doc.xpath("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % name)
-        if len(search) > 0:
-            provider = search[0]
-        else:
-            # the label does not exist, try to find it in GEOM DEV
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']//provider/@ref" % name)
-            if len(search) > 0:
-                provider = search[0]
-            else:
-                return None
-        search = doc.xpath("//provider[@id = '%s']/../name" % provider)
-        disk = search[0].text
-        if search[0].getparent().getparent().xpath("./name")[0].text in ('ELI', ):
-            return self.label_to_disk(disk.replace(".eli", ""))
-        return disk
+        return self._geom_index().label_to_disk(name)
 
     def identifier_to_device(self, ident):
 
         if not ident:
             return None
 
-        doc = self._geom_confxml()
-
-        search = re.search(r'\{(?P<type>.+?)\}(?P<value>.+)', ident)
-        if not search:
-            return None
-
-        tp = search.group("type")
-        # We need to escape single quotes to html entity
-        value = search.group("value").replace("'", "%27")
-
-        if tp == 'uuid':
-            search = doc.xpath("//class[name = 'PART']/geom//config[rawuuid = '%s']/../../name" % value)
-            if len(search) > 0:
-                for entry in search:
-                    if not entry.text.startswith('label'):
-                        return entry.text
-            return None
+        index = self._geom_index()
+        devname = index.identifier_to_device(ident)
+        if devname is not None or not ident.startswith('{serial}'):
+            return devname
 
-        elif tp == 'label':
-            search = doc.xpath("//class[name = 'LABEL']/geom//provider[name = '%s']/../name" % value)
-            if len(search) > 0:
-                return search[0].text
-            return None
-
-        elif tp == 'serial':
-            search = doc.xpath("//class[name = 'DISK']/geom/provider/config[ident = '%s']/../../name" % value)
-            if len(search) > 0:
-                return search[0].text
-            search = doc.xpath("//class[name = 'DISK']/geom/provider/config[normalize-space(ident) = normalize-space('%s')]/../../name" % value)
-            if len(search) > 0:
-                return search[0].text
-            with client as c:
-                for devname in self.__get_disks():
-                    serial = c.call('disk.serial_from_device', devname)
-                    if serial == value:
-                        return devname
-            return None
-
-        elif tp == 'serial_lunid':
-            search = doc.xpath("//class[name = 'DISK']/geom/provider/config[concat(ident,'_',lunid) = '%s']/../../name" % value)
-            if len(search) > 0:
-                return search[0].text
-            return None
-
-        elif tp == 'devicename':
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']" % value)
-            if len(search) > 0:
-                return value
-            return None
-        else:
-            raise NotImplementedError
+        # Serial not known to GEOM, ask smartctl once for every disk
+        # missing from the index and remember it until it is invalidated
+        value = ident[len('{serial}'):]
+        with client as c:
+            for devname in self.__get_disks():
+                if devname in index.smart_serials:
+                    continue
+                serial = c.call('disk.serial_from_device', devname)
+                index.smart_serials[devname] = serial
+                if serial == value:
+                    return devname
+        return None
 
     def part_type_from_device(self, name, device):
         """
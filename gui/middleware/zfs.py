@@ -28,14 +28,33 @@ import libzfs
 import logging
 import re
 import subprocess
+import threading
+import time
 
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 from django.utils.translation import ugettext_lazy as _
 
 log = logging.getLogger('middleware.zfs')
 
 ZPOOL_NAME_RE = r'[a-z][a-z0-9_\-\.]*'
 
+# Properties zfs_list fetches by default, the ones ZFSDataset and ZFSVol
+# attributes are built from
+ZFS_LIST_PROPERTIES = (
+    'type', 'available', 'used', 'usedbysnapshots', 'usedbydataset',
+    'usedbyrefreservation', 'usedbychildren', 'referenced', 'compression',
+    'dedup', 'readonly', 'org.freenas:description', 'atime', 'mountpoint',
+    'quota', 'refquota', 'reservation', 'refreservation', 'recordsize',
+    'volsize',
+)
+# Seconds zfs_list results are cached for, changes made through the
+# notifier invalidate it right away. Others (middlewared, CLI) are not
+# seen until it expires, so existence checks must not use the cache.
+ZFS_LIST_CACHE_TTL = 5
+
+_zfs_list_cache = {}
+_zfs_list_cache_lock = threading.Lock()
+
 
 def _is_vdev(name):
     """
@@ -867,43 +886,96 @@ def parse_status(name, doc, data):
     return pool
 
 
+def zfs_list_cache_clear():
+    """
+    Invalidate cached zfs_list results, to be called after datasets are
+    created, destroyed, renamed or their properties set.
+    """
+    with _zfs_list_cache_lock:
+        _zfs_list_cache.clear()
+
+
+def _zfs_property(prop):
+    # Same value and source `zfs get -p` would output
+    value = getattr(prop, 'rawvalue', prop.value)
+    source = getattr(prop, 'source', None)
+    if source is None or source.name == 'NONE':
+        source = '-'
+    else:
+        source = source.name.lower()
+    return value, source
+
+
+def _zfs_get(path, recursive, types, properties):
+    """
+    Get `properties` (all if None) of datasets of `types` using libzfs.
+
+    Returns an OrderedDict of dataset name -> {property: (value, source)},
+    parents always come before their children.
+    """
+    zfs = libzfs.ZFS()
+    if path:
+        try:
+            root = zfs.get_dataset(path)
+        except libzfs.ZFSException:
+            return OrderedDict()
+        roots = [root]
+    else:
+        # `zfs get` lists every dataset when given no path
+        roots = [pool.root_dataset for pool in zfs.pools]
+        recursive = True
+
+    types = {libzfs.DatasetType[t.upper()] for t in types}
+    rv = OrderedDict()
+    for root in roots:
+        datasets = [root]
+        if recursive:
+            datasets += list(root.children_recursive)
+        for dataset in datasets:
+            if dataset.type not in types:
+                continue
+            # Property values are only read from libzfs when accessed
+            props = dataset.properties
+            names = props.keys() if properties is None else properties
+            rv[dataset.name] = {
+                name: _zfs_property(props[name])
+                for name in names if name in props
+            }
+            rv[dataset.name]['type'] = (dataset.type.name.lower(), '-')
+    return rv
+
+
 def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
-             types=None):
+             types=None, properties=ZFS_LIST_PROPERTIES, cache=True):
     """
     Return a dictionary that contains all ZFS dataset list and their
     mountpoints
+
+    Only `properties` are read from libzfs, None reads them all (e.g. to
+    know the source of every property in `local`, `default` and `inherit`).
+    Results are cached for ZFS_LIST_CACHE_TTL seconds, pass `cache=False`
+    to always read the current state (e.g. for validation).
     """
-    args = [
-        "/sbin/zfs",
-        "get",
-        "-p",
-        "-H",
-        "-t", ",".join(types or ['filesystem', 'volume']),
-        "-o", "name,property,value,source",
-        "all",
-    ]
-    if recursive:
-        args.insert(3, "-r")
+    types = tuple(types or ['filesystem', 'volume'])
+    if properties is not None:
+        properties = tuple(properties)
+    key = (path, recursive, types, properties)
+    with _zfs_list_cache_lock:
+        cached = _zfs_list_cache.get(key)
+    if cache and cached and cached[0] > time.monotonic():
+        zfsget = cached[1]
+    else:
+        zfsget = _zfs_get(path, recursive, types, properties)
+        with _zfs_list_cache_lock:
+            _zfs_list_cache[key] = (time.monotonic() + ZFS_LIST_CACHE_TTL, zfsget)
 
-    if path:
-        args.append(path)
-
-    zfsproc = subprocess.Popen(
-        args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        encoding='utf8')
-
-    zfs_output, zfs_err = zfsproc.communicate()
-    zfs_output = zfs_output.split('\n')
-    zfsget = defaultdict(OrderedDict)
-    for line in zfs_output:
-        if not line:
-            continue
-        data = line.split('\t')
-        zfsget[data[0]][data[1]] = (data[2], data[3])
+    def intprop(props, name):
+        if name in props and props[name][0].isdigit():
+            return int(props[name][0])
+        return None
 
     zfslist = ZFSList()
+    items = {}
     for path, props in zfsget.items():
         names = path.split('/')
         depth = len(names)
@@ -929,10 +1001,7 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
                 zprops[dname] = None
                 continue
             if ptype is int:
-                if props[pname][0].isdigit():
-                    zprops[dname] = int(props[pname][0])
-                else:
-                    zprops[dname] = None
+                zprops[dname] = intprop(props, pname)
             else:
                 zprops[dname] = props[pname][0]
 
@@ -949,13 +1018,13 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
 
         _type = props['type'][0]
         if _type == 'filesystem':
-            zprops['atime'] = props['atime'][0]
-            zprops['mountpoint'] = props['mountpoint'][0]
-            zprops['quota'] = int(props['quota'][0]) if props['quota'][0].isdigit() else None
-            zprops['refquota'] = int(props['refquota'][0]) if props['refquota'][0].isdigit() else None
-            zprops['reservation'] = int(props['reservation'][0]) if props['reservation'][0].isdigit() else None
-            zprops['refreservation'] = int(props['refreservation'][0]) if props['refreservation'][0].isdigit() else None
-            zprops['recordsize'] = int(props['recordsize'][0]) if props['recordsize'][0].isdigit() else None
+            zprops['atime'] = props['atime'][0] if 'atime' in props else None
+            zprops['mountpoint'] = props['mountpoint'][0] if 'mountpoint' in props else None
+            zprops['quota'] = intprop(props, 'quota')
+            zprops['refquota'] = intprop(props, 'refquota')
+            zprops['reservation'] = intprop(props, 'reservation')
+            zprops['refreservation'] = intprop(props, 'refreservation')
+            zprops['recordsize'] = intprop(props, 'recordsize')
             item = ZFSDataset(
                 path=path,
                 include_root=include_root,
@@ -965,7 +1034,7 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
                 inherit=inherit_props,
             )
         elif _type == 'volume':
-            zprops['volsize'] = int(props['volsize'][0]) if props['volsize'][0].isdigit() else None
+            zprops['volsize'] = intprop(props, 'volsize')
             item = ZFSVol(
                 path=path,
                 props=zprops,
@@ -973,11 +1042,17 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
         else:
             raise NotImplementedError
 
+        items[path] = item
         if not hierarchical:
             zfslist.append(item)
             continue
 
-        parentds = zfslist.find(names, root=include_root)
+        # Attach to the closest listed ancestor
+        parentds = None
+        parent = path
+        while parentds is None and '/' in parent:
+            parent = parent.rsplit('/', 1)[0]
+            parentds = items.get(parent)
         if parentds:
             parentds.append(item)
         else:
@@ -987,13 +1062,15 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
 
 
 def list_datasets(path="", recursive=False, hierarchical=False,
-                  include_root=False):
+                  include_root=False, properties=ZFS_LIST_PROPERTIES, cache=True):
     return zfs_list(
         path=path,
         recursive=recursive,
         hierarchical=hierarchical,
         include_root=include_root,
         types=["filesystem"],
+        properties=properties,
+        cache=cache,
     )
 
 
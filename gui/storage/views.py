@@ -514,7 +514,7 @@ def mp_permission(request, path):
 
 def dataset_delete(request, name):
 
-    datasets = zfs.list_datasets(path=name, recursive=True)
+    datasets = zfs.list_datasets(path=name, recursive=True, cache=False)
     if request.method == 'POST':
         form = forms.Dataset_Destroy(request.POST, fs=name, datasets=datasets)
         if form.is_valid():
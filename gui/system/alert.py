@@ -1,11 +1,15 @@
+from collections import deque
 import pickle
 import datetime
 import hashlib
 import imp
 import logging
 import os
+import queue
 import socket
+import sqlite3
 import subprocess
+import threading
 import time
 
 from django.utils.translation import ugettext_lazy as _
@@ -24,6 +28,9 @@ from lxml import etree
 
 log = logging.getLogger('system.alert')
 
+# Alert modules running at the same time
+ALERT_WORKERS = 4
+
 
 def alert_node():
     from freenasUI.middleware.notifier import notifier
@@ -53,6 +60,8 @@ class BaseAlert(object, metaclass=BaseAlertMetaclass):
     interval = 0
     fire_once = False
     name = None
+    # Seconds to wait for run() before giving up on it for this round
+    timeout = 60
 
     def __init__(self, alert):
         self.alert = alert
@@ -180,9 +189,128 @@ class SnmpTrapSender:
         return True
 
 
+class AlertStore(object):
+    """
+    Results of alert modules, one row per module.
+
+    Alerts are only written for the modules which ran, along with how
+    long they took, so a run does not rewrite the state of every module.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'name TEXT PRIMARY KEY, seq INTEGER, active INTEGER, '
+            'lastrun REAL, duration REAL, error TEXT, timeouts INTEGER, '
+            'alerts BLOB)'
+        )
+        return conn
+
+    def results(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                'SELECT name, seq, active, lastrun, duration, error, timeouts, alerts FROM results'
+            ).fetchall()
+        finally:
+            conn.close()
+        rv = {}
+        for name, seq, active, lastrun, duration, error, timeouts, alerts in rows:
+            try:
+                alerts = pickle.loads(alerts) if alerts else None
+            except Exception:
+                log.debug('Failed to load alerts of %s', name, exc_info=True)
+                alerts = None
+            rv[name] = {
+                'seq': seq,
+                'active': bool(active),
+                'lastrun': lastrun,
+                'duration': duration,
+                'error': error,
+                'timeouts': timeouts or 0,
+                'alerts': alerts,
+            }
+        return rv
+
+    def alerts(self):
+        """
+        Alerts of the last run, in modules order.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT alerts FROM results WHERE active ORDER BY seq').fetchall()
+        finally:
+            conn.close()
+        rv = []
+        for row in rows:
+            try:
+                rv.extend(a for a in (pickle.loads(row[0]) if row[0] else None) or [] if a)
+            except Exception:
+                log.debug('Failed to load alerts', exc_info=True)
+        return rv
+
+    def save(self, results, flags, removed):
+        """
+        Write `results` (name -> result) in full, update `flags`
+        (name -> (seq, active)) of other modules and delete `removed`.
+        """
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN')
+            conn.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        name, r['seq'], r['active'], r['lastrun'], r['duration'],
+                        r['error'], r['timeouts'], pickle.dumps(r['alerts']),
+                    )
+                    for name, r in results.items()
+                ],
+            )
+            conn.executemany(
+                'UPDATE results SET seq = ?, active = ? WHERE name = ?',
+                [(seq, active, name) for name, (seq, active) in flags.items()],
+            )
+            conn.executemany('DELETE FROM results WHERE name = ?', [(name, ) for name in removed])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+
+class AlertModuleRun(threading.Thread):
+    """
+    Run of an alert module, in a daemon thread so a module which never
+    returns does not prevent the process from exiting.
+    """
+
+    def __init__(self, instance, done):
+        super(AlertModuleRun, self).__init__(daemon=True, name=f'alert.{instance.name}')
+        self.instance = instance
+        self.done = done
+        self.result = None
+        self.error = None
+        self.started = None
+        self.duration = None
+
+    def run(self):
+        self.started = time.monotonic()
+        try:
+            self.result = self.instance.run()
+        except Exception as e:
+            log.debug("Alert module '%s' failed: %s", self.instance, e, exc_info=True)
+            self.error = e
+        finally:
+            self.duration = time.monotonic() - self.started
+            self.done.put(self)
+
+
 class AlertPlugins(metaclass=HookMetaclass):
 
-    ALERT_FILE = '/var/tmp/alert'
+    ALERT_DB = '/var/tmp/alert.db'
 
     def __init__(self):
         self.basepath = os.path.abspath(
@@ -190,6 +318,9 @@ class AlertPlugins(metaclass=HookMetaclass):
         )
         self.modspath = os.path.join(self.basepath, 'alertmods/')
         self.mods = []
+        self.store = AlertStore(self.ALERT_DB)
+        # Modules which timed out and are still running
+        self.running = {}
 
         self.snmp_trap_sender = SnmpTrapSender()
 
@@ -303,6 +434,44 @@ class AlertPlugins(metaclass=HookMetaclass):
             except ClientException as e:
                 log.error(f'Failed to create a support ticket: {e.error}')
 
+    def _run_modules(self, instances):
+        """
+        Run `instances` concurrently, ALERT_WORKERS at a time.
+
+        Returns finished and timed out runs. Modules taking longer than
+        their `timeout` are left running and not run again until they
+        return.
+        """
+        pending = deque(instances)
+        done = queue.Queue()
+        active = {}
+        finished = []
+        timedout = []
+        while pending or active:
+            while pending and len(active) < ALERT_WORKERS:
+                t = AlertModuleRun(pending.popleft(), done)
+                active[t] = time.monotonic() + t.instance.timeout
+                t.start()
+
+            try:
+                t = done.get(timeout=max(min(active.values()) - time.monotonic(), 0))
+            except queue.Empty:
+                pass
+            else:
+                if active.pop(t, None):
+                    finished.append(t)
+
+            now = time.monotonic()
+            for t, deadline in list(active.items()):
+                if deadline <= now:
+                    del active[t]
+                    log.error(
+                        "Alert module '%s' timed out after %s seconds", t.instance, t.instance.timeout
+                    )
+                    self.running[t.instance.name] = t
+                    timedout.append(t)
+        return finished, timedout
+
     @lock('/tmp/.alertrun')
     def run(self):
 
@@ -314,68 +483,121 @@ class AlertPlugins(metaclass=HookMetaclass):
         ):
             return []
 
-        obj = None
-        if os.path.exists(self.ALERT_FILE):
-            with open(self.ALERT_FILE, 'rb') as f:
-                try:
-                    obj = pickle.load(f)
-                except Exception:
-                    log.debug('Failed to load alert state file', exc_info=True)
-
-        if not obj:
+        try:
+            results = self.store.results()
+        except Exception:
+            log.debug('Failed to load alert results', exc_info=True)
             results = {}
-        else:
-            results = obj['results']
+        last_alerts = [
+            a
+            for name, r in sorted(results.items(), key=lambda i: i[1]['seq'] or 0)
+            if r['active']
+            for a in r['alerts'] or []
+            if a
+        ]
+
+        for name, t in list(self.running.items()):
+            if not t.is_alive():
+                self.running.pop(name)
+
+        due = []
+        for instance in self.mods:
+            result = results.get(instance.name)
+            if instance.name in self.running:
+                continue
+            if result and result['lastrun'] is not None:
+                if instance.fire_once:
+                    continue
+                if result['lastrun'] > time.time() - (instance.interval * 60):
+                    continue
+            due.append(instance)
+
+        finished, timedout = self._run_modules(due)
+        runs = {t.instance.name: t for t in finished}
+        timedout = {t.instance.name: t for t in timedout}
+
         rvs = []
         node = alert_node()
         dismisseds = [a.message_id for a in mAlert.objects.filter(node=node)]
         ids = []
-        for instance in self.mods:
-            try:
-                if instance.name in results:
-                    if instance.fire_once:
-                        continue
-                    if results.get(instance.name).get(
-                        'lastrun'
-                    ) > time.time() - (instance.interval * 60):
-                        if results.get(instance.name).get('alerts'):
-                            for alert in results.get(instance.name).get('alerts'):
-                                ids.append(alert.getId())
-                                rvs.append(alert)
-                        continue
-                rv = instance.run()
-                if rv:
-                    alerts = [_f for _f in rv if _f]
-                    for alert in alerts:
-                        ids.append(alert.getId())
-                        if instance.name in results:
-                            found = False
-                            for i in (results[instance.name]['alerts'] or []):
-                                if alert == i:
-                                    found = i
-                                    break
-                            if found is not False:
-                                alert.setTimestamp(found.getTimestamp())
-
-                        if alert.getId() in dismisseds:
-                            alert.setDismiss(True)
-                    rvs.extend(alerts)
-                results[instance.name] = {
-                    'lastrun': int(time.time()),
-                    'alerts': rv,
-                }
-
-            except Exception as e:
-                log.debug("Alert module '%s' failed: %s", instance, e, exc_info=True)
-                log.error("Alert module '%s' failed: %s", instance, e)
+        new_results = {}
+        flags = {}
+        for seq, instance in enumerate(self.mods):
+            result = results.get(instance.name) or {
+                'seq': seq,
+                'active': False,
+                'lastrun': None,
+                'duration': None,
+                'error': None,
+                'timeouts': 0,
+                'alerts': None,
+            }
+            t = runs.get(instance.name)
+            if t is None:
+                # Not due, still running or timed out: keep previous alerts
+                # unless the module only fires once or never succeeded.
+                active = bool(
+                    result['lastrun'] is not None and not instance.fire_once and
+                    (instance.name not in timedout or result['alerts'])
+                )
+                if active:
+                    for alert in result['alerts'] or []:
+                        if alert:
+                            ids.append(alert.getId())
+                            rvs.append(alert)
+                if instance.name in timedout:
+                    new_results[instance.name] = dict(
+                        result,
+                        seq=seq,
+                        active=active,
+                        error=f'Timed out after {instance.timeout} seconds',
+                        timeouts=result['timeouts'] + 1,
+                    )
+                elif (result['seq'], result['active']) != (seq, active) and instance.name in results:
+                    flags[instance.name] = (seq, active)
+                continue
+
+            if t.error is not None:
+                log.error("Alert module '%s' failed: %s", instance, t.error)
+                new_results[instance.name] = dict(
+                    result, seq=seq, active=False, duration=t.duration, error=str(t.error),
+                )
+                continue
+
+            rv = t.result
+            if rv:
+                alerts = [_f for _f in rv if _f]
+                for alert in alerts:
+                    ids.append(alert.getId())
+                    if result['lastrun'] is not None:
+                        found = False
+                        for i in (result['alerts'] or []):
+                            if alert == i:
+                                found = i
+                                break
+                        if found is not False:
+                            alert.setTimestamp(found.getTimestamp())
+
+                    if alert.getId() in dismisseds:
+                        alert.setDismiss(True)
+                rvs.extend(alerts)
+            new_results[instance.name] = dict(
+                result,
+                seq=seq,
+                active=True,
+                lastrun=int(time.time()),
+                duration=t.duration,
+                error=None,
+                alerts=rv,
+            )
 
         qs = mAlert.objects.exclude(message_id__in=ids, node=node)
         if qs.exists():
             qs.delete()
         crits = sorted([a for a in rvs if a and a.getLevel() == Alert.CRIT])
-        if obj and crits:
+        if results and crits:
             lastcrits = sorted([
-                a for a in obj['alerts'] if a and a.getLevel() == Alert.CRIT
+                a for a in last_alerts if a and a.getLevel() == Alert.CRIT
             ])
             if crits == lastcrits:
                 crits = []
@@ -386,7 +608,7 @@ class AlertPlugins(metaclass=HookMetaclass):
         new_alerts = sorted([
             a
             for a in rvs
-            if a and (not obj or a not in obj['alerts'])
+            if a and (not results or a not in last_alerts)
         ])
 
         if service_enabled("snmp"):
@@ -397,9 +619,9 @@ class AlertPlugins(metaclass=HookMetaclass):
             # Automatically create ticket for new alerts tagged as possible
             # hardware problem
             hardware = sorted([a for a in rvs if a and a.getHardware()])
-            if obj and hardware:
+            if results and hardware:
                 lasthardware = sorted([
-                    a for a in obj['alerts'] if a and a.getHardware()
+                    a for a in last_alerts if a and a.getHardware()
                 ])
                 if hardware == lasthardware:
                     hardware = []
@@ -410,19 +632,32 @@ class AlertPlugins(metaclass=HookMetaclass):
             if hardware and support.is_enabled():
                 self.ticket(support, hardware)
 
-        with open(self.ALERT_FILE, 'wb') as f:
-            pickle.dump({
-                'last': time.time(),
-                'alerts': rvs,
-                'results': results,
-            }, f)
+        names = {instance.name for instance in self.mods}
+        self.store.save(new_results, flags, [name for name in results if name not in names])
         return rvs
 
     def get_alerts(self):
-        if not os.path.exists(self.ALERT_FILE):
+        try:
+            return self.store.alerts()
+        except sqlite3.Error:
+            log.debug('Failed to read alerts', exc_info=True)
             return []
-        with open(self.ALERT_FILE, 'rb') as f:
-            return pickle.load(f)['alerts']
+
+    def get_metrics(self):
+        """
+        Timing of alert modules, e.g.
+        {"Smart": {"lastrun": ..., "duration": 0.2, "error": None, "timeouts": 0}}
+        """
+        return {
+            name: {
+                'lastrun': r['lastrun'],
+                'duration': r['duration'],
+                'error': r['error'],
+                'timeouts': r['timeouts'],
+                'running': name in self.running,
+            }
+            for name, r in self.store.results().items()
+        }
 
 
 alertPlugins = AlertPlugins()
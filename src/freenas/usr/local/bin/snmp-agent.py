@@ -1,18 +1,17 @@
 #!/usr/bin/env python
 
+import argparse
 from collections import defaultdict
 import copy
 from datetime import datetime, timedelta
-import os
-import subprocess
-import sys
 import threading
+import time
 
 import libzfs
 import netsnmpagent
+import sysctl
 
-sys.path.append("/usr/local/www")
-from freenasUI.tools.arc_summary import get_Kstat, get_arc_efficiency
+from middlewared.zilstat import ZilStat
 
 
 def calculate_allocation_units(*args):
@@ -27,6 +26,17 @@ def calculate_allocation_units(*args):
     return allocation_units, values
 
 
+def get_arcstats():
+    # Read in-process instead of forking sysctl(8)
+    return {node.name: node.value for node in sysctl.filter("kstat.zfs.misc.arcstats")}
+
+
+def get_ratio_percent(value, total):
+    if total > 0:
+        return "%0.2f" % (100 * value / total)
+    return "%0.2f" % 100
+
+
 def get_zfs_arc_miss_percent(kstat):
     arc_hits = kstat["kstat.zfs.misc.arcstats.hits"]
     arc_misses = kstat["kstat.zfs.misc.arcstats.misses"]
@@ -154,67 +164,176 @@ class ZpoolIoThread(threading.Thread):
             return copy.deepcopy(self.values_overall), copy.deepcopy(self.values_1s)
 
 
-class ZilstatThread(threading.Thread):
+class DatasetThread(threading.Thread):
+    """
+    Walks datasets and zvols of every pool every `interval` seconds, out of
+    the agent loop, reading only the properties the tables need.
+    """
+
     def __init__(self, interval):
         super().__init__()
 
         self.daemon = True
 
         self.interval = interval
-        self.value = {
-            "NBytes": 0,
-            "NBytespersec": 0,
-            "NMaxRate": 0,
-            "BBytes": 0,
-            "BBytespersec": 0,
-            "BMaxRate": 0,
-            "ops": 0,
-            "lteq4kb": 0,
-            "4to32kb": 0,
-            "gteq4kb": 0,
-        }
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.datasets = {}
+        self.zvols = {}
 
     def run(self):
+        zfs = libzfs.ZFS()
         while True:
-            zilstatproc = subprocess.Popen(
-                ["/usr/local/bin/zilstat", str(self.interval), "1"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                preexec_fn=os.setsid,
-            )
-            output = zilstatproc.communicate()[0].strip(b"\n")
-            output = output.split(b"\n")[1].split()
-            self.value = {
-                "NBytes": output[0],
-                "NBytespersec": output[1],
-                "NMaxRate": output[2],
-                "BBytes": output[3],
-                "BBytespersec": output[4],
-                "BMaxRate": output[5],
-                "ops": int(output[6]),
-                "lteq4kb": output[7],
-                "4to32kb": output[8],
-                "gteq4kb": output[9],
-            }
+            try:
+                datasets, zvols = self.walk(zfs)
+            except libzfs.ZFSException:
+                # e.g. pool exported during the walk, try again later
+                pass
+            else:
+                with self.lock:
+                    self.datasets = datasets
+                    self.zvols = zvols
+                    self.generation += 1
+
+            time.sleep(self.interval)
+
+    def walk(self, zfs):
+        datasets = {}
+        zvols = {}
+        for zpool in zfs.pools:
+            for dataset in zpool.root_dataset.children_recursive:
+                if dataset.type not in (libzfs.DatasetType.FILESYSTEM, libzfs.DatasetType.VOLUME):
+                    continue
+
+                # Every access builds all the properties, do it once
+                properties = dataset.properties
+                guid = int(properties["guid"].rawvalue)
+                used = int(properties["used"].rawvalue)
+                available = int(properties["available"].rawvalue)
+                if dataset.type == libzfs.DatasetType.FILESYSTEM:
+                    allocation_units, values = calculate_allocation_units(used + available, used, available)
+                    datasets[guid] = (properties["name"].value, allocation_units) + values
+                else:
+                    allocation_units, values = calculate_allocation_units(
+                        int(properties["volsize"].rawvalue), used, available,
+                    )
+                    zvols[guid] = (properties["name"].value, allocation_units) + values
+        return datasets, zvols
+
+    def get_values(self):
+        with self.lock:
+            return self.generation, self.datasets, self.zvols
+
+
+class IncrementalTable(object):
+    """
+    Keeps the rows of an agent table keyed by a stable key (pool or dataset
+    GUID), only setting the cells whose value changed.
+
+    Every key keeps the index it was given when first seen, so indexes do
+    not shift when other rows go away. netsnmpagent can not remove a single
+    row, the table is rebuilt from the known values when one does.
+    """
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.rows = {}
+        self.indexes = {}
+        self.next_index = 0
+
+    def update(self, items):
+        if any(key not in items for key in self.rows):
+            self.table.clear()
+            self.rows = {}
+            self.indexes = {key: index for key, index in self.indexes.items() if key in items}
+
+        for key, values in items.items():
+            if key in self.rows:
+                row, old = self.rows[key]
+                if old == values:
+                    continue
+            else:
+                if key not in self.indexes:
+                    self.indexes[key] = self.next_index
+                    self.next_index += 1
+                row = self.table.addRow([agent.Integer32(self.indexes[key])])
+                old = (None,) * len(values)
+
+            for (column, type_), value, old_value in zip(self.columns, values, old):
+                if value != old_value:
+                    row.setRowCell(column, type_(value))
+            self.rows[key] = (row, values)
+
+
+class ZilstatThread(threading.Thread):
+    def __init__(self):
+        super().__init__()
+
+        self.daemon = True
+
+        self.lock = threading.Lock()
+        self.zilstat = ZilStat()
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.zilstat.sample()
+            time.sleep(1)
+
+    def get_values(self):
+        with self.lock:
+            return self.zilstat.get()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dataset-interval", type=int, default=30,
+        help="Seconds between refreshes of the dataset and zvol tables",
+    )
+    args = parser.parse_args()
+
     zfs = libzfs.ZFS()
 
     zpool_io_thread = ZpoolIoThread()
     zpool_io_thread.start()
 
-    zilstat_1_thread = ZilstatThread(1)
-    zilstat_1_thread.start()
+    dataset_thread = DatasetThread(args.dataset_interval)
+    dataset_thread.start()
 
-    zilstat_5_thread = ZilstatThread(5)
-    zilstat_5_thread.start()
-
-    zilstat_10_thread = ZilstatThread(10)
-    zilstat_10_thread.start()
+    zilstat_thread = ZilstatThread()
+    zilstat_thread.start()
 
     agent.start()
 
+    zpool_rows = IncrementalTable(zpool_table, [
+        (2, agent.DisplayString),
+        (3, agent.Integer32),
+        (4, agent.Integer32),
+        (5, agent.Integer32),
+        (6, agent.Integer32),
+        (7, agent.DisplayString),
+        (8, agent.Counter64),
+        (9, agent.Counter64),
+        (10, agent.Counter64),
+        (11, agent.Counter64),
+        (12, agent.Counter64),
+        (13, agent.Counter64),
+        (14, agent.Counter64),
+        (15, agent.Counter64),
+    ])
+    dataset_columns = [
+        (2, agent.DisplayString),
+        (3, agent.Integer32),
+        (4, agent.Integer32),
+        (5, agent.Integer32),
+        (6, agent.Integer32),
+    ]
+    dataset_rows = IncrementalTable(dataset_table, dataset_columns)
+    zvol_rows = IncrementalTable(zvol_table, dataset_columns)
+    dataset_generation = 0
+
     last_update_at = datetime.min
     while True:
         agent.check_and_process()
@@ -222,93 +341,51 @@ if __name__ == "__main__":
         if datetime.utcnow() - last_update_at > timedelta(seconds=1):
             zpool_io_overall, zpool_io_1sec = zpool_io_thread.get_values()
 
-            datasets = []
-            zvols = []
-            zpool_table.clear()
-            for i, zpool in enumerate(zfs.pools):
-                row = zpool_table.addRow([agent.Integer32(i)])
-                row.setRowCell(2, agent.DisplayString(zpool.properties["name"].value))
-                allocation_units, \
-                    (
-                        size,
-                        used,
-                        available
-                    ) = calculate_allocation_units(
-                        int(zpool.properties["size"].rawvalue),
-                        int(zpool.properties["allocated"].rawvalue),
-                        int(zpool.properties["free"].rawvalue),
-                    )
-                row.setRowCell(3, agent.Integer32(allocation_units))
-                row.setRowCell(4, agent.Integer32(size))
-                row.setRowCell(5, agent.Integer32(used))
-                row.setRowCell(6, agent.Integer32(available))
-                row.setRowCell(7, agent.DisplayString(zpool.properties["health"].value))
-                row.setRowCell(8, agent.Counter64(zpool_io_overall[zpool.name]["read_ops"]))
-                row.setRowCell(9, agent.Counter64(zpool_io_overall[zpool.name]["write_ops"]))
-                row.setRowCell(10, agent.Counter64(zpool_io_overall[zpool.name]["read_bytes"]))
-                row.setRowCell(11, agent.Counter64(zpool_io_overall[zpool.name]["write_bytes"]))
-                row.setRowCell(12, agent.Counter64(zpool_io_1sec[zpool.name]["read_ops"]))
-                row.setRowCell(13, agent.Counter64(zpool_io_1sec[zpool.name]["write_ops"]))
-                row.setRowCell(14, agent.Counter64(zpool_io_1sec[zpool.name]["read_bytes"]))
-                row.setRowCell(15, agent.Counter64(zpool_io_1sec[zpool.name]["write_bytes"]))
-
-                for dataset in zpool.root_dataset.children_recursive:
-                    if dataset.type == libzfs.DatasetType.FILESYSTEM:
-                        datasets.append(dataset)
-                    if dataset.type == libzfs.DatasetType.VOLUME:
-                        zvols.append(dataset)
-
-            dataset_table.clear()
-            for i, dataset in enumerate(datasets):
-                row = dataset_table.addRow([agent.Integer32(i)])
-                row.setRowCell(2, agent.DisplayString(dataset.properties["name"].value))
-                allocation_units, (
-                    size,
-                    used,
-                    available
-                ) = calculate_allocation_units(
-                    int(dataset.properties["used"].rawvalue) + int(dataset.properties["available"].rawvalue),
-                    int(dataset.properties["used"].rawvalue),
-                    int(dataset.properties["available"].rawvalue),
+            zpools = {}
+            for zpool in zfs.pools:
+                properties = zpool.properties
+                allocation_units, values = calculate_allocation_units(
+                    int(properties["size"].rawvalue),
+                    int(properties["allocated"].rawvalue),
+                    int(properties["free"].rawvalue),
                 )
-                row.setRowCell(3, agent.Integer32(allocation_units))
-                row.setRowCell(4, agent.Integer32(size))
-                row.setRowCell(5, agent.Integer32(used))
-                row.setRowCell(6, agent.Integer32(available))
-
-            zvol_table.clear()
-            for i, zvol in enumerate(zvols):
-                row = zvol_table.addRow([agent.Integer32(i)])
-                row.setRowCell(2, agent.DisplayString(zvol.properties["name"].value))
-                allocation_units, (
-                    volsize,
-                    used,
-                    available
-                ) = calculate_allocation_units(
-                    int(zvol.properties["volsize"].rawvalue),
-                    int(zvol.properties["used"].rawvalue),
-                    int(zvol.properties["available"].rawvalue),
+                io_overall = zpool_io_overall[zpool.name]
+                io_1sec = zpool_io_1sec[zpool.name]
+                zpools[zpool.guid] = (properties["name"].value, allocation_units) + values + (
+                    properties["health"].value,
+                    io_overall["read_ops"],
+                    io_overall["write_ops"],
+                    io_overall["read_bytes"],
+                    io_overall["write_bytes"],
+                    io_1sec["read_ops"],
+                    io_1sec["write_ops"],
+                    io_1sec["read_bytes"],
+                    io_1sec["write_bytes"],
                 )
-                row.setRowCell(3, agent.Integer32(allocation_units))
-                row.setRowCell(4, agent.Integer32(volsize))
-                row.setRowCell(5, agent.Integer32(used))
-                row.setRowCell(6, agent.Integer32(available))
+            zpool_rows.update(zpools)
+
+            generation, datasets, zvols = dataset_thread.get_values()
+            if generation != dataset_generation:
+                dataset_rows.update(datasets)
+                zvol_rows.update(zvols)
+                dataset_generation = generation
 
             last_update_at = datetime.utcnow()
 
-            kstat = get_Kstat()
-            arc_efficiency = get_arc_efficiency(kstat)
+            kstat = get_arcstats()
+            arc_hits = kstat["kstat.zfs.misc.arcstats.hits"]
+            arc_misses = kstat["kstat.zfs.misc.arcstats.misses"]
 
             zfs_arc_size.update(kstat["kstat.zfs.misc.arcstats.size"] / 1024)
             zfs_arc_meta.update(kstat["kstat.zfs.misc.arcstats.arc_meta_used"] / 1024)
             zfs_arc_data.update(kstat["kstat.zfs.misc.arcstats.data_size"] / 1024)
-            zfs_arc_hits.update(kstat["kstat.zfs.misc.arcstats.hits"] % 2 ** 32)
-            zfs_arc_misses.update(kstat["kstat.zfs.misc.arcstats.misses"] % 2 ** 32)
+            zfs_arc_hits.update(arc_hits % 2 ** 32)
+            zfs_arc_misses.update(arc_misses % 2 ** 32)
             zfs_arc_c.update(kstat["kstat.zfs.misc.arcstats.c"] / 1024)
             zfs_arc_p.update(kstat["kstat.zfs.misc.arcstats.p"] / 1024)
             zfs_arc_miss_percent.update(str(get_zfs_arc_miss_percent(kstat)).encode("ascii"))
-            zfs_arc_cache_hit_ratio.update(str(arc_efficiency["cache_hit_ratio"]["per"][:-1]).encode("ascii"))
-            zfs_arc_cache_miss_ratio.update(str(arc_efficiency["cache_miss_ratio"]["per"][:-1]).encode("ascii"))
+            zfs_arc_cache_hit_ratio.update(get_ratio_percent(arc_hits, arc_hits + arc_misses).encode("ascii"))
+            zfs_arc_cache_miss_ratio.update(get_ratio_percent(arc_misses, arc_hits + arc_misses).encode("ascii"))
 
             zfs_l2arc_hits.update(int(kstat["kstat.zfs.misc.arcstats.l2_hits"] % 2 ** 32))
             zfs_l2arc_misses.update(int(kstat["kstat.zfs.misc.arcstats.l2_misses"] % 2 ** 32))
@@ -316,6 +393,7 @@ if __name__ == "__main__":
             zfs_l2arc_write.update(int(kstat["kstat.zfs.misc.arcstats.l2_write_bytes"] / 1024 % 2 ** 32))
             zfs_l2arc_size.update(int(kstat["kstat.zfs.misc.arcstats.l2_size"] / 1024))
 
-            zfs_zilstat_ops1.update(zilstat_1_thread.value["ops"])
-            zfs_zilstat_ops5.update(zilstat_5_thread.value["ops"])
-            zfs_zilstat_ops10.update(zilstat_10_thread.value["ops"])
+            zilstat = zilstat_thread.get_values()
+            zfs_zilstat_ops1.update(zilstat["1"]["ops"])
+            zfs_zilstat_ops5.update(zilstat["5"]["ops"])
+            zfs_zilstat_ops10.update(zilstat["10"]["ops"])
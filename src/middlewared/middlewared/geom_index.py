@@ -0,0 +1,182 @@
+"""
+Index of the GEOM topology (kern.geom.confxml) for constant time disk
+lookups.
+
+The index is built once and shared by middlewared plugins and the
+notifier until it is invalidated, which happens on devfs events and when
+the notifier changes the GEOM configuration. Processes not receiving
+devfs events (e.g. the GUI) revalidate it against the current XML.
+"""
+import re
+import threading
+from xml.etree import ElementTree
+
+import sysctl
+
+RE_IDENTIFIER = re.compile(r'\{(?P<type>.+?)\}(?P<value>.+)')
+
+_index = None
+_index_generation = 0
+_index_lock = threading.Lock()
+
+
+class GeomIndex(object):
+    """
+    Lookup tables built in one pass over the GEOM XML document.
+    """
+
+    def __init__(self, xml):
+        self.xml = xml
+        # DISK geom name -> ident, lunid and mediasize of its provider
+        self.disks = {}
+        self.by_serial = {}
+        self.by_serial_stripped = {}
+        self.by_serial_lunid = {}
+        # PART rawuuid -> geom (disk) name
+        self.by_uuid = {}
+        # PART provider name -> config (rawtype, rawuuid, ...)
+        self.partitions = {}
+        # LABEL provider name (e.g. gptid/...) -> LABEL geom name
+        self.by_label = {}
+        # LABEL geom name -> name of its first provider
+        self.labels = {}
+        # LABEL provider name -> provider id its geom consumes
+        self.label_consumes = {}
+        # DEV geom name -> provider id it consumes
+        self.devs = {}
+        # provider id -> (geom name, class name)
+        self.providers = {}
+        # Serials found with smartctl for disks without a GEOM ident
+        self.smart_serials = {}
+
+        root = ElementTree.fromstring(xml)
+        for klass in root.findall('class'):
+            cname = klass.findtext('name')
+            for geom in klass.findall('geom'):
+                self.__add_geom(cname, geom)
+
+    def __add_geom(self, cname, geom):
+        gname = geom.findtext('name')
+        consumes = None
+        for consumer in geom.findall('consumer'):
+            provider = consumer.find('provider')
+            if provider is not None and provider.get('ref'):
+                consumes = provider.get('ref')
+                break
+
+        if cname == 'DEV':
+            self.devs[gname] = consumes
+
+        for provider in geom.findall('provider'):
+            pname = provider.findtext('name')
+            config = provider.find('config')
+            config = {} if config is None else {i.tag: i.text for i in config}
+            self.providers[provider.get('id')] = (gname, cname)
+
+            if cname == 'DISK':
+                ident = config.get('ident')
+                lunid = config.get('lunid')
+                mediasize = provider.findtext('mediasize')
+                self.disks.setdefault(gname, {
+                    'ident': ident,
+                    'lunid': lunid,
+                    'mediasize': int(mediasize) if mediasize else None,
+                })
+                if ident:
+                    self.by_serial.setdefault(ident, gname)
+                    self.by_serial_stripped.setdefault(' '.join(ident.split()), gname)
+                    self.by_serial_lunid.setdefault(f'{ident}_{lunid or ""}', gname)
+            elif cname == 'PART':
+                self.partitions[pname] = config
+                if config.get('rawuuid') and not gname.startswith('label'):
+                    self.by_uuid.setdefault(config['rawuuid'], gname)
+            elif cname == 'LABEL':
+                self.by_label.setdefault(pname, gname)
+                self.labels.setdefault(gname, pname)
+                self.label_consumes[pname] = consumes
+
+    def identifier_to_device(self, ident):
+        """
+        Get the device name of a disk identifier (see
+        `disk.device_to_identifier`).
+
+        Returns None if not found. Disks identified by a serial GEOM does
+        not know about are only found if their serial has been added to
+        `smart_serials`.
+        """
+        if not ident:
+            return None
+
+        search = RE_IDENTIFIER.search(ident)
+        if not search:
+            return None
+
+        tp = search.group('type')
+        value = search.group('value')
+        if tp == 'uuid':
+            return self.by_uuid.get(value)
+        elif tp == 'label':
+            return self.by_label.get(value)
+        elif tp == 'serial':
+            name = self.by_serial.get(value) or self.by_serial_stripped.get(' '.join(value.split()))
+            if name:
+                return name
+            for name, serial in self.smart_serials.items():
+                if serial == value:
+                    return name
+            return None
+        elif tp == 'serial_lunid':
+            return self.by_serial_lunid.get(value)
+        elif tp == 'devicename':
+            return value if value in self.devs else None
+        else:
+            raise NotImplementedError
+
+    def label_to_disk(self, name):
+        """
+        Get the name of the geom (disk) providing a geom label or device.
+        """
+        if name in self.label_consumes:
+            provider = self.label_consumes[name]
+        else:
+            provider = self.devs.get(name)
+        if provider is None or provider not in self.providers:
+            return None
+        disk, cname = self.providers[provider]
+        if cname == 'ELI':
+            return self.label_to_disk(disk.replace('.eli', ''))
+        return disk
+
+
+def get_geom_index(revalidate=False):
+    """
+    Get the shared GEOM index, building it if it has been invalidated.
+
+    With `revalidate` the index is also rebuilt if the GEOM XML changed
+    since it was built, for callers which cannot rely on devfs events.
+    """
+    global _index
+    with _index_lock:
+        index = _index
+        generation = _index_generation
+    xml = None
+    if index is not None and revalidate:
+        xml = sysctl.filter('kern.geom.confxml')[0].value
+        if xml != index.xml:
+            index = None
+    if index is None:
+        if xml is None:
+            xml = sysctl.filter('kern.geom.confxml')[0].value
+        index = GeomIndex(xml)
+        with _index_lock:
+            # Do not keep an index built before an invalidation
+            if generation == _index_generation:
+                _index = index
+    return index
+
+
+def invalidate_geom_index():
+    global _index, _index_generation
+    with _index_lock:
+        _index = None
+        _index_generation += 1
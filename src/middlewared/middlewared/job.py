@@ -1,5 +1,5 @@
 import asyncio
-from collections import OrderedDict
+from collections import defaultdict, deque, OrderedDict
 import copy
 from datetime import datetime
 import enum
@@ -10,7 +10,34 @@ import sys
 import time
 import traceback
 
+from middlewared.job_history import JobsHistory
 from middlewared.utils import Popen
+from middlewared.worker import JOB_PROCESS, JOB_PROCESS_ENV, JobWorkerUnavailable
+
+
+# Arguments with these names are never written to the jobs history
+REDACTED_ARGUMENTS = ('password', 'passphrase', 'secret')
+
+
+def redact_arguments(method, args):
+    """
+    Returns a copy of job `args` with credentials masked, looking both at
+    the names in the method `accepts` schema and dict keys.
+    """
+    def redact(name, value):
+        if value is not None and isinstance(name, str) and any(i in name.lower() for i in REDACTED_ARGUMENTS):
+            return '********'
+        if isinstance(value, dict):
+            return {k: redact(k, v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [redact(None, v) for v in value]
+        return value
+
+    schema = getattr(method, 'accepts', None) or []
+    return [
+        redact(schema[i].name if i < len(schema) else None, arg)
+        for i, arg in enumerate(args)
+    ]
 
 
 class State(enum.Enum):
@@ -27,58 +54,97 @@ class JobSharedLock(object):
     Each job method can specify a lock which will be shared
     among all calls for that job and only one job can run at a time
     for this lock.
+
+    Jobs waiting for the lock are kept in FIFO order.
     """
 
     def __init__(self, queue, name):
         self.queue = queue
         self.name = name
-        self.jobs = []
-        self.semaphore = asyncio.Semaphore()
-
-    def add_job(self, job):
-        self.jobs.append(job)
-
-    def get_jobs(self):
-        return self.jobs
-
-    def remove_job(self, job):
-        self.jobs.remove(job)
+        self.owner = None
+        self.waiting = deque()
 
     def locked(self):
-        return self.semaphore.locked()
+        return self.owner is not None
+
+    def acquire(self, job):
+        """
+        Acquire the lock for `job` or put it in the wait queue.
 
-    async def acquire(self):
-        return await self.semaphore.acquire()
+        Returns whether the lock has been acquired.
+        """
+        if self.owner is None:
+            self.owner = job
+            return True
+        self.waiting.append(job)
+        return False
 
     def release(self):
-        return self.semaphore.release()
+        """
+        Release the lock and hand it over to the next waiting job, if any.
+
+        Returns the new owner.
+        """
+        self.owner = self.waiting.popleft() if self.waiting else None
+        return self.owner
 
 
 class JobsQueue(object):
 
     def __init__(self, middleware):
         self.middleware = middleware
-        self.deque = JobsDeque()
-        self.queue = []
+        try:
+            self.history = JobsHistory()
+        except Exception:
+            self.history = None
+            self.middleware.logger.warn('Failed to open jobs history', exc_info=True)
+        # Keep assigning ids after the ones in history
+        self.deque = JobsDeque(start_id=self.history.last_id() if self.history else 0)
+
+        # Jobs which hold all they need to run (lock and concurrency slot)
+        self.ready = deque()
 
         # Event responsible for the job queue schedule loop.
-        # This event is set and a new job is potentially ready to run
+        # This event is set when there are jobs ready to run
         self.queue_event = asyncio.Event()
 
         # Shared lock (JobSharedLock) dict
         self.job_locks = {}
 
+        # Running jobs and jobs waiting for a concurrency slot per method
+        self.method_running = defaultdict(int)
+        self.method_waiting = defaultdict(deque)
+
     def all(self):
         return self.deque.all()
 
+    def archive(self, job):
+        """
+        Append a finished job to the jobs history.
+        """
+        if self.history is None:
+            return
+
+        async def add(data):
+            try:
+                await self.middleware.threaded(self.history.add, data)
+            except Exception:
+                self.middleware.logger.warn('Failed to archive job %d', data['id'], exc_info=True)
+        data = job.__encode__()
+        data['arguments'] = redact_arguments(job.method, job.args)
+        asyncio.ensure_future(add(data))
+
     def add(self, job):
         self.deque.add(job)
-        self.queue.append(job)
 
         self.middleware.send_event('core.get_jobs', 'ADDED', id=job.id, fields=job.__encode__())
 
-        # A job has been added to the queue, let the queue scheduler run
-        self.queue_event.set()
+        lock = self.get_lock(job)
+        if lock is None or lock.acquire(job):
+            job.lock = lock
+            self.__acquire_slot(job)
+        else:
+            job.waiting_for = 'lock'
 
     def get_lock(self, job):
         """
@@ -92,51 +158,54 @@ class JobsQueue(object):
         if lock is None:
             lock = JobSharedLock(self, name)
             self.job_locks[lock.name] = lock
-        lock.add_job(job)
         return lock
 
+    def __acquire_slot(self, job):
+        max_concurrency = job.options.get('max_concurrency')
+        if max_concurrency and self.method_running[job.method_name] >= max_concurrency:
+            job.waiting_for = 'concurrency'
+            self.method_waiting[job.method_name].append(job)
+            return
+        self.method_running[job.method_name] += 1
+        self.__ready(job)
+
+    def __ready(self, job):
+        job.waiting_for = None
+        self.ready.append(job)
+        # A job is ready, let the queue scheduler run
+        self.queue_event.set()
+
     def release_lock(self, job):
+        # Hand the concurrency slot to the next job of the same method
+        waiting = self.method_waiting.get(job.method_name)
+        if waiting:
+            self.__ready(waiting.popleft())
+        else:
+            self.method_running[job.method_name] -= 1
+            if self.method_running[job.method_name] == 0:
+                self.method_running.pop(job.method_name)
+            self.method_waiting.pop(job.method_name, None)
+
         lock = job.get_lock()
         if not lock:
             return
-        # Remove job from lock list and release it so another job can use it
-        lock.remove_job(job)
-        lock.release()
-
-        if len(lock.get_jobs()) == 0:
+        # Hand the lock to the next job waiting for it, if any
+        owner = lock.release()
+        if owner is None:
             self.job_locks.pop(lock.name)
-
-        # Once a lock is released there could be another job in the queue
-        # waiting for the same lock
-        self.queue_event.set()
+        else:
+            owner.lock = lock
+            self.__acquire_slot(owner)
 
     async def __next__(self):
         """
         This is a blocking method.
         Returns when there is a new job ready to run.
         """
-        while True:
-            # Awaits a new event to look for a job
+        while not self.ready:
+            self.queue_event.clear()
             await self.queue_event.wait()
-            found = None
-            for job in self.queue:
-                lock = self.get_lock(job)
-                # Get job in the queue if it has no lock or its not locked
-                if lock is None or not lock.locked():
-                    found = job
-                    if lock:
-                        await job.set_lock(lock)
-                    break
-            if found:
-                # Unlocked job found to run
-                self.queue.remove(found)
-                # If there are no more jobs in the queue, clear the event
-                if len(self.queue) == 0:
-                    self.queue_event.clear()
-                return found
-            else:
-                # No jobs available to run, clear the event
-                self.queue_event.clear()
+        return self.ready.popleft()
 
     async def run(self):
         while True:
@@ -150,15 +219,15 @@ class JobsDeque(object):
     with a `id` assigner.
     """
 
-    def __init__(self, maxlen=1000):
-        self.maxlen = 1000
-        self.count = 0
+    def __init__(self, maxlen=1000, start_id=0):
+        self.maxlen = maxlen
+        self.count = start_id
         self.__dict = OrderedDict()
 
     def add(self, job):
         self.count += 1
         job.set_id(self.count)
-        if len(self.__dict) > self.maxlen:
+        if len(self.__dict) >= self.maxlen:
             self.__dict.popitem(last=False)
         self.__dict[job.id] = job
 
@@ -192,6 +261,10 @@ class Job(object):
         }
         self.time_started = datetime.now()
         self.time_finished = None
+        self.time_queued = time.monotonic()
+        self.queue_wait = None
+        # What the job is waiting for to run: "lock", "concurrency" or None
+        self.waiting_for = None
         self.loop = None
         self.future = None
 
@@ -215,10 +288,6 @@ class Job(object):
     def get_lock(self):
         return self.lock
 
-    async def set_lock(self, lock):
-        self.lock = lock
-        await self.lock.acquire()
-
     def set_result(self, result):
         self.result = result
 
@@ -261,6 +330,7 @@ class Job(object):
         """
 
         self.set_state('RUNNING')
+        self.queue_wait = time.monotonic() - self.time_queued
         try:
             self.loop = asyncio.get_event_loop()
             self.future = asyncio.ensure_future(self.__run_body())
@@ -275,31 +345,41 @@ class Job(object):
             queue.release_lock(self)
             self._finished.set()
             self.middleware.send_event('core.get_jobs', 'CHANGED', id=self.id, fields=self.__encode__())
+            queue.archive(self)
 
     async def __run_body(self):
         """
-        If job is flagged as process a new process is spawned
-        with the job id which will in turn run the method
-        and return the result as a json
+        If job is flagged as process it is handed over to an idle worker
+        of the job worker pool, or a new process is spawned with the job id
+        if the pool is disabled. Either way the method runs in a separate
+        process and returns the result as a json
         """
         if self.options.get('process'):
+            pool = self.middleware.job_worker_pool
+            if pool.enabled() and pool.workers:
+                try:
+                    data = await pool.run(self)
+                except JobWorkerUnavailable:
+                    # Workers failed to start, spawn a process for the job
+                    data = None
+            else:
+                data = None
+            if data is not None:
+                if 'exception' in data:
+                    self.set_state('FAILED')
+                    self.error = data['error']
+                    self.exception = data['exception']
+                else:
+                    self.set_result(data['result'])
+                    self.set_state('SUCCESS')
+                return
+
             proc = await Popen([
                 '/usr/bin/env',
                 'python3',
-                os.path.join(
-                    os.path.dirname(os.path.realpath(__file__)),
-                    'job_process.py',
-                ),
+                JOB_PROCESS,
                 str(self.id),
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
-                env={
-                    'LOGNAME': 'root',
-                    'USER': 'root',
-                    'GROUP': 'wheel',
-                    'HOME': '/root',
-                    'PATH': '/sbin:/bin:/usr/sbin:/usr/bin:/usr/local/sbin:/usr/local/bin',
-                    'TERM': 'xterm',
-                })
+            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, env=JOB_PROCESS_ENV)
             output = await proc.communicate()
             try:
                 data = json.loads(output[0].decode())
@@ -336,6 +416,8 @@ class Job(object):
             'state': self.state.name,
             'time_started': self.time_started,
             'time_finished': self.time_finished,
+            'queue_wait': self.queue_wait if self.queue_wait is not None else time.monotonic() - self.time_queued,
+            'waiting_for': self.waiting_for,
         }
 
 
@@ -0,0 +1,195 @@
+from datetime import datetime
+import os
+import sqlite3
+import threading
+import zlib
+
+from middlewared.client import ejson as json
+from middlewared.utils import filter_compile
+
+JOBS_HISTORY_PATH = '/var/db/middlewared/jobs.db'
+JOBS_HISTORY_MAXLEN = 100000
+# Rows decoded at a time when filtering on non indexed attributes
+JOBS_HISTORY_BATCH = 500
+
+# Job attributes stored in their own indexed columns, which filters and
+# ordering can be pushed down to
+COLUMNS = ('id', 'method', 'state', 'time_started', 'time_finished')
+SQL_OPMAP = {
+    '=': '=',
+    '!=': '!=',
+    '>': '>',
+    '>=': '>=',
+    '<': '<',
+    '<=': '<=',
+    'in': 'IN',
+    'nin': 'NOT IN',
+}
+
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        return (value - datetime(1970, 1, 1)).total_seconds()
+    return value
+
+
+class JobsHistory(object):
+    """
+    Append-only on-disk log of finished jobs.
+
+    Jobs are stored as compressed JSON along with indexed columns for id,
+    method, state and times so `core.get_jobs` can query old jobs without
+    keeping them in memory. Only the last `maxlen` jobs are retained.
+    """
+
+    def __init__(self, path=JOBS_HISTORY_PATH, maxlen=JOBS_HISTORY_MAXLEN):
+        self.path = path
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Jobs results may hold sensitive data, only root can read them
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY, method TEXT, state TEXT, '
+            'time_started REAL, time_finished REAL, data BLOB)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_method ON jobs (method, id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_time_started ON jobs (time_started)')
+        self.added = 0
+
+    def last_id(self):
+        with self.lock:
+            return self.conn.execute('SELECT MAX(id) FROM jobs').fetchone()[0] or 0
+
+    def add(self, job):
+        """
+        Append the encoded `job` to the log.
+        """
+        data = zlib.compress(json.dumps(job, separators=(',', ':')).encode())
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    job['id'], job['method'], job['state'],
+                    _timestamp(job['time_started']), _timestamp(job['time_finished']), data,
+                ),
+            )
+            self.added += 1
+            # Prune in batches instead of on every insert
+            if self.added % 1000 == 0:
+                self.conn.execute('DELETE FROM jobs WHERE id <= ?', (job['id'] - self.maxlen,))
+
+    def __where(self, filters):
+        """
+        Translate `filters` into a SQL WHERE clause.
+
+        Returns None if any filter can not be translated.
+        """
+        clauses = []
+        params = []
+        for f in filters:
+            if len(f) == 3:
+                name, op, value = f
+                if name not in COLUMNS or op not in SQL_OPMAP:
+                    return None
+                if op in ('in', 'nin'):
+                    value = list(value)
+                    clauses.append(f'{name} {SQL_OPMAP[op]} ({",".join("?" * len(value))})')
+                    params.extend(_timestamp(i) for i in value)
+                else:
+                    clauses.append(f'{name} {SQL_OPMAP[op]} ?')
+                    params.append(_timestamp(value))
+            elif len(f) == 2 and f[0] == 'OR':
+                or_clauses = []
+                for i in f[1]:
+                    where = self.__where([i])
+                    if where is None:
+                        return None
+                    or_clauses.append(where[0])
+                    params.extend(where[1])
+                clauses.append('(' + ' OR '.join(or_clauses) + ')')
+            else:
+                return None
+        return ' AND '.join(clauses) or '1', params
+
+    def __order_by(self, order_by):
+        rv = []
+        for o in order_by:
+            desc = o.startswith('-')
+            name = o[1:] if desc else o
+            if name not in COLUMNS:
+                return None
+            rv.append(f'{name} DESC' if desc else name)
+        return ', '.join(rv) or 'id'
+
+    def query(self, before_id, filters=None, options=None):
+        """
+        Query jobs with id lower than `before_id` (the ones no longer in
+        memory).
+
+        Filters and ordering on indexed columns are run by SQLite, pushing
+        down `limit` so a page of results (e.g. `[["id", "<", last_id]]`
+        with `{"order_by": ["-id"], "limit": 50}`) costs an index range
+        scan. Filters on other attributes are applied while reading rows
+        in batches, stopping as soon as `offset + limit` jobs matched.
+        Ordering is only possible on indexed columns.
+
+        Only up to `offset + limit` jobs are returned, the caller applies
+        `offset` after merging them with the in-memory jobs.
+        """
+        filters = filters or []
+        options = options or {}
+
+        order_by = self.__order_by(options.get('order_by') or [])
+        if order_by is None:
+            raise ValueError(f'Jobs history can only be ordered by {", ".join(COLUMNS)}')
+
+        # Translate as many filters as possible, the rest is run in Python
+        sql_filters, residual = [], []
+        for f in filters:
+            (residual if self.__where([f]) is None else sql_filters).append(f)
+        where, params = self.__where(sql_filters)
+        sql_where, params = f'id < ? AND ({where})', [before_id] + params
+
+        if options.get('count') and not residual:
+            with self.lock:
+                return self.conn.execute(f'SELECT COUNT(*) FROM jobs WHERE {sql_where}', params).fetchone()[0]
+
+        top = (options.get('offset') or 0) + options['limit'] if options.get('limit') else None
+        sql = f'SELECT data FROM jobs WHERE {sql_where} ORDER BY {order_by}'
+        if top is not None and not residual:
+            sql += ' LIMIT ?'
+            params.append(top)
+
+        predicate = filter_compile(residual) if residual else None
+        jobs = []
+        count = 0
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            try:
+                while top is None or len(jobs) < top:
+                    rows = cursor.fetchmany(JOBS_HISTORY_BATCH)
+                    if not rows:
+                        break
+                    for row in rows:
+                        job = json.loads(zlib.decompress(row[0]).decode())
+                        if predicate is not None and not predicate(job):
+                            continue
+                        if options.get('count'):
+                            count += 1
+                            continue
+                        jobs.append(job)
+                        if top is not None and len(jobs) >= top:
+                            break
+            finally:
+                cursor.close()
+
+        if options.get('count'):
+            return count
+        return jobs
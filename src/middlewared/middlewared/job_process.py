@@ -10,6 +10,7 @@ import json
 import logging
 import os
 import sys
+import time
 import traceback
 
 
@@ -96,20 +97,74 @@ class FakeJob(object):
         self.client.call('core.job_update', self.id, {'progress': self.progress})
 
 
-async def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('job', type=int)
-    args = parser.parse_args()
+def connect():
+    """
+    Connect to middlewared, retrying for a while since workers may be
+    started before the websocket server is accepting connections.
+    """
+    retries = 30
+    while True:
+        try:
+            return Client()
+        except Exception:
+            retries -= 1
+            if retries == 0:
+                raise
+            time.sleep(1)
+
+
+async def worker():
+    """
+    Job worker mode, used by the middlewared job worker pool.
+
+    Plugins are loaded and the connection to middlewared is opened only once.
+    Job ids are then read one per line from stdin and the result of each job
+    is written as a single line of JSON to stdout. Plugins may print to
+    stdout, so the protocol uses a private copy of it and the regular
+    stdout is pointed to stderr.
+    """
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    with connect() as c:
+        middleware = FakeMiddleware(c)
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                # Pool closed our stdin, time to go
+                break
+            try:
+                data = {'result': await middleware._call_job(int(line))}
+            except Exception as e:
+                data = {
+                    'exception': ''.join(traceback.format_exception(*sys.exc_info())),
+                    'error': str(e),
+                }
+            output.write(json.dumps(data) + '\n')
+            output.flush()
+
+
+async def main(job_id):
     with Client() as c:
         middleware = FakeMiddleware(c)
-        return await middleware._call_job(args.job)
+        return await middleware._call_job(job_id)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('job', type=int, nargs='?')
+    parser.add_argument('--worker', action='store_true')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    if args.worker:
+        loop.run_until_complete(worker())
+        sys.exit(0)
+
+    if args.job is None:
+        parser.error('job id is required')
+
     try:
-        loop = asyncio.get_event_loop()
-        coro = main()
-        loop.run_until_complete(coro)
-        print(json.dumps(coro.result()))
+        print(json.dumps(loop.run_until_complete(main(args.job))))
     except Exception as e:
         print(json.dumps({
             'exception': ''.join(traceback.format_exception(*sys.exc_info())),
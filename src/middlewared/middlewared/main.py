@@ -4,16 +4,17 @@ from .job import Job, JobsQueue
 from .restful import RESTfulAPI
 from .schema import ResolverError, Error as SchemaError
 from .service import CallError, CallException, ValidationError, ValidationErrors
+from .threadpool import ThreadPool
+from .worker import JobWorkerPool
 from aiohttp import web
 from aiohttp_wsgi import WSGIHandler
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from daemon import DaemonContext
 from daemon.pidfile import TimeoutPIDLockFile
 
 import argparse
 import asyncio
 import binascii
-import concurrent.futures
 import errno
 import functools
 import imp
@@ -25,6 +26,7 @@ import select
 import setproctitle
 import signal
 import sys
+import tempfile
 import threading
 import time
 import traceback
@@ -33,6 +35,36 @@ import urllib.parse
 import uuid
 from . import logger
 
+# Size of the chunks streamed between job pipes and HTTP file transfers
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Max events waiting to be sent to a websocket client which is not keeping up
+EVENT_QUEUE_MAXSIZE = 1000
+# Transport write buffer size above which a client is deemed slow
+EVENT_HIGH_WATER = 256 * 1024
+
+
+def event_merge(old, new):
+    """
+    Coalesce two CHANGED events for the same item into one.
+    """
+    merged = dict(old)
+    if 'fields' in new:
+        fields = merged.get('fields')
+        merged['fields'] = _dict_merge(fields, new['fields']) if isinstance(fields, dict) else new['fields']
+    if 'cleared' in new:
+        merged['cleared'] = list(set(merged.get('cleared') or []) | set(new['cleared']))
+    return merged
+
+
+def _dict_merge(old, new):
+    merged = dict(old)
+    for k, v in new.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = _dict_merge(merged[k], v)
+        else:
+            merged[k] = v
+    return merged
+
 
 class Application(object):
 
@@ -55,6 +87,12 @@ class Application(object):
         self.__callbacks = defaultdict(list)
         self.__subscribed = {}
 
+        # Events waiting for a slow client to catch up, see send_event
+        self.__event_queue = OrderedDict()
+        self.__event_seq = 0
+        self.__event_flusher = None
+        self.events_dropped = 0
+
     def register_callback(self, name, method):
         assert name in ('on_message', 'on_close')
         self.__callbacks[name].append(method)
@@ -178,6 +216,8 @@ class Application(object):
                 ))
 
     def subscribe(self, ident, name):
+        if name not in self.__subscribed.values():
+            self.middleware.register_subscription(self, name)
         self.__subscribed[ident] = name
         self._send({
             'msg': 'ready',
@@ -185,29 +225,70 @@ class Application(object):
         })
 
     def unsubscribe(self, ident):
-        self.__subscribed.pop(ident)
+        name = self.__subscribed.pop(ident)
+        if name not in self.__subscribed.values():
+            self.middleware.unregister_subscription(self, name)
 
-    def send_event(self, name, event_type, **kwargs):
-        found = False
-        for i in self.__subscribed.values():
-            if i == name or i == '*':
-                found = True
-                break
-        if not found:
+    def is_subscribed(self, name):
+        return name in self.__subscribed.values()
+
+    def __congested(self):
+        transport = self.request.transport
+        return transport is not None and transport.get_write_buffer_size() > EVENT_HIGH_WATER
+
+    def send_event(self, name, event, text, policy=None):
+        """
+        Send an already serialized event to the client.
+
+        Events are queued while the client is not keeping up. For
+        collections with the "drop" policy events are then dropped and with
+        the "coalesce" policy CHANGED events for the same item are merged.
+        """
+        if not self.__event_queue and not self.__congested():
+            self.response.send_str(text)
+            return
+
+        if policy == 'drop':
+            self.events_dropped += 1
             return
-        event = {
-            'msg': event_type.lower(),
-            'collection': name,
-        }
-        if 'id' in kwargs:
-            event['id'] = kwargs['id']
-        if event_type in ('ADDED', 'CHANGED'):
-            if 'fields' in kwargs:
-                event['fields'] = kwargs['fields']
-        if event_type == 'CHANGED':
-            if 'cleared' in kwargs:
-                event['cleared'] = kwargs['cleared']
-        self._send(event)
+
+        key = None
+        if policy == 'coalesce' and event['msg'] == 'changed':
+            key = (name, event.get('id'))
+            queued = self.__event_queue.get(key)
+            if queued is not None:
+                self.__event_queue[key] = (event_merge(queued[0], event), None)
+                return
+
+        if len(self.__event_queue) >= EVENT_QUEUE_MAXSIZE:
+            if policy is not None:
+                self.events_dropped += 1
+                return
+            self.logger.warn('Client %s is not reading events, closing connection', self.sessionid)
+            self.__event_queue.clear()
+            asyncio.ensure_future(self.response.close())
+            return
+
+        if key is None:
+            key = self.__event_seq
+            self.__event_seq += 1
+        self.__event_queue[key] = (event, text)
+        if self.__event_flusher is None:
+            self.__event_flusher = asyncio.ensure_future(self.__flush_events())
+
+    async def __flush_events(self):
+        try:
+            while self.__event_queue:
+                if self.__congested():
+                    await asyncio.sleep(0.1)
+                    continue
+                event, text = self.__event_queue.popitem(last=False)[1]
+                self.response.send_str(text if text is not None else json.dumps(event))
+        except Exception:
+            self.logger.debug('Failed to send queued events to %s', self.sessionid, exc_info=True)
+            self.__event_queue.clear()
+        finally:
+            self.__event_flusher = None
 
     def on_open(self):
         self.middleware.register_wsclient(self)
@@ -220,6 +301,11 @@ class Application(object):
             except:
                 self.logger.error('Failed to run on_close callback.', exc_info=True)
 
+        for name in set(self.__subscribed.values()):
+            self.middleware.unregister_subscription(self, name)
+        self.__subscribed.clear()
+        self.__event_queue.clear()
+
         self.middleware.unregister_wsclient(self)
 
     async def on_message(self, message):
@@ -319,24 +405,44 @@ class FileApplication(object):
         })
         await resp.prepare(request)
 
-        f = None
+        transport, reader = await self._pipe_reader(job.read_fd)
         try:
-            def read_write():
-                f = os.fdopen(job.read_fd, 'rb')
-                while True:
-                    read = f.read(1024)
-                    if read == b'':
-                        break
-                    resp.write(read)
-                    #await web.drain()
-            await self.middleware.threaded(read_write)
-            await resp.drain()
-
+            while True:
+                data = await reader.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                resp.write(data)
+                await resp.drain()
         finally:
-            if f:
-                f.close()
+            transport.close()
         return resp
 
+    async def _pipe_reader(self, fd):
+        """
+        Wrap the read end of a job pipe in a StreamReader.
+
+        The reader stops reading from the pipe while `2 * STREAM_CHUNK_SIZE`
+        bytes are buffered, so a slow client throttles the job writing to it.
+        """
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader(limit=STREAM_CHUNK_SIZE)
+        transport, protocol = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', buffering=0),
+        )
+        return transport, reader
+
+    async def _pipe_writer(self, fd):
+        """
+        Wrap the write end of a job pipe in a StreamWriter, `drain()` waits
+        while the job is not keeping up reading from it.
+        """
+        loop = asyncio.get_event_loop()
+        transport, protocol = await loop.connect_write_pipe(
+            lambda: asyncio.streams.FlowControlMixin(), os.fdopen(fd, 'wb', buffering=0),
+        )
+        transport.set_write_buffer_limits(high=STREAM_CHUNK_SIZE)
+        return asyncio.StreamWriter(transport, protocol, None, loop)
+
     async def upload(self, request):
 
         denied = True
@@ -364,43 +470,45 @@ class FileApplication(object):
             resp.set_status(401)
             return resp
 
-        form = {}
+        # The file is streamed straight into the job pipe, so the "data" part
+        # with the method to call is expected before the "file" part. A file
+        # sent first is spooled to a temporary file rather than to memory.
+        data = None
+        spool = None
+        job = None
         reader = await request.multipart()
-        while True:
-            part = await reader.next()
-            if part is None:
-                break
-            form[part.name] = await part.read()  # FIXME: handle big files
+        try:
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                if part.name == 'data':
+                    data = await part.read()
+                elif part.name == 'file':
+                    if data is None:
+                        spool = await self._spool(part)
+                        continue
+                    job = await self._upload_job(data)
+                    if job is None:
+                        break
+                    await self._upload_stream(job, self._part_chunks(part))
+                    break
+                else:
+                    await part.release()
 
-        if 'data' not in form or 'file' not in form:
-            resp = web.Response(status=405, reason='Expected data not on payload')
-            resp.set_status(405)
-            return resp
+            if job is None and data is not None and spool is not None:
+                job = await self._upload_job(data)
+                if job is not None:
+                    await self._upload_stream(job, self._spool_chunks(spool))
+        finally:
+            if spool is not None:
+                spool.close()
 
-        try:
-            data = json.loads(form['data'])
-            job = await self.middleware.call(data['method'], *(data.get('params') or []))
-        except Exception:
-            resp = web.Response()
+        if job is None:
+            resp = web.Response(status=405, reason='Expected data not on payload')
             resp.set_status(405)
             return resp
 
-        f = None
-        try:
-            def read_write():
-                f = os.fdopen(job.write_fd, 'wb')
-                i = 0
-                while True:
-                    read = form['file'][i* 1024:(i + 1) * 1024]
-                    if read == b'':
-                        break
-                    f.write(read)
-                    i += 1
-            await self.middleware.threaded(read_write)
-        finally:
-            if f:
-                f.close()
-
         resp = web.Response(
             status=200,
             headers={
@@ -410,6 +518,50 @@ class FileApplication(object):
         )
         return resp
 
+    async def _upload_job(self, data):
+        try:
+            data = json.loads(data)
+            return await self.middleware.call(data['method'], *(data.get('params') or []))
+        except Exception:
+            return None
+
+    async def _upload_stream(self, job, chunks):
+        writer = await self._pipe_writer(job.write_fd)
+        try:
+            async for chunk in chunks:
+                writer.write(chunk)
+                await writer.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # Job stopped reading, e.g. it failed, its state tells why
+            pass
+        finally:
+            writer.close()
+
+    async def _part_chunks(self, part):
+        while True:
+            chunk = await part.read_chunk(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    async def _spool(self, part):
+        spool = tempfile.TemporaryFile()
+        try:
+            async for chunk in self._part_chunks(part):
+                await self.middleware.threaded(spool.write, chunk)
+            await self.middleware.threaded(spool.seek, 0)
+        except Exception:
+            spool.close()
+            raise
+        return spool
+
+    async def _spool_chunks(self, spool):
+        while True:
+            chunk = await self.middleware.threaded(spool.read, STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
 
 class ShellWorkerThread(threading.Thread):
     """
@@ -585,20 +737,32 @@ class ShellApplication(object):
 
 class Middleware(object):
 
-    def __init__(self, loop_monitor=True, plugins_dirs=None, debug_level=None):
+    def __init__(
+        self, loop_monitor=True, plugins_dirs=None, debug_level=None,
+        job_workers=2, job_worker_max_jobs=50, job_worker_max_rss=None,
+    ):
         self.logger = logger.Logger('middlewared', debug_level).getLogger()
         self.crash_reporting = logger.CrashReporting()
         self.loop_monitor = loop_monitor
         self.plugins_dirs = plugins_dirs or []
         self.__loop = None
         self.__thread_id = threading.get_ident()
-        self.__threadpool = concurrent.futures.ThreadPoolExecutor(
-            max_workers=10,
-        )
+        self.__threadpools = {
+            'default': ThreadPool('default', 10),
+        }
         self.jobs = JobsQueue(self)
+        self.job_worker_pool = JobWorkerPool(
+            self, size=job_workers, max_jobs=job_worker_max_jobs, max_rss=job_worker_max_rss,
+        )
         self.__schemas = {}
         self.__services = {}
         self.__wsclients = {}
+        # Index of event name to websocket clients subscribed to it,
+        # "*" holds clients subscribed to every event
+        self.__event_index = defaultdict(dict)
+        self.__event_policies = {
+            'core.get_jobs': 'coalesce',
+        }
         self.__event_subs = defaultdict(list)
         self.__hooks = defaultdict(list)
         self.__server_threads = []
@@ -758,6 +922,13 @@ class Middleware(object):
     def add_service(self, service):
         self.__services[service._config.namespace] = service
 
+        # Services may share a named thread pool, first one to declare it wins
+        pool = service._config.threadpool
+        if pool and pool not in self.__threadpools:
+            self.__threadpools[pool] = ThreadPool(
+                pool, service._config.threadpool_workers, service._config.threadpool_queue,
+            )
+
     def get_service(self, name):
         return self.__services[name]
 
@@ -774,16 +945,24 @@ class Middleware(object):
     def get_schema(self, name):
         return self.__schemas.get(name)
 
-    async def threaded(self, method, *args, **kwargs):
+    def get_threadpools(self):
+        return self.__threadpools
+
+    async def threaded(self, method, *args, pool=None):
         """
         Runs method in a native thread using concurrent.futures.ThreadPool.
         This prevents a CPU intensive or non-greenlet friendly method
         to block the event loop indefinitely.
+
+        `pool` is the name of the thread pool to use. If not given, bound
+        methods of a service run in the pool declared in the service Config
+        and everything else runs in the "default" pool.
         """
-        loop = asyncio.get_event_loop()
-        task = loop.run_in_executor(self.__threadpool, method, *args, **kwargs)
-        await task
-        return task.result()
+        if pool is None:
+            service = getattr(method, '__self__', None)
+            config = getattr(service, '_config', None)
+            pool = getattr(config, 'threadpool', None) or 'default'
+        return await self.__threadpools[pool].run(method, *args)
 
     async def _call(self, name, methodobj, params, app=None):
 
@@ -861,13 +1040,63 @@ class Middleware(object):
         """
         self.__event_subs[name].append(handler)
 
+    def register_subscription(self, app, name):
+        self.__event_index[name][app.sessionid] = app
+
+    def unregister_subscription(self, app, name):
+        subscribers = self.__event_index.get(name)
+        if subscribers is None:
+            return
+        subscribers.pop(app.sessionid, None)
+        if not subscribers:
+            self.__event_index.pop(name)
+
+    def register_event_policy(self, name, policy):
+        """
+        Set what to do with events of `name` for clients not keeping up:
+          - drop: discard new events
+          - coalesce: merge CHANGED events of the same item
+        """
+        assert policy in ('drop', 'coalesce')
+        self.__event_policies[name] = policy
+
+    def has_subscribers(self, name):
+        """
+        Whether any websocket client explicitly subscribed to `name`,
+        so event sources can avoid doing work nobody will receive.
+        """
+        return name in self.__event_index
+
     def send_event(self, name, event_type, **kwargs):
         assert event_type in ('ADDED', 'CHANGED', 'REMOVED')
-        for sessionid, wsclient in self.__wsclients.items():
-            try:
-                wsclient.send_event(name, event_type, **kwargs)
-            except:
-                self.logger.warn('Failed to send event {} to {}'.format(name, sessionid), exc_info=True)
+
+        subscribers = self.__event_index.get(name, {})
+        wildcard = self.__event_index.get('*', {})
+        clients = list(subscribers.values()) + [
+            client for sessionid, client in wildcard.items() if sessionid not in subscribers
+        ]
+        if clients:
+            event = {
+                'msg': event_type.lower(),
+                'collection': name,
+            }
+            if 'id' in kwargs:
+                event['id'] = kwargs['id']
+            if event_type in ('ADDED', 'CHANGED'):
+                if 'fields' in kwargs:
+                    event['fields'] = kwargs['fields']
+            if event_type == 'CHANGED':
+                if 'cleared' in kwargs:
+                    event['cleared'] = kwargs['cleared']
+            # Serialize only once for all subscribers
+            text = json.dumps(event)
+            policy = self.__event_policies.get(name)
+
+            for client in clients:
+                try:
+                    client.send_event(name, event, text, policy)
+                except:
+                    self.logger.warn('Failed to send event {} to {}'.format(name, client.sessionid), exc_info=True)
 
         # Send event also for internally subscribed plugins
         for handler in self.__event_subs.get(name, []):
@@ -950,6 +1179,8 @@ class Middleware(object):
             asyncio.ensure_future(restful_api.register_resources())
         )
         asyncio.ensure_future(self.jobs.run())
+        # Workers connect back to us, they will retry until we accept connections
+        asyncio.ensure_future(self.job_worker_pool.start())
 
         self.__setup_periodic_tasks()
 
@@ -976,6 +1207,8 @@ class Middleware(object):
             if hasattr(service, "terminate"):
                 await service.terminate()
 
+        await self.job_worker_pool.terminate()
+
         self.__loop.stop()
 
 
@@ -993,6 +1226,12 @@ def main():
     parser.add_argument('--foreground', '-f', action='store_true')
     parser.add_argument('--disable-loop-monitor', '-L', action='store_true')
     parser.add_argument('--plugins-dirs', '-p', action='append')
+    parser.add_argument('--job-workers', type=int, default=2,
+                        help='Number of pre-forked workers for process jobs (0 disables the pool)')
+    parser.add_argument('--job-worker-max-jobs', type=int, default=50,
+                        help='Recycle a job worker after this many jobs')
+    parser.add_argument('--job-worker-max-rss', type=int,
+                        help='Recycle a job worker once its RSS exceeds this many MiB')
     parser.add_argument('--debug-level', choices=[
         'TRACE',
         'DEBUG',
@@ -1054,6 +1293,9 @@ def main():
         loop_monitor=not args.disable_loop_monitor,
         plugins_dirs=args.plugins_dirs,
         debug_level=debug_level,
+        job_workers=args.job_workers,
+        job_worker_max_jobs=args.job_worker_max_jobs,
+        job_worker_max_rss=args.job_worker_max_rss * 1024 * 1024 if args.job_worker_max_rss else None,
     ).run()
     if not args.foreground:
         daemonc.close()
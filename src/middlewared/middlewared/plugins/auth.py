@@ -1,23 +1,63 @@
+from collections import OrderedDict
 import crypt
+import hashlib
+import heapq
+import hmac
+import os
 import subprocess
 import time
 import uuid
 
 from middlewared.schema import Dict, Int, Str, accepts
-from middlewared.service import Service, no_auth_required, pass_app, private
+from middlewared.service import Service, no_auth_required, pass_app, periodic, private
 from middlewared.utils import Popen
 
+# Seconds a verified username/password is remembered
+CHECK_USER_CACHE_TTL = 60
+CHECK_USER_CACHE_SIZE = 64
+# Tokens kept before least recently used ones are evicted
+AUTH_TOKENS_MAX = 10000
+
 
 class AuthTokens(object):
+    """
+    Tokens expire `ttl` seconds after they were last used.
+
+    Expiry times are kept in a heap so expired tokens are swept without
+    looking at every token. Using a token pushes its new expiry time and
+    outdated heap entries are skipped when popped. Past `max_tokens` the
+    least recently used tokens are evicted.
+    """
 
-    def __init__(self):
+    def __init__(self, max_tokens=AUTH_TOKENS_MAX):
         # Keep two indexes, one by token id and one by session id
-        self.__tokens = {}
+        # Tokens are kept ordered from least to most recently used
+        self.__tokens = OrderedDict()
         self.__sessionid_map = {}
+        # Heap of (expire time, token id)
+        self.__expiry = []
+        self.max_tokens = max_tokens
+        self.__stats = {
+            'created': 0,
+            'expired': 0,
+            'evicted': 0,
+        }
 
     def get_token(self, token_id):
-        # Get token entry from token id
-        return self.__tokens.get(token_id)
+        # Get valid token entry from token id, extending its life
+        token = self.__tokens.get(token_id)
+        if token is None:
+            return None
+        now = int(time.time())
+        if token['last'] + token['ttl'] <= now:
+            self.__remove(token_id)
+            self.__stats['expired'] += 1
+            return None
+        self.__tokens.move_to_end(token_id)
+        if token['last'] != now:
+            token['last'] = now
+            self.__push(token)
+        return token
 
     def get_token_by_sessionid(self, sessionid):
         # Get token from session id
@@ -28,6 +68,7 @@ class AuthTokens(object):
 
     def new(self, ttl, attrs=None):
         # Create a new token with given Time To Live
+        self.sweep()
         token_id = str(uuid.uuid4())
         token = self.__tokens[token_id] = {
             'id': token_id,
@@ -37,6 +78,11 @@ class AuthTokens(object):
             'sessions': set(),
             'attributes': attrs or {},
         }
+        self.__push(token)
+        self.__stats['created'] += 1
+        while len(self.__tokens) > self.max_tokens:
+            self.__remove(next(iter(self.__tokens)))
+            self.__stats['evicted'] += 1
         return token
 
     def add_session(self, sessionid, token):
@@ -46,10 +92,10 @@ class AuthTokens(object):
 
     def remove_session(self, sessionid):
         # Remove a session id from index and token object
-        token_id = self.__sessionid_map.get(sessionid)
+        token_id = self.__sessionid_map.pop(sessionid, None)
         if not token_id:
             return
-        token = self.get_token(token_id)
+        token = self.__tokens.get(token_id)
         if not token:
             return
         if sessionid in token['sessions']:
@@ -57,16 +103,84 @@ class AuthTokens(object):
 
     def pop_token(self, token_id):
         # Remove a token from both indexes
+        if token_id in self.__tokens:
+            self.__remove(token_id)
+
+    def sweep(self):
+        """
+        Remove expired tokens, returning how many were removed.
+        """
+        now = int(time.time())
+        removed = 0
+        while self.__expiry and self.__expiry[0][0] <= now:
+            expires, token_id = heapq.heappop(self.__expiry)
+            token = self.__tokens.get(token_id)
+            # Skip outdated entries of tokens used since then
+            if token is not None and token['last'] + token['ttl'] <= now:
+                self.__remove(token_id)
+                removed += 1
+        self.__stats['expired'] += removed
+        return removed
+
+    def stats(self):
+        return dict(self.__stats, tokens=len(self.__tokens), sessions=len(self.__sessionid_map))
+
+    def __push(self, token):
+        heapq.heappush(self.__expiry, (token['last'] + token['ttl'], token['id']))
+        # Rebuild the heap once most of its entries are outdated
+        if len(self.__expiry) > 2 * len(self.__tokens) + 64:
+            self.__expiry = [(t['last'] + t['ttl'], t['id']) for t in self.__tokens.values()]
+            heapq.heapify(self.__expiry)
+
+    def __remove(self, token_id):
         token = self.__tokens.pop(token_id)
         for sessionid in token['sessions']:
             self.__sessionid_map.pop(sessionid, None)
 
 
+class CheckUserCache(object):
+    """
+    Credentials recently verified, so clients sending username and
+    password on every request (e.g. REST) do not pay for crypt each time.
+
+    Entries are keyed by a keyed digest of the credentials, so passwords
+    are never kept in memory, and hold the password hash they were
+    verified against: they stop matching once the password is changed.
+    """
+
+    def __init__(self, ttl=CHECK_USER_CACHE_TTL, size=CHECK_USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.key = os.urandom(32)
+        self.entries = OrderedDict()
+
+    def __digest(self, username, password):
+        return hmac.new(self.key, f'{username}\0{password}'.encode('utf8'), hashlib.sha256).digest()
+
+    def verified(self, username, password, unixhash):
+        digest = self.__digest(username, password)
+        entry = self.entries.get(digest)
+        if entry is None:
+            return False
+        if entry[0] != unixhash or entry[1] < time.monotonic():
+            self.entries.pop(digest)
+            return False
+        return True
+
+    def add(self, username, password, unixhash):
+        digest = self.__digest(username, password)
+        self.entries.pop(digest, None)
+        self.entries[digest] = (unixhash, time.monotonic() + self.ttl)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
 class AuthService(Service):
 
     def __init__(self, *args, **kwargs):
         super(AuthService, self).__init__(*args, **kwargs)
         self.authtokens = AuthTokens()
+        self.check_user_cache = CheckUserCache()
 
     @accepts(Str('username'), Str('password'))
     async def check_user(self, username, password):
@@ -79,21 +193,50 @@ class AuthService(Service):
             user = await self.middleware.call('datastore.query', 'account.bsdusers', [('bsdusr_username', '=', username)], {'get': True})
         except IndexError:
             return False
-        if user['bsdusr_unixhash'] in ('x', '*'):
+        unixhash = user['bsdusr_unixhash']
+        if unixhash in ('x', '*'):
             return False
-        return crypt.crypt(password, user['bsdusr_unixhash']) == user['bsdusr_unixhash']
+        if self.check_user_cache.verified(username, password, unixhash):
+            return True
+        # Key stretching takes a while, keep it off the event loop
+        if await self.middleware.threaded(crypt.crypt, password, unixhash) != unixhash:
+            return False
+        self.check_user_cache.add(username, password, unixhash)
+        return True
 
     @accepts(Int('ttl', required=False), Dict('attrs', additional_attrs=True))
-    def generate_token(self, ttl=None, attrs=None):
+    async def generate_token(self, ttl=None, attrs=None):
         """Generate a token to be used for authentication."""
         if ttl is None:
             ttl = 600
         return self.authtokens.new(ttl, attrs=attrs)['id']
 
     @private
-    def get_token(self, token_id):
+    async def get_token(self, token_id):
         return self.authtokens.get_token(token_id)
 
+    @private
+    async def check_token(self, token_id):
+        """
+        Check whether token `token_id` exists and is still valid (TTL),
+        refreshing its last use time.
+        """
+        return self.authtokens.get_token(token_id) is not None
+
+    @accepts()
+    async def token_stats(self):
+        """
+        Get number of tokens and sessions using them along with counters
+        of created, expired and evicted tokens.
+        """
+        return self.authtokens.stats()
+
+    @private
+    @periodic(60)
+    async def sweep_tokens(self):
+        # Tokens are only handled in the event loop, no locking needed
+        self.authtokens.sweep()
+
     @no_auth_required
     @accepts(Str('username'), Str('password'))
     @pass_app
@@ -109,7 +252,7 @@ class AuthService(Service):
     @no_auth_required
     @accepts(Str('token'))
     @pass_app
-    def token(self, app, token):
+    async def token(self, app, token):
         """Authenticate using a given `token` id."""
 
         def update_token(app, message):
@@ -118,13 +261,7 @@ class AuthService(Service):
             make sure the token is still valid, updating last time or
             removing authentication
             """
-            token = self.authtokens.get_token_by_sessionid(app.sessionid)
-            if token is None:
-                return
-            if int(time.time()) - token['ttl'] < token['last']:
-                token['last'] = int(time.time())
-            else:
-                self.authtokens.pop_token(token['id'])
+            if self.authtokens.get_token_by_sessionid(app.sessionid) is None:
                 app.authenticated = False
 
         def remove_session(app):
@@ -143,16 +280,11 @@ class AuthService(Service):
           - add the session id to token
           - register connection callbacks to update/remove token
         """
-        if int(time.time()) - token['ttl'] < token['last']:
-            token['last'] = int(time.time())
-            self.authtokens.add_session(app.sessionid, token)
-            app.register_callback('on_message', update_token)
-            app.register_callback('on_close', remove_session)
-            app.authenticated = True
-            return True
-        else:
-            self.authtokens.pop_token(token['id'])
-            return False
+        self.authtokens.add_session(app.sessionid, token)
+        app.register_callback('on_message', update_token)
+        app.register_callback('on_close', remove_session)
+        app.authenticated = True
+        return True
 
 
 async def check_permission(app):
@@ -0,0 +1,259 @@
+from datetime import datetime, timedelta
+
+import asyncio
+import os
+import subprocess
+import sys
+
+import libzfs
+
+from middlewared.service import Service
+from middlewared.snapshot_schedule import (
+    AutoSnapshotIndex, due_snapshots, expire_match, is_matching_time, snap_time,
+)
+from middlewared.utils import Popen, run
+
+if '/usr/local/www' not in sys.path:
+    sys.path.append('/usr/local/www')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
+
+import django
+from django.apps import apps
+if not apps.ready:
+    django.setup()
+
+from freenasUI.common.locks import mntlock
+from freenasUI.freeadmin.apppool import appPool
+
+# Rebuild the index from scratch every now and then to catch up with
+# snapshots created or destroyed behind our back.
+INDEX_REBUILD_INTERVAL = 3600
+# Maximum number of snapshots destroyed by a single `zfs destroy`
+DESTROY_BATCH = 256
+
+AUTOREPL = '/usr/local/www/freenasUI/tools/autorepl.py'
+AUTOREPL_PID = '/var/run/autorepl.pid'
+
+
+def autorepl_running():
+    try:
+        with open(AUTOREPL_PID, 'r') as f:
+            pid = f.read().strip('\n')
+    except OSError:
+        return False
+    if not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+        return True
+    except OSError:
+        return False
+
+
+class AutoSnapshotService(Service):
+
+    class Config:
+        namespace = 'autosnap'
+        private = True
+
+    def __init__(self, *args, **kwargs):
+        super(AutoSnapshotService, self).__init__(*args, **kwargs)
+        self.__index = None
+        self.__lock = asyncio.Lock()
+
+    async def rescan(self):
+        """
+        Rebuild the automatic snapshots index.
+        """
+        cp = await run(
+            '/sbin/zfs', 'list', '-H', '-t', 'filesystem,volume,snapshot', '-o', 'name', check=False,
+        )
+        if cp.returncode != 0:
+            self.logger.warn('Failed to list snapshots: %s', cp.stderr.decode(errors='ignore'))
+            self.__index = None
+            return
+        self.__index = await self.middleware.threaded(AutoSnapshotIndex, cp.stdout.decode().split('\n'))
+
+    async def index_stats(self):
+        if self.__index is None:
+            return None
+        return self.__index.stats()
+
+    def imported_pools(self):
+        return {pool.name for pool in libzfs.ZFS().pools}
+
+    def take(self, snapshots):
+        # Runs in the default pool, create_batch itself runs in the zfs one
+        # and waiting on it from there would hold two of its workers.
+        with mntlock():
+            return self.middleware.call_sync('zfs.snapshot.create_batch', snapshots)
+
+    def destroy(self, pending):
+        """
+        Destroy expired snapshots, every `zfs destroy` removing a batch of
+        snapshots of a dataset and its children in a single transaction.
+
+        Snapshots with clones will have their destruction deferred.
+        """
+        destroyed = {}
+        with mntlock():
+            if autorepl_running():
+                self.logger.debug('Autorepl running, skip destroying snapshots')
+                return destroyed, True
+            ok = True
+            for dataset, snapnames in pending.items():
+                for i in range(0, len(snapnames), DESTROY_BATCH):
+                    batch = snapnames[i:i + DESTROY_BATCH]
+                    proc = subprocess.Popen(
+                        ['/sbin/zfs', 'destroy', '-r', '-d', f'{dataset}@{",".join(batch)}'],
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8',
+                    )
+                    err = proc.communicate()[1]
+                    if proc.returncode != 0:
+                        self.logger.error('Failed to destroy snapshots of %s: %s', dataset, err)
+                        ok = False
+                        continue
+                    destroyed.setdefault(dataset, []).extend(batch)
+        return destroyed, ok
+
+    async def __snapshot(self, due, snaptime):
+        snapname = f'auto-{snaptime.strftime("%Y%m%d.%H%M")}'
+        snapshots = []
+        vmcontexts = []
+        for dataset, retention, recursive in due:
+            name = f'{snapname}-{retention}'
+            # Take VMware snapshots first so the ZFS snapshot holds consistent VMs
+            try:
+                vmcontext = await self.middleware.call(
+                    'vmware.snapshot_begin', dataset, f'{dataset}@{name}', recursive,
+                )
+            except Exception:
+                self.logger.warn('Failed to snapshot VMware VMs for %s@%s', dataset, name, exc_info=True)
+                vmcontext = None
+            if vmcontext:
+                vmcontexts.append(vmcontext)
+            snapshots.append({
+                'dataset': dataset,
+                'name': name,
+                'recursive': recursive,
+                'vmsynced': bool(vmcontext and vmcontext['vmsynced']),
+            })
+
+        # All snapshots of this run go in a single batch so the ones that
+        # share pool and flags land in the same transaction group.
+        results = await self.middleware.threaded(self.take, snapshots)
+
+        try:
+            for snapshot, result in zip(snapshots, results):
+                if result['success']:
+                    if snapshot['recursive']:
+                        self.__index.add_recursive(snapshot['dataset'], snapshot['name'])
+                    else:
+                        self.__index.add(snapshot['dataset'], snapshot['name'])
+                    continue
+                fullname = f'{snapshot["dataset"]}@{snapshot["name"]}'
+                self.logger.error('Failed to create snapshot %r: %s', fullname, result['error'])
+                try:
+                    await self.middleware.call('mail.send', {
+                        'subject': f'Snapshot failed! ({fullname})',
+                        'text': f'\nHello,\n    Snapshot {fullname} failed with the following error: {result["error"]}',
+                        'interval': 3600,
+                        'channel': 'autosnap',
+                    })
+                except Exception:
+                    self.logger.warn('Failed to send snapshot failure email', exc_info=True)
+        finally:
+            # VMware snapshots impact the VMs performance, always remove them
+            for vmcontext in vmcontexts:
+                try:
+                    await self.middleware.call('vmware.snapshot_end', vmcontext)
+                except Exception:
+                    self.logger.warn('Failed to remove VMware snapshots', exc_info=True)
+
+    async def run(self, now=None):
+        """
+        Take the automatic snapshots due at `now` and destroy expired ones.
+        """
+        async with self.__lock:
+            # Same extension point the autosnap tool offered, plugins may
+            # adjust things before a run or veto it by raising.
+            try:
+                await self.middleware.threaded(appPool.hook_tool_run, 'autosnap')
+            except Exception:
+                self.logger.warn('autosnap tool run hook failed, skipping this run', exc_info=True)
+                return
+            await self.__run(now or datetime.now())
+
+    async def __run(self, now):
+        snaptime = snap_time(now)
+
+        tasks = await self.middleware.call('datastore.query', 'storage.task', [('task_enabled', '=', True)])
+        tasks = [t for t in tasks if is_matching_time(t, snaptime)]
+        if tasks:
+            pools = await self.middleware.threaded(self.imported_pools, pool='zfs')
+            for task in list(tasks):
+                if task['task_filesystem'].split('/')[0] not in pools:
+                    self.logger.warn(
+                        'Volume %s not imported, skipping snapshot task #%d',
+                        task['task_filesystem'].split('/')[0], task['id'],
+                    )
+                    tasks.remove(task)
+
+        # Only proceed further if we are going to generate any snapshots
+        if not tasks:
+            return
+
+        if self.__index is None or datetime.now() - self.__index.built > timedelta(seconds=INDEX_REBUILD_INTERVAL):
+            await self.rescan()
+            if self.__index is None:
+                return
+
+        due = due_snapshots(tasks, self.__index, snaptime)
+        if due:
+            await self.__snapshot(due, snaptime)
+
+        # Only destroy snapshots of datasets matching an enabled task
+        pending = self.__index.expired(snaptime, expire_match(tasks))
+        if pending:
+            destroyed, ok = await self.middleware.threaded(self.destroy, pending, pool='zfs')
+            for dataset, snapnames in destroyed.items():
+                self.__index.discard_recursive(dataset, snapnames)
+            if not ok:
+                # Index is out of sync with what is on disk, start over
+                self.__index = None
+
+    async def autorepl(self, now=None):
+        """
+        Start replication every minute while there are periodic snapshot
+        tasks, weekly otherwise.
+        """
+        now = now or datetime.now()
+        if not (now.weekday() == 5 and now.hour == 4 and now.minute == 15) and not await self.middleware.call(
+            'datastore.query', 'storage.task', [('task_enabled', '=', True)], {'count': True},
+        ):
+            return
+        if await self.middleware.call('datastore.query', 'storage.replication', None, {'count': True}):
+            proc = await Popen(
+                ['/usr/local/bin/python', AUTOREPL],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=True,
+            )
+            asyncio.ensure_future(proc.wait())
+
+
+async def autosnap_loop(middleware):
+    while True:
+        # Wake up at the beginning of every minute
+        now = datetime.now()
+        await asyncio.sleep(60 - now.second - now.microsecond / 1000000)
+        try:
+            await middleware.call('autosnap.run')
+        except Exception:
+            middleware.logger.error('Automatic snapshots failed', exc_info=True)
+        try:
+            await middleware.call('autosnap.autorepl')
+        except Exception:
+            middleware.logger.error('Failed to start replication', exc_info=True)
+
+
+def setup(middleware):
+    asyncio.ensure_future(autosnap_loop(middleware))
@@ -1,43 +1,184 @@
-from middlewared.schema import Any, Str, accepts
-from middlewared.service import Service
+from collections import OrderedDict
+import asyncio
+import time
+
+from middlewared.client import ejson as json
+from middlewared.schema import Any, Int, List, Str, accepts
+from middlewared.service import Service, periodic, private
+
+
+class CacheEntry(object):
+
+    __slots__ = ('value', 'expires', 'size')
+
+    def __init__(self, value, ttl, size):
+        self.value = value
+        self.expires = time.monotonic() + ttl if ttl else None
+        self.size = size
+
+    def expired(self, now=None):
+        return self.expires is not None and (now or time.monotonic()) >= self.expires
 
 
 class CacheService(Service):
 
     class Config:
         private = True
+        # Approximate budget (size of values serialized as JSON) before
+        # least recently used entries start to be evicted.
+        max_memory = 32 * 1024 * 1024
 
     def __init__(self, *args, **kwargs):
         super(CacheService, self).__init__(*args, **kwargs)
-        self.__cache = {}
+        self.__cache = OrderedDict()
+        self.__memory = 0
+        self.__pending = {}
+        self.__stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+        }
+
+    def __lookup(self, key):
+        entry = self.__cache.get(key)
+        if entry is None:
+            return None
+        if entry.expired():
+            self.__stats['expirations'] += 1
+            self.__remove(key)
+            return None
+        # Mark as most recently used
+        self.__cache.move_to_end(key)
+        return entry
+
+    def __remove(self, key):
+        entry = self.__cache.pop(key)
+        self.__memory -= entry.size
+        return entry
+
+    def __store(self, key, value, ttl):
+        try:
+            size = len(json.dumps(value))
+        except TypeError:
+            size = 0
+        if key in self.__cache:
+            self.__remove(key)
+        self.__cache[key] = CacheEntry(value, ttl, size)
+        self.__memory += size
+
+        while self.__memory > self._config.max_memory and len(self.__cache) > 1:
+            oldest = next(iter(self.__cache))
+            self.__stats['evictions'] += 1
+            self.__remove(oldest)
 
     @accepts(Str('key'))
-    def has_key(self, key):
+    async def has_key(self, key):
         """
         Check if given `key` is in cache.
         """
-        return key in self.__cache
+        return self.__lookup(key) is not None
 
     @accepts(Str('key'))
-    def get(self, key):
+    async def get(self, key):
         """
         Get `key` from cache.
 
         Raises:
             KeyError: not found in the cache
         """
-        return self.__cache[key]
+        entry = self.__lookup(key)
+        if entry is None:
+            self.__stats['misses'] += 1
+            raise KeyError(key)
+        self.__stats['hits'] += 1
+        return entry.value
 
-    @accepts(Str('key'), Any('value'))
-    def put(self, key, value):
+    @accepts(Str('key'), Any('value'), Int('ttl'))
+    async def put(self, key, value, ttl=None):
         """
         Put `key` of `value` in the cache.
+
+        `ttl` is the time in seconds after which the key expires,
+        it never expires if not set.
         """
-        self.__cache[key] = value
+        self.__store(key, value, ttl)
 
     @accepts(Str('key'))
-    def pop(self, key):
+    async def pop(self, key):
         """
         Removes and returns `key` from cache.
         """
-        return self.__cache.pop(key, None)
+        entry = self.__lookup(key)
+        if entry is None:
+            return None
+        return self.__remove(key).value
+
+    @accepts(Str('key'), Str('method'), List('args'), Int('ttl'))
+    async def get_or_set(self, key, method, args, ttl=None):
+        """
+        Get `key` from cache or set it to the result of calling `method`
+        with `args`.
+
+        Concurrent calls for the same key wait for the same method call
+        instead of calling it again.
+        """
+        entry = self.__lookup(key)
+        if entry is not None:
+            self.__stats['hits'] += 1
+            return entry.value
+
+        self.__stats['misses'] += 1
+        pending = self.__pending.get(key)
+        if pending is None:
+            pending = self.__pending[key] = asyncio.ensure_future(self.middleware.call(method, *args))
+            try:
+                value = await asyncio.shield(pending)
+            finally:
+                invalidated = self.__pending.get(key) is not pending
+                if not invalidated:
+                    self.__pending.pop(key)
+            # Do not store a value computed before the key was invalidated
+            if not invalidated:
+                self.__store(key, value, ttl)
+            return value
+        return await asyncio.shield(pending)
+
+    @accepts(Str('namespace'))
+    async def invalidate(self, namespace):
+        """
+        Remove every key under `namespace`, e.g. "disk" removes "disk" and
+        all "disk.*" keys.
+
+        Returns the number of keys removed.
+        """
+        prefix = f'{namespace}.'
+        keys = [k for k in self.__cache if k == namespace or k.startswith(prefix)]
+        for key in keys:
+            self.__remove(key)
+        for key in [k for k in self.__pending if k == namespace or k.startswith(prefix)]:
+            self.__pending.pop(key)
+        self.__stats['invalidations'] += len(keys)
+        return len(keys)
+
+    @accepts()
+    async def stats(self):
+        """
+        Get cache counters, number of keys and memory used.
+        """
+        return dict(
+            self.__stats,
+            keys=len(self.__cache),
+            memory=self.__memory,
+            max_memory=self._config.max_memory,
+        )
+
+    @private
+    @periodic(60)
+    async def expire(self):
+        now = time.monotonic()
+        keys = [k for k, v in self.__cache.items() if v.expired(now)]
+        for key in keys:
+            self.__remove(key)
+        self.__stats['expirations'] += len(keys)
@@ -1,6 +1,7 @@
 from middlewared.service import Service, private
 from middlewared.schema import accepts, Any, Bool, Dict, Int, List, Ref, Str
 
+from collections import defaultdict
 import os
 import sys
 
@@ -13,7 +14,7 @@ if not apps.ready:
     django.setup()
 
 from django.apps import apps
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
 from django.db.models.fields.related import ForeignKey
 
@@ -23,11 +24,19 @@ from django.db.models.fields.related import ForeignKey
 from freenasUI.freeadmin.sqlite3_ha import base as sqlite3_ha_base
 sqlite3_ha_base.execute_sync = True
 
-from middlewared.utils import django_modelobj_serialize
+from middlewared.utils import django_modelobj_to_dict, filter_list
 
 
 class DatastoreService(Service):
 
+    class Config:
+        threadpool = 'datastore'
+        threadpool_workers = 4
+
+    def __init__(self, *args, **kwargs):
+        super(DatastoreService, self).__init__(*args, **kwargs)
+        self.__select_related = {}
+
     def _filters_to_queryset(self, filters, field_prefix=None):
         opmap = {
             '=': 'exact',
@@ -79,10 +88,38 @@ class DatastoreService(Service):
         app, model = name.split('.', 1)
         return apps.get_model(app, model)
 
-    async def __queryset_serialize(self, qs, extend=None, field_prefix=None):
-        result = await self.middleware.threaded(lambda: list(qs))
-        for i in result:
-            yield await django_modelobj_serialize(self.middleware, i, extend=extend, field_prefix=field_prefix)
+    def __get_select_related(self, model, prefix='', seen=None):
+        """
+        Get the `select_related` lookups of every foreign key reachable
+        from `model` so a query fetches related rows in a single JOIN.
+        """
+        if not prefix and model in self.__select_related:
+            return self.__select_related[model]
+
+        seen = (seen or set()) | {model}
+        related = []
+        for field in model._meta.fields:
+            if not isinstance(field, ForeignKey):
+                continue
+            lookup = prefix + field.name
+            related.append(lookup)
+            # Stop on cycles, those will be resolved by attribute access
+            if field.rel.model not in seen:
+                related.extend(self.__get_select_related(field.rel.model, lookup + '__', seen))
+
+        if not prefix:
+            self.__select_related[model] = related
+        return related
+
+    async def __queryset_serialize(self, qs, extend=None, extend_list=None, field_prefix=None):
+        result = await self.middleware.threaded(
+            lambda: [django_modelobj_to_dict(i, field_prefix) for i in qs], pool='datastore',
+        )
+        if extend:
+            result = [await self.middleware.call(extend, i) for i in result]
+        if extend_list:
+            result = await self.middleware.call(extend_list, result)
+        return result
 
     @accepts(
         Str('name'),
@@ -90,11 +127,15 @@ class DatastoreService(Service):
         Dict(
             'query-options',
             Str('extend'),
+            Str('extend_list'),
             Dict('extra', additional_attrs=True),
             List('order_by'),
             Bool('count'),
             Bool('get'),
             Str('prefix'),
+            Int('limit'),
+            Int('offset'),
+            List('select'),
             register=True,
         ),
     )
@@ -116,6 +157,12 @@ class DatastoreService(Service):
 
         `[ ['username', '=', 'root' ] ]`
 
+        `extend` is the name of a method called for every entry to extend it,
+        `extend_list` is called only once with the list of all entries.
+
+        `options` may also paginate results with `limit` and `offset` and
+        return only some attributes of each entry with `select`.
+
         .. examples(websocket)::
 
           Querying for username "root" and returning a single item:
@@ -138,6 +185,10 @@ class DatastoreService(Service):
 
         qs = model.objects.all()
 
+        select_related = self.__get_select_related(model)
+        if select_related:
+            qs = qs.select_related(*select_related)
+
         extra = options.get('extra')
         if extra:
             qs = qs.extra(**extra)
@@ -162,11 +213,18 @@ class DatastoreService(Service):
         if options.get('count') is True:
             return qs.count()
 
-        result = []
-        async for i in self.__queryset_serialize(
-            qs, extend=options.get('extend'), field_prefix=options.get('prefix')
-        ):
-            result.append(i)
+        offset = options.get('offset') or 0
+        limit = options.get('limit')
+        if offset or limit:
+            qs = qs[offset:offset + limit if limit else None]
+
+        result = await self.__queryset_serialize(
+            qs, extend=options.get('extend'), extend_list=options.get('extend_list'),
+            field_prefix=options.get('prefix'),
+        )
+
+        if options.get('select'):
+            result = filter_list(result, options={'select': options['select']})
 
         if options.get('get') is True:
             return result[0]
@@ -208,7 +266,7 @@ class DatastoreService(Service):
                 k_new = f'{prefix}{k}'
                 data[k_new] = data.pop(k)
         obj = model(**data)
-        await self.middleware.threaded(obj.save)
+        await self.middleware.threaded(obj.save, pool='datastore')
         return obj.pk
 
     @accepts(Str('name'), Any('id'), Dict('data', additional_attrs=True), Dict('options', Str('prefix')))
@@ -220,7 +278,7 @@ class DatastoreService(Service):
         options = options or {}
         prefix = options.get('prefix')
         model = self.__get_model(name)
-        obj = await self.middleware.threaded(lambda oid: model.objects.get(pk=oid), id)
+        obj = await self.middleware.threaded(lambda oid: model.objects.get(pk=oid), id, pool='datastore')
         for field in model._meta.fields:
             if prefix:
                 name = field.name.replace(prefix, '')
@@ -234,16 +292,84 @@ class DatastoreService(Service):
             if prefix:
                 k = f'{prefix}{k}'
             setattr(obj, k, v)
-        await self.middleware.threaded(obj.save)
+        await self.middleware.threaded(obj.save, pool='datastore')
         return obj.pk
 
+    @private
+    @accepts(
+        Str('name'),
+        Dict(
+            'changes',
+            List('insert'),
+            List('update'),
+            List('delete'),
+        ),
+        Dict('options', Str('prefix')),
+    )
+    def bulk(self, name, changes, options=None):
+        """
+        Insert, update and delete many entries of `name` in one transaction.
+
+        `insert` and `update` are lists of entries, updated entries are
+        matched by primary key and only the fields present are written.
+        Foreign keys are given by id. Updates sharing the same fields are
+        written with a single `executemany`.
+        """
+        options = options or {}
+        prefix = options.get('prefix') or ''
+        model = self.__get_model(name)
+        pk = model._meta.pk
+
+        def fields(data):
+            rv = []
+            for k, v in data.items():
+                field = model._meta.get_field(f'{prefix}{k}')
+                rv.append((field, v))
+            return rv
+
+        updates = defaultdict(list)
+        for data in changes.get('update') or []:
+            data = fields(data)
+            pk_value = [v for f, v in data if f.primary_key]
+            data = [(f, v) for f, v in data if not f.primary_key]
+            if len(pk_value) != 1 or not data:
+                continue
+            key = tuple(f.column for f, v in data)
+            updates[key].append(
+                [f.get_db_prep_save(v, connection) for f, v in data] +
+                [pk.get_db_prep_save(pk_value[0], connection)]
+            )
+
+        with transaction.atomic():
+            inserts = [
+                model(**{f.attname: v for f, v in fields(data)})
+                for data in changes.get('insert') or []
+            ]
+            if inserts:
+                model.objects.bulk_create(inserts)
+            with connection.cursor() as cursor:
+                for columns, params in updates.items():
+                    cursor.executemany(
+                        'UPDATE {} SET {} WHERE {} = %s'.format(
+                            model._meta.db_table,
+                            ', '.join(f'{column} = %s' for column in columns),
+                            pk.column,
+                        ),
+                        params,
+                    )
+            # Deleted one by one so models can clean up related entries
+            for obj in model.objects.filter(pk__in=changes.get('delete') or []):
+                obj.delete()
+
+        return [obj.pk for obj in inserts]
+
     @accepts(Str('name'), Any('id'))
     async def delete(self, name, id):
         """
         Delete an entry `id` in `name`.
         """
         model = self.__get_model(name)
-        await self.middleware.threaded(lambda oid: model.objects.get(pk=oid).delete(), id)
+        await self.middleware.threaded(lambda oid: model.objects.get(pk=oid).delete(), id, pool='datastore')
         return True
 
     @private
@@ -10,6 +10,7 @@ import sys
 import sysctl
 
 from bsd import geom
+from middlewared.geom_index import get_geom_index, invalidate_geom_index
 from middlewared.schema import accepts, Str
 from middlewared.service import filterable, job, private, CallError, CRUDService
 from middlewared.utils import Popen, run
@@ -22,6 +23,8 @@ from freenasUI.services.utils import SmartAlert
 
 DISK_EXPIRECACHE_DAYS = 7
 MIRROR_MAX = 5
+# Disks probed (e.g. smartctl) at the same time while syncing
+SYNC_CONCURRENCY = 8
 RE_DA = re.compile('^da[0-9]+$')
 RE_DD = re.compile(r'^(\d+) bytes transferred .*\((\d+) bytes')
 RE_DSKNAME = re.compile(r'^([a-z]+)([0-9]+)$')
@@ -31,6 +34,11 @@ RE_MPATH_NAME = re.compile(r'[a-z]+(\d+)')
 
 class DiskService(CRUDService):
 
+    class Config:
+        threadpool = 'disk'
+        threadpool_workers = 8
+        threadpool_queue = 64
+
     @filterable
     async def query(self, filters=None, options=None):
         if filters is None:
@@ -39,13 +47,14 @@ class DiskService(CRUDService):
             options = {}
         options['prefix'] = 'disk_'
         filters.append(('expiretime', '=', None))
-        options['extend'] = 'disk.disk_extend'
+        options['extend_list'] = 'disk.disk_extend'
         return await self.middleware.call('datastore.query', 'storage.disk', filters, options)
 
     @private
-    def disk_extend(self, disk):
-        disk.pop('enabled', None)
-        return disk
+    async def disk_extend(self, disks):
+        for disk in disks:
+            disk.pop('enabled', None)
+        return disks
 
     async def __camcontrol_list(self):
         """
@@ -196,35 +205,40 @@ class DiskService(CRUDService):
         Returns:
             str - identifier
         """
-        await self.middleware.threaded(geom.scan)
+        return await self.__device_to_identifier(name, await self.__geom_index())
+
+    async def __geom_index(self):
+        """
+        Get the shared index of the GEOM topology, it is only rebuilt after
+        being invalidated by devfs events or changes made by this plugin.
+        """
+        return await self.middleware.threaded(get_geom_index, pool='disk')
 
-        g = geom.geom_by_name('DISK', name)
-        if g and g.provider.config.get('ident'):
-            serial = g.provider.config['ident']
-            lunid = g.provider.config.get('lunid')
+    async def __device_to_identifier(self, name, index):
+        disk = index.disks.get(name)
+        if disk and disk['ident']:
+            serial = disk['ident']
+            lunid = disk['lunid']
             if lunid:
                 return f'{{serial_lunid}}{serial}_{lunid}'
             return f'{{serial}}{serial}'
 
-        serial = await self.serial_from_device(name)
+        if name in index.smart_serials:
+            serial = index.smart_serials[name]
+        else:
+            serial = index.smart_serials[name] = await self.serial_from_device(name) or ''
         if serial:
             return f'{{serial}}{serial}'
 
-        klass = geom.class_by_name('PART')
-        if klass:
-            for g in klass.geoms:
-                for p in g.providers:
-                    if p.name == name:
-                        # freebsd-zfs partition
-                        if p.config['rawtype'] == '516e7cba-6ecf-11d6-8ff8-00022d09712b':
-                            return f'{{uuid}}{p.config["rawuuid"]}'
+        part = index.partitions.get(name)
+        # freebsd-zfs partition
+        if part and part.get('rawtype') == '516e7cba-6ecf-11d6-8ff8-00022d09712b':
+            return f'{{uuid}}{part["rawuuid"]}'
 
-        g = geom.geom_by_name('LABEL', name)
-        if g:
-            return f'{{label}}{g.provider.name}'
+        if name in index.labels:
+            return f'{{label}}{index.labels[name]}'
 
-        g = geom.geom_by_name('DEV', name)
-        if g:
+        if name in index.devs:
             return f'{{devicename}}{name}'
 
         return ''
@@ -252,7 +266,8 @@ class DiskService(CRUDService):
         # Abort if the disk is not recognized as an available disk
         if name not in disks:
             return
-        ident = await self.device_to_identifier(name)
+        index = await self.__geom_index()
+        ident = await self.__device_to_identifier(name, index)
         qs = await self.middleware.call('datastore.query', 'storage.disk', [('disk_identifier', '=', ident)], {'order_by': ['disk_expiretime']})
         if ident and qs:
             disk = qs[0]
@@ -266,13 +281,12 @@ class DiskService(CRUDService):
             disk = {'disk_identifier': ident}
         disk.update({'disk_name': name, 'disk_expiretime': None})
 
-        await self.middleware.threaded(geom.scan)
-        g = geom.geom_by_name('DISK', name)
+        g = index.disks.get(name)
         if g:
-            if g.provider.config['ident']:
-                disk['disk_serial'] = g.provider.config['ident']
-            if g.provider.mediasize:
-                disk['disk_size'] = g.provider.mediasize
+            if g['ident']:
+                disk['disk_serial'] = g['ident']
+            if g['mediasize']:
+                disk['disk_size'] = g['mediasize']
         if not disk.get('disk_serial'):
             disk['disk_serial'] = await self.serial_from_device(name) or ''
         reg = RE_DSKNAME.search(name)
@@ -292,6 +306,10 @@ class DiskService(CRUDService):
     async def sync_all(self):
         """
         Synchronyze all disks with the cache in database.
+
+        Serials GEOM does not know about are probed concurrently and all
+        changes are written in a single transaction. Only entries which
+        actually changed are written.
         """
         # Skip sync disks on backup node
         if (
@@ -303,93 +321,136 @@ class DiskService(CRUDService):
 
         sys_disks = list((await self.middleware.call('device.get_info', 'DISK')).keys())
 
+        index = await self.__geom_index()
+        qs = await self.middleware.call('datastore.query', 'storage.disk', [], {'order_by': ['disk_expiretime']})
+
+        # Serials unknown to GEOM are only available through smartctl
+        if any(
+            disk['disk_identifier'].startswith('{serial}') and
+            not index.identifier_to_device(disk['disk_identifier'])
+            for disk in qs
+        ):
+            await self.__probe_serials(index, sys_disks)
+
+        now = datetime.utcnow()
+        rows = {disk['disk_identifier']: disk for disk in qs}
+        inserts = {}
+        updates = {}
+        deletes = []
+        changed = []
         seen_disks = {}
         serials = []
-        await self.middleware.threaded(geom.scan)
-        for disk in (await self.middleware.call('datastore.query', 'storage.disk', [], {'order_by': ['disk_expiretime']})):
+        for disk in qs:
+            original = disk.copy()
 
-            name = await self.middleware.call('notifier.identifier_to_device', disk['disk_identifier'])
+            name = index.identifier_to_device(disk['disk_identifier'])
             if not name or name in seen_disks:
                 # If we cant translate the indentifier to a device, give up
                 # If name has already been seen once then we are probably
                 # dealing with with multipath here
                 if not disk['disk_expiretime']:
-                    disk['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-                    await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-                elif disk['disk_expiretime'] < datetime.utcnow():
+                    disk['disk_expiretime'] = now + timedelta(days=DISK_EXPIRECACHE_DAYS)
+                    updates[disk['disk_identifier']] = disk
+                elif disk['disk_expiretime'] < now:
                     # Disk expire time has surpassed, go ahead and remove it
-                    await self.middleware.call('datastore.delete', 'storage.disk', disk['disk_identifier'])
+                    deletes.append(disk['disk_identifier'])
                 continue
             else:
                 disk['disk_expiretime'] = None
                 disk['disk_name'] = name
 
-            reg = RE_DSKNAME.search(name)
-            if reg:
-                disk['disk_subsystem'] = reg.group(1)
-                disk['disk_number'] = int(reg.group(2))
-            serial = ''
-            g = geom.geom_by_name('DISK', name)
-            if g:
-                if g.provider.config['ident']:
-                    serial = disk['disk_serial'] = g.provider.config['ident']
-                serial += g.provider.config.get('lunid') or ''
-                if g.provider.mediasize:
-                    disk['disk_size'] = g.provider.mediasize
-            if not disk.get('disk_serial'):
-                serial = disk['disk_serial'] = await self.serial_from_device(name) or ''
-
+            serial = self.__update_disk(disk, name, index)
             if serial:
                 serials.append(serial)
 
             # If for some reason disk is not identified as a system disk
             # mark it to expire.
             if name not in sys_disks and not disk['disk_expiretime']:
-                    disk['disk_expiretime'] = datetime.utcnow() + timedelta(days=DISK_EXPIRECACHE_DAYS)
-            await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-
-            # FIXME: use a truenas middleware plugin
-            await self.middleware.call('notifier.sync_disk_extra', disk['disk_identifier'], False)
+                    disk['disk_expiretime'] = now + timedelta(days=DISK_EXPIRECACHE_DAYS)
+            if disk != original:
+                updates[disk['disk_identifier']] = disk
+                changed.append((disk['disk_identifier'], False))
             seen_disks[name] = disk
 
-        for name in sys_disks:
-            if name not in seen_disks:
-                disk_identifier = await self.device_to_identifier(name)
-                qs = await self.middleware.call('datastore.query', 'storage.disk', [('disk_identifier', '=', disk_identifier)])
-                if qs:
-                    new = False
-                    disk = qs[0]
+        new_disks = [name for name in sys_disks if name not in seen_disks]
+        await self.__probe_serials(index, [
+            name for name in new_disks
+            if not (index.disks.get(name) or {}).get('ident')
+        ])
+        for name in new_disks:
+            disk_identifier = await self.__device_to_identifier(name, index)
+            disk = rows.get(disk_identifier) or {'disk_identifier': disk_identifier}
+            original = disk.copy()
+            disk['disk_name'] = name
+            serial = self.__update_disk(disk, name, index)
+            if serial:
+                if serial in serials:
+                    # Probably dealing with multipath here, do not add another
+                    disk.clear()
+                    disk.update(original)
+                    continue
                 else:
-                    new = True
-                    disk = {'disk_identifier': disk_identifier}
-                disk['disk_name'] = name
-                serial = ''
-                g = geom.geom_by_name('DISK', name)
-                if g:
-                    if g.provider.config['ident']:
-                        serial = disk['disk_serial'] = g.provider.config['ident']
-                    serial += g.provider.config.get('lunid') or ''
-                    if g.provider.mediasize:
-                        disk['disk_size'] = g.provider.mediasize
-                if not disk.get('disk_serial'):
-                    serial = disk['disk_serial'] = await self.serial_from_device(name) or ''
-                if serial:
-                    if serial in serials:
-                        # Probably dealing with multipath here, do not add another
-                        continue
-                    else:
-                        serials.append(serial)
-                reg = RE_DSKNAME.search(name)
-                if reg:
-                    disk['disk_subsystem'] = reg.group(1)
-                    disk['disk_number'] = int(reg.group(2))
+                    serials.append(serial)
+            if disk_identifier not in rows:
+                rows[disk_identifier] = inserts[disk_identifier] = disk
+            elif disk_identifier not in inserts:
+                if disk_identifier in deletes:
+                    deletes.remove(disk_identifier)
+                updates[disk_identifier] = disk
+            changed.append((disk_identifier, True))
+
+        if inserts or updates or deletes:
+            await self.middleware.call('datastore.bulk', 'storage.disk', {
+                'insert': list(inserts.values()),
+                'update': list(updates.values()),
+                'delete': deletes,
+            })
 
-                if not new:
-                    await self.middleware.call('datastore.update', 'storage.disk', disk['disk_identifier'], disk)
-                else:
-                    disk['disk_identifier'] = await self.middleware.call('datastore.insert', 'storage.disk', disk)
-                # FIXME: use a truenas middleware plugin
-                await self.middleware.call('notifier.sync_disk_extra', disk['disk_identifier'], True)
+        # FIXME: use a truenas middleware plugin
+        await self.__gather([
+            self.middleware.call('notifier.sync_disk_extra', identifier, add)
+            for identifier, add in changed
+        ])
+
+    def __update_disk(self, disk, name, index):
+        """
+        Update `disk` entry with device `name` information, returning the
+        serial (with lunid) used to tell multipath disks apart.
+        """
+        reg = RE_DSKNAME.search(name)
+        if reg:
+            disk['disk_subsystem'] = reg.group(1)
+            disk['disk_number'] = int(reg.group(2))
+        serial = ''
+        g = index.disks.get(name)
+        if g:
+            if g['ident']:
+                serial = disk['disk_serial'] = g['ident']
+            serial += g['lunid'] or ''
+            if g['mediasize']:
+                disk['disk_size'] = str(g['mediasize'])
+        if not disk.get('disk_serial'):
+            serial = disk['disk_serial'] = index.smart_serials.get(name) or ''
+        return serial
+
+    async def __probe_serials(self, index, names):
+        """
+        Read serial of disks `names` with smartctl, SYNC_CONCURRENCY at a
+        time, remembering them in the GEOM index.
+        """
+        async def probe(name):
+            index.smart_serials[name] = await self.serial_from_device(name) or ''
+
+        await self.__gather([probe(name) for name in names if name not in index.smart_serials])
+
+    async def __gather(self, coros):
+        semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+        async def run_one(coro):
+            async with semaphore:
+                return await coro
+
+        return await asyncio.gather(*[run_one(coro) for coro in coros])
 
     async def __multipath_create(self, name, consumers, mode=None):
         """
@@ -420,7 +481,7 @@ class DiskService(CRUDService):
         Returns:
             The string of the multipath name to be created
         """
-        await self.middleware.threaded(geom.scan)
+        await self.middleware.threaded(geom.scan, pool='disk')
         numbers = sorted([
             int(RE_MPATH_NAME.search(g.name).group(1))
             for g in geom.class_by_name('MULTIPATH').geoms if RE_MPATH_NAME.match(g.name)
@@ -448,7 +509,7 @@ class DiskService(CRUDService):
         then a gmultipath is automatically created and will be available for use.
         """
 
-        await self.middleware.threaded(geom.scan)
+        await self.middleware.threaded(geom.scan, pool='disk')
 
         mp_disks = []
         for g in geom.class_by_name('MULTIPATH').geoms:
@@ -518,7 +579,8 @@ class DiskService(CRUDService):
             await self.__multipath_create(name, disks, 'A' if disks[0] in active_active else mode)
 
         # Scan again to take new multipaths into account
-        await self.middleware.threaded(geom.scan)
+        await self.middleware.threaded(geom.scan, pool='disk')
+        invalidate_geom_index()
         mp_ids = []
         for g in geom.class_by_name('MULTIPATH').geoms:
             _disks = []
@@ -564,7 +626,7 @@ class DiskService(CRUDService):
         We try to mirror all available swap partitions to avoid a system
         crash in case one of them dies.
         """
-        await self.middleware.threaded(geom.scan)
+        await self.middleware.threaded(geom.scan, pool='disk')
 
         used_partitions = set()
         swap_devices = []
@@ -641,7 +703,7 @@ class DiskService(CRUDService):
         it will offline if from swap, remove it from the gmirror (if exists)
         and detach the geli.
         """
-        await self.middleware.threaded(geom.scan)
+        await self.middleware.threaded(geom.scan, pool='disk')
         providers = {}
         for disk in disks:
             partgeom = geom.geom_by_name('PART', disk)
@@ -708,7 +770,7 @@ class DiskService(CRUDService):
 
         # First do a quick wipe of every partition to clean things like zfs labels
         if mode == 'QUICK':
-            await self.middleware.threaded(geom.scan)
+            await self.middleware.threaded(geom.scan, pool='disk')
             klass = geom.class_by_name('PART')
             for g in klass.xml.findall(f'./geom[name=\'{dev}\']'):
                 for p in g.findall('./provider'):
@@ -758,6 +820,8 @@ class DiskService(CRUDService):
                 if reg:
                     job.set_progress(int(reg.group(1)) / size, extra={'speed': int(reg.group(2))})
 
+        # Partitions are gone, do not wait for devfs to notice
+        invalidate_geom_index()
         await self.sync(dev)
 
 
@@ -792,11 +856,15 @@ async def _event_devfs(middleware, event_type, args):
     if data.get('subsystem') != 'CDEV':
         return
 
+    # Any device node coming or going may change the GEOM topology
+    invalidate_geom_index()
+
     if data['type'] == 'CREATE':
         disks = await middleware.threaded(lambda: sysctl.filter('kern.disks')[0].value.split())
         # Device notified about is not a disk
         if data['cdev'] not in disks:
             return
+        await middleware.call('cache.invalidate', 'disk')
         # TODO: hack so every disk is not synced independently during boot
         # This is a performance issue
         if os.path.exists('/tmp/.sync_disk_done'):
@@ -811,6 +879,7 @@ async def _event_devfs(middleware, event_type, args):
         # Device notified about is not a disk
         if not RE_ISDISK.match(data['cdev']):
             return
+        await middleware.call('cache.invalidate', 'disk')
         # TODO: hack so every disk is not synced independently during boot
         # This is a performance issue
         if os.path.exists('/tmp/.sync_disk_done'):
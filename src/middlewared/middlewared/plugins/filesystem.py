@@ -1,11 +1,59 @@
 from middlewared.schema import Bool, Dict, Int, Ref, Str, accepts
-from middlewared.service import private, CallError, Service
-from middlewared.utils import filter_list
+from middlewared.service import private, CallError, Service, job
+from middlewared.utils import filter_compile, filter_list
 
 import binascii
 import errno
+import hashlib
+import heapq
+import operator
 import os
 
+# Size of the reads and writes of the streaming file transfer methods
+CHUNK_SIZE = 1024 * 1024
+CHECKSUM_ALGORITHMS = ('md5', 'sha1', 'sha256')
+# listdir attributes which require a stat(2) of the entry
+STAT_ATTRS = ('size', 'mode', 'uid', 'gid')
+
+
+def _filter_names(filters):
+    for f in filters:
+        if len(f) == 3:
+            yield f[0]
+        elif len(f) == 2:
+            yield from _filter_names(f[1])
+
+
+def _listdir_entry(entry, stat, realpath):
+    if entry.is_dir():
+        etype = 'DIRECTORY'
+    elif entry.is_file():
+        etype = 'FILE'
+    elif entry.is_symlink():
+        etype = 'SYMLINK'
+    else:
+        etype = 'OTHER'
+
+    data = {
+        'name': entry.name,
+        'path': entry.path,
+        'type': etype,
+    }
+    if realpath:
+        data['realpath'] = os.path.realpath(entry.path) if etype == 'SYMLINK' else entry.path
+    if stat:
+        try:
+            st = entry.stat()
+            data.update({
+                'size': st.st_size,
+                'mode': st.st_mode,
+                'uid': st.st_uid,
+                'gid': st.st_gid,
+            })
+        except FileNotFoundError:
+            data.update({'size': None, 'mode': None, 'uid': None, 'gid': None})
+    return data
+
 
 class FilesystemService(Service):
 
@@ -23,6 +71,14 @@ class FilesystemService(Service):
           mode(int): file mode/permission
           uid(int): user id of entry owner
           gid(int): group id of entry onwer
+
+        Filters are applied while the directory is read. Entries are only
+        stat'd if one of the stat attributes is selected, filtered or ordered
+        by, so `{"select": ["name", "type"]}` is cheap on huge directories.
+
+        Big directories can be read in pages with `limit`: entries are then
+        returned ordered by name and the next page is requested passing the
+        name of the last entry as `{"extra": {"cursor": name}}`.
         """
         if not os.path.exists(path):
             raise CallError(f'Directory {path} does not exist', errno.ENOENT)
@@ -30,35 +86,46 @@ class FilesystemService(Service):
         if not os.path.isdir(path):
             raise CallError(f'Path {path} is not a directory', errno.ENOTDIR)
 
-        rv = []
-        for entry in os.scandir(path):
-            if entry.is_dir():
-                etype = 'DIRECTORY'
-            elif entry.is_file():
-                etype = 'FILE'
-            elif entry.is_symlink():
-                etype = 'SYMLINK'
+        filters = filters or []
+        options = options or {}
+        cursor = (options.get('extra') or {}).get('cursor')
+        order_by = options.get('order_by') or []
+
+        attrs = None
+        if options.get('select'):
+            attrs = set(options['select']) | set(_filter_names(filters)) | {o.lstrip('-') for o in order_by}
+        want_stat = attrs is None or bool(attrs & set(STAT_ATTRS))
+        want_realpath = attrs is None or 'realpath' in attrs
+        predicate = filter_compile(filters) if filters else None
+
+        def entries():
+            with os.scandir(path) as it:
+                for entry in it:
+                    if cursor is not None and entry.name <= cursor:
+                        continue
+                    data = _listdir_entry(entry, want_stat, want_realpath)
+                    if predicate is None or predicate(data):
+                        yield data
+
+        if options.get('count') is True:
+            return sum(1 for i in entries())
+
+        if options.get('get') is True and not order_by:
+            options = dict(options, limit=1)
+
+        if cursor is not None or (options.get('limit') and not order_by):
+            if order_by not in ([], ['name']):
+                raise CallError('Paginated listing is ordered by name', errno.EINVAL)
+            # Keep only the entries of the requested page in memory
+            top = (options.get('offset') or 0) + options['limit'] if options.get('limit') else None
+            if top is not None:
+                rv = heapq.nsmallest(top, entries(), key=operator.itemgetter('name'))
             else:
-                etype = 'OTHER'
-
-            data = {
-                'name': entry.name,
-                'path': entry.path,
-                'realpath': os.path.realpath(entry.path) if etype == 'SYMLINK' else entry.path,
-                'type': etype,
-            }
-            try:
-                stat = entry.stat()
-                data.update({
-                    'size': stat.st_size,
-                    'mode': stat.st_mode,
-                    'uid': stat.st_uid,
-                    'gid': stat.st_gid,
-                })
-            except FileNotFoundError:
-                data.update({'size': None, 'mode': None, 'uid': None, 'gid': None})
-            rv.append(data)
-        return filter_list(rv, filters=filters or [], options=options or {})
+                rv = sorted(entries(), key=operator.itemgetter('name'))
+            options = dict(options, order_by=[])
+        else:
+            rv = list(entries())
+        return filter_list(rv, options=options)
 
     @accepts(Str('path'))
     def stat(self, path):
@@ -90,26 +157,50 @@ class FilesystemService(Service):
             'options',
             Bool('append', default=False),
             Int('mode'),
+            Int('offset'),
+            Str('checksum'),
         ),
     )
     def file_receive(self, path, content, options=None):
         """
-        Simplified file receiving method for small files.
+        Simplified file receiving method for small files or chunks of files.
 
         `content` must be a base 64 encoded file content.
 
-        DISCLAIMER: DO NOT USE THIS FOR BIG FILES (> 500KB).
+        `offset` writes `content` at that position of the file instead of
+        replacing it, so a file can be sent in chunks and an interrupted
+        transfer resumed from the size of the file (see `filesystem.stat`).
+        It can not be past the end of the file.
+
+        `checksum` is the SHA256 hex digest of the decoded `content`, the
+        chunk is not written if it does not match.
+
+        Use `filesystem.put` through `/_upload` for big files.
         """
         options = options or {}
+        data = binascii.a2b_base64(content)
+        if options.get('checksum') and hashlib.sha256(data).hexdigest() != options['checksum'].lower():
+            raise CallError('Checksum mismatch', errno.EINVAL)
+
         dirname = os.path.dirname(path)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
-        if options.get('append'):
-            openmode = 'ab'
+
+        if options.get('offset') is not None:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                if options['offset'] > os.fstat(fd).st_size:
+                    raise CallError(f'Offset is past the end of {path}', errno.EINVAL)
+                os.pwrite(fd, data, options['offset'])
+            finally:
+                os.close(fd)
         else:
-            openmode = 'wb+'
-        with open(path, openmode) as f:
-            f.write(binascii.a2b_base64(content))
+            if options.get('append'):
+                openmode = 'ab'
+            else:
+                openmode = 'wb+'
+            with open(path, openmode) as f:
+                f.write(data)
         mode = options.get('mode')
         if mode:
             os.chmod(path, mode)
@@ -128,7 +219,10 @@ class FilesystemService(Service):
         """
         Get contents of a file `path` in base64 encode.
 
-        DISCLAIMER: DO NOT USE THIS FOR BIG FILES (> 500KB).
+        `offset` and `maxlen` allow to get the file in chunks, which can be
+        verified with `filesystem.checksum`.
+
+        Use `filesystem.get` through `/_download` for big files.
         """
         options = options or {}
         if not os.path.exists(path):
@@ -136,5 +230,118 @@ class FilesystemService(Service):
         with open(path, 'rb') as f:
             if options.get('offset'):
                 f.seek(options['offset'])
-            data = binascii.b2a_base64(f.read(options.get('maxlen'))).decode().strip()
+            data = binascii.b2a_base64(f.read(options.get('maxlen')), newline=False).decode()
         return data
+
+    @accepts(
+        Str('path'),
+        Dict(
+            'checksum-options',
+            Str('algorithm', enum=list(CHECKSUM_ALGORITHMS), default='sha256'),
+            Int('offset'),
+            Int('length'),
+        ),
+    )
+    def checksum(self, path, options=None):
+        """
+        Get the hex digest of the contents of file `path`.
+
+        `offset` and `length` restrict it to a chunk of the file, e.g. to
+        verify a chunk got with `filesystem.file_get_contents` or find where
+        an interrupted transfer has to be resumed.
+        """
+        options = options or {}
+        h = hashlib.new(options.get('algorithm') or 'sha256')
+        remaining = options.get('length')
+        try:
+            with open(path, 'rb') as f:
+                if options.get('offset'):
+                    f.seek(options['offset'])
+                while remaining is None or remaining > 0:
+                    data = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    h.update(data)
+                    if remaining is not None:
+                        remaining -= len(data)
+        except FileNotFoundError:
+            raise CallError(f'Path {path} not found', errno.ENOENT)
+        return h.hexdigest()
+
+    @accepts(
+        Str('path'),
+        Dict(
+            'options',
+            Int('offset'),
+        ),
+    )
+    @job(pipe=True)
+    def get(self, job, path, options=None):
+        """
+        Stream the contents of file `path` starting at `offset`.
+
+        Meant to be called through `core.download`, the file is sent as is
+        in the `/_download` response.
+        """
+        options = options or {}
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            os.close(job.write_fd)
+            raise CallError(f'Path {path} not found', errno.ENOENT)
+        with f, os.fdopen(job.write_fd, 'wb') as out:
+            if options.get('offset'):
+                f.seek(options['offset'])
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                out.write(data)
+
+    @accepts(
+        Str('path'),
+        Dict(
+            'options',
+            Bool('append', default=False),
+            Int('mode'),
+            Int('offset'),
+        ),
+    )
+    @job(pipe=True)
+    def put(self, job, path, options=None):
+        """
+        Write file `path` with the contents streamed through `/_upload`.
+
+        `append` and `offset` work as in `filesystem.file_receive`, so an
+        interrupted upload can be resumed with the rest of the file.
+
+        Returns the size and SHA256 hex digest of the received data.
+        """
+        options = options or {}
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        flags = os.O_WRONLY | os.O_CREAT
+        if options.get('offset') is None:
+            flags |= os.O_APPEND if options.get('append') else os.O_TRUNC
+        fd = os.open(path, flags, 0o644)
+        with os.fdopen(job.read_fd, 'rb') as f, os.fdopen(fd, 'wb') as out:
+            if options.get('offset') is not None:
+                if options['offset'] > os.fstat(fd).st_size:
+                    raise CallError(f'Offset is past the end of {path}', errno.EINVAL)
+                out.seek(options['offset'])
+            h = hashlib.sha256()
+            size = 0
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                h.update(data)
+                out.write(data)
+                size += len(data)
+
+        mode = options.get('mode')
+        if mode:
+            os.chmod(path, mode)
+        return {'size': size, 'sha256': h.hexdigest()}
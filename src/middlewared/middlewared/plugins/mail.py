@@ -1,3 +1,4 @@
+from datetime import timedelta
 from middlewared.schema import Bool, Dict, Int, List, Str, accepts
 from middlewared.service import ConfigService
 
@@ -35,8 +36,12 @@ class MailService(ConfigService):
     def send(self, message):
         """
         Sends mail using configured mail settings.
+
+        `interval` is given in seconds.
         """
         # TODO: For now this is just a wrapper for freenasUI send_mail,
         #       when the time comes we will do the reverse, logic here
         #       and calling this method from freenasUI.
+        if message.get('interval') is not None:
+            message['interval'] = timedelta(seconds=message['interval'])
         return send_mail(**message)
@@ -1,15 +1,23 @@
 import asyncio
 import inspect
 import os
+import re
+import select
 import signal
 import threading
 import time
-from subprocess import DEVNULL, PIPE
+from subprocess import DEVNULL
+
+import psutil
 
 from middlewared.schema import accepts, Bool, Dict, Int, Ref, Str
-from middlewared.service import filterable, CRUDService
+from middlewared.service import filterable, private, CRUDService
 from middlewared.utils import Popen, filter_list
 
+# Interval in seconds to rescan all services, daemons started outside of
+# middlewared are only noticed then
+LIVENESS_RESYNC_INTERVAL = 30
+
 
 class StartNotify(threading.Thread):
 
@@ -47,6 +55,117 @@ class StartNotify(threading.Thread):
             tries += 1
 
 
+def service_pids(procname, pidfile):
+    """
+    Get pids of a daemon the way `pgrep [-F pidfile] [procname]` does,
+    without forking it.
+    """
+    if pidfile:
+        try:
+            with open(pidfile) as f:
+                pid = int(f.readline().strip())
+        except (OSError, ValueError):
+            return []
+        try:
+            if procname and not re.search(procname, psutil.Process(pid).name()):
+                return []
+        except psutil.Error:
+            return []
+        return [pid]
+
+    pids = []
+    for proc in psutil.process_iter():
+        try:
+            if re.search(procname, proc.name()):
+                pids.append(proc.pid)
+        except psutil.Error:
+            pass
+    return pids
+
+
+class ServiceLiveness(threading.Thread):
+    """
+    Tracks whether the daemons of SERVICE_DEFS are running.
+
+    The state is cached so `service.query` does not have to look for the
+    processes. Pids found are watched with kqueue EVFILT_PROC, so a daemon
+    exiting is noticed right away and `on_change` is called with its
+    service name. Everything is also rescanned every
+    LIVENESS_RESYNC_INTERVAL seconds.
+    """
+
+    def __init__(self, defs, on_change):
+        super(ServiceLiveness, self).__init__(daemon=True)
+        self.defs = defs
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.status = {}
+        self.watched = {}
+        self.kq = select.kqueue() if hasattr(select, 'kqueue') else None
+
+    def cached(self, service):
+        with self.lock:
+            return self.status.get(service)
+
+    def check(self, service):
+        """
+        Look for the processes of `service` and update its cached state.
+
+        Returns:
+            tuple: ((running, pids), whether the state changed)
+        """
+        procname, pidfile = self.defs[service]
+        pids = service_pids(procname, pidfile)
+        status = (bool(pids), pids)
+        with self.lock:
+            old = self.status.get(service)
+            self.status[service] = status
+            new_pids = [pid for pid in pids if pid not in self.watched]
+            for pid in new_pids:
+                self.watched[pid] = service
+        for pid in new_pids:
+            self.__watch(pid)
+        return status, old is not None and old[0] != status[0]
+
+    def __watch(self, pid):
+        if self.kq is None:
+            return
+        try:
+            self.kq.control([select.kevent(
+                pid,
+                filter=select.KQ_FILTER_PROC,
+                flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                fflags=select.KQ_NOTE_EXIT,
+            )], 0)
+        except ProcessLookupError:
+            # Exited before we could watch it, forget it so the next check
+            # notices
+            with self.lock:
+                self.watched.pop(pid, None)
+
+    def run(self):
+        last_resync = 0
+        while True:
+            if time.monotonic() - last_resync >= LIVENESS_RESYNC_INTERVAL:
+                services = set(self.defs)
+                last_resync = time.monotonic()
+            elif self.kq is not None:
+                events = self.kq.control(None, 32, LIVENESS_RESYNC_INTERVAL)
+                with self.lock:
+                    services = {self.watched.pop(ev.ident, None) for ev in events} - {None}
+            else:
+                time.sleep(LIVENESS_RESYNC_INTERVAL)
+                continue
+
+            for service in services:
+                try:
+                    changed = self.check(service)[1]
+                except Exception:
+                    continue
+                if changed:
+                    self.on_change(service)
+
+
 class ServiceService(CRUDService):
 
     SERVICE_DEFS = {
@@ -70,6 +189,10 @@ class ServiceService(CRUDService):
         'netdata': ('netdata', '/var/db/netdata/netdata.pid')
     }
 
+    def __init__(self, *args, **kwargs):
+        super(ServiceService, self).__init__(*args, **kwargs)
+        self.liveness = ServiceLiveness(self.SERVICE_DEFS, self._liveness_changed)
+
     @filterable
     async def query(self, filters=None, options=None):
         if options is None:
@@ -150,6 +273,7 @@ class ServiceService(CRUDService):
         """
         if sn:
             await self.middleware.threaded(sn.join)
+        await self._started_refresh(service)
 
         try:
             svc = await self.query([('service', '=', service)], {'get': True})
@@ -309,34 +433,50 @@ class ServiceService(CRUDService):
         """
         This is the second step::
         Wait for the StartNotify thread to finish and then check for the
-        status of pidfile/procname using pgrep
+        status of pidfile/procname
 
         Returns:
             True whether the service is alive, False otherwise
         """
 
         if what in self.SERVICE_DEFS:
-            procname, pidfile = self.SERVICE_DEFS[what]
             if notify:
                 await self.middleware.threaded(notify.join)
-
-            if pidfile:
-                pgrep = "/bin/pgrep -F {}{}".format(
-                    pidfile,
-                    ' ' + procname if procname else '',
-                )
             else:
-                pgrep = "/bin/pgrep {}".format(procname)
-            proc = await Popen(pgrep, shell=True, stdout=PIPE, stderr=PIPE, close_fds=True)
-            data = (await proc.communicate())[0].decode()
-
-            if proc.returncode == 0:
-                return True, [
-                    int(i)
-                    for i in data.strip().split('\n') if i.isdigit()
-                ]
+                status = self.liveness.cached(what)
+                if status is not None:
+                    return status
+            return (await self.middleware.threaded(self.liveness.check, what))[0]
         return False, []
 
+    async def _started_refresh(self, what):
+        """
+        Look for the processes of `what` again after it has been started or
+        stopped, instead of using the cached state.
+        """
+        if what in self.SERVICE_DEFS:
+            await self.middleware.threaded(self.liveness.check, what)
+        elif what == 'ups':
+            for svc in ('ups', 'upsmon'):
+                await self.middleware.threaded(self.liveness.check, svc)
+
+    def _liveness_changed(self, what):
+        # Called from the liveness thread
+        if what == 'upsmon':
+            what = 'ups'
+        asyncio.run_coroutine_threadsafe(self._send_changed(what), self.middleware.loop)
+
+    async def _send_changed(self, what):
+        try:
+            svc = await self.query([('service', '=', what)], {'get': True})
+        except IndexError:
+            return
+        self.middleware.send_event('service.query', 'CHANGED', fields=svc)
+
+    @private
+    async def liveness_start(self):
+        self.liveness.start()
+
     async def _start_webdav(self, **kwargs):
         await self._service("ix-apache", "start", force=True, **kwargs)
         await self._service("apache24", "start", **kwargs)
@@ -898,3 +1038,7 @@ class ServiceService(CRUDService):
             # benefit in waiting for it since even if it fails it wont
             # tell the user anything useful.
             asyncio.ensure_future(self.restart("collectd", kwargs))
+
+
+def setup(middleware):
+    asyncio.ensure_future(middleware.call('service.liveness_start'))
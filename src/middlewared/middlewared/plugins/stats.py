@@ -1,22 +1,163 @@
 from middlewared.client import ejson as json
 from middlewared.schema import Dict, Int, List, Str, accepts
+from middlewared.rrd import RRDError, RRDFile, xport
 from middlewared.service import Service
 from middlewared.utils import Popen
+from middlewared.zilstat import ZilStat
 
+import asyncio
 import glob
 import os
+import psutil
 import re
 import subprocess
+import sysctl
+import time
 
 
 RRD_PATH = '/var/db/collectd/rrd/localhost/'
 RE_DSTYPE = re.compile(r'ds\[(\w+)\]\.type = "(\w+)"')
 RE_STEP = re.compile(r'step = (\d+)')
 RE_LAST_UPDATE = re.compile(r'last_update = (\d+)')
+REALTIME_INTERVAL = 2
+REALTIME_PRECISION = 2
+
+
+def dict_delta(old, new, prefix=''):
+    """
+    Returns the changed values of `new` compared to `old` and the
+    dotted path of keys which no longer exist.
+    """
+    changed = {}
+    cleared = [f'{prefix}{k}' for k in old if k not in new]
+    for k, v in new.items():
+        o = old.get(k)
+        if isinstance(v, dict) and isinstance(o, dict):
+            sub_changed, sub_cleared = dict_delta(o, v, f'{prefix}{k}.')
+            if sub_changed:
+                changed[k] = sub_changed
+            cleared += sub_cleared
+        elif k not in old or o != v:
+            changed[k] = v
+    return changed, cleared
+
+
+class RealtimeStats(object):
+    """
+    Samples counters which change quickly (CPU, ARC, network interfaces
+    and disks) and converts them to rates since the previous sample.
+    """
+
+    def __init__(self):
+        self.counters = None
+        self.time = None
+        self.last = {}
+
+    def __rate(self, new, old, elapsed):
+        if old is None:
+            return 0
+        return round(max(new - old, 0) / elapsed, REALTIME_PRECISION)
+
+    def __arc(self):
+        arc = {}
+        for name in ('size', 'c', 'hits', 'misses'):
+            try:
+                arc[name] = sysctl.filter(f'kstat.zfs.misc.arcstats.{name}')[0].value
+            except IndexError:
+                pass
+        return arc
+
+    def sample(self):
+        now = time.monotonic()
+        counters = {
+            'arc': self.__arc(),
+            'interfaces': psutil.net_io_counters(pernic=True),
+            'disks': psutil.disk_io_counters(perdisk=True) or {},
+        }
+        old = self.counters or {'arc': {}, 'interfaces': {}, 'disks': {}}
+        elapsed = (now - self.time) if self.time else REALTIME_INTERVAL
+
+        cpu = {
+            k: round(v, REALTIME_PRECISION)
+            for k, v in psutil.cpu_times_percent(interval=None)._asdict().items()
+        }
+
+        arc = {}
+        if 'size' in counters['arc']:
+            arc['size'] = counters['arc']['size']
+        if 'c' in counters['arc']:
+            arc['target'] = counters['arc']['c']
+        for name in ('hits', 'misses'):
+            if name in counters['arc']:
+                arc[name] = self.__rate(counters['arc'][name], old['arc'].get(name), elapsed)
+
+        interfaces = {}
+        for name, io in counters['interfaces'].items():
+            prev = old['interfaces'].get(name)
+            interfaces[name] = {
+                'received_bytes': self.__rate(io.bytes_recv, prev and prev.bytes_recv, elapsed),
+                'sent_bytes': self.__rate(io.bytes_sent, prev and prev.bytes_sent, elapsed),
+            }
+
+        disks = {}
+        for name, io in counters['disks'].items():
+            prev = old['disks'].get(name)
+            disks[name] = {
+                'read_bytes': self.__rate(io.read_bytes, prev and prev.read_bytes, elapsed),
+                'write_bytes': self.__rate(io.write_bytes, prev and prev.write_bytes, elapsed),
+            }
+            busy_time = getattr(io, 'busy_time', None)
+            if busy_time is not None:
+                # busy_time is in milliseconds
+                disks[name]['busy'] = min(self.__rate(
+                    busy_time, prev and prev.busy_time, elapsed * 10,
+                ), 100)
+
+        self.counters = counters
+        self.time = now
+        return {
+            'cpu': cpu,
+            'arc': arc,
+            'interfaces': interfaces,
+            'disks': disks,
+        }
+
+    def reset(self):
+        self.counters = None
+        self.time = None
+        self.last = {}
 
 
 class StatsService(Service):
 
+    def __init__(self, *args, **kwargs):
+        super(StatsService, self).__init__(*args, **kwargs)
+        self.realtime = RealtimeStats()
+        self.zilstat = ZilStat()
+
+    @accepts()
+    def get_realtime(self):
+        """
+        Returns the last sample sent to `stats.realtime` subscribers.
+
+        Events of the `stats.realtime` collection only carry the values
+        which changed since the previous sample (and the dotted path of
+        removed keys in `cleared`), so this is meant to get the initial
+        state right after subscribing.
+        """
+        return self.realtime.last
+
+    @accepts()
+    def get_zilstat(self):
+        """
+        Returns the ZIL activity over the last 1, 5 and 10 seconds, keyed by
+        the window length.
+
+        `ops` and `bytes` are the log records written to the ZIL and
+        `commits` the number of ZIL commits (e.g. fsync) in the window.
+        """
+        return self.zilstat.get()
+
     @accepts()
     def get_sources(self):
         """
@@ -40,6 +181,19 @@ class StatsService(Service):
         Returns info about a given dataset from some source.
         """
         rrdfile = '{}/{}/{}.rrd'.format(RRD_PATH, source, _type)
+        try:
+            header = await self.middleware.threaded(self.__read_header, rrdfile)
+        except RRDError:
+            self.logger.debug('Failed to read %s, falling back to rrdtool', rrdfile, exc_info=True)
+        else:
+            return {
+                'source': source,
+                'type': _type,
+                'datasets': {ds.name: {'type': ds.type} for ds in header.datasources},
+                'step': header.step,
+                'last_update': header.last_update,
+            }
+
         proc = await Popen(
             ['/usr/local/bin/rrdtool', 'info', rrdfile],
             stdout=subprocess.PIPE,
@@ -88,11 +242,30 @@ class StatsService(Service):
         """
         Get data points from rrd files.
         """
+        defs = [
+            (
+                '{}/{}/{}.rrd'.format(RRD_PATH, data['source'], data['type']),
+                data['dataset'], data['cf'], '{}/{}'.format(data['source'], data['type']),
+            )
+            for data in data_list
+        ]
+        try:
+            data = await self.middleware.threaded(xport, defs, stats['start'], stats['end'], stats.get('step'))
+        except RRDError:
+            self.logger.debug('Failed to read rrd files natively, falling back to rrdtool', exc_info=True)
+            data = await self.__rrdtool_xport(data_list, stats)
+
+        # Custom about property
+        data['about'] = 'Data for ' + ','.join(['{}/{}'.format(i['source'], i['type']) for i in data_list])
+        return data
+
+    def __read_header(self, rrdfile):
+        with RRDFile(rrdfile) as f:
+            return f.header
 
+    async def __rrdtool_xport(self, data_list, stats):
         defs = []
-        names_pair = []
         for i, data in enumerate(data_list):
-            names_pair.append([data['source'], data['type']])
             rrdfile = '{}/{}/{}.rrd'.format(RRD_PATH, data['source'], data['type'])
             defs.extend([
                 'DEF:xxx{}={}:{}:{}'.format(i, rrdfile, data['dataset'], data['cf']),
@@ -109,8 +282,42 @@ class StatsService(Service):
         data, err = await proc.communicate()
         if proc.returncode != 0:
             raise ValueError('rrdtool failed: {}'.format(err.decode()))
-        data = json.loads(data.decode())
+        return json.loads(data.decode())
 
-        # Custom about property
-        data['about'] = 'Data for ' + ','.join(['/'.join(i) for i in names_pair])
-        return data
+
+async def realtime_loop(middleware):
+    """
+    Sample realtime stats once per interval while there are subscribers
+    and send the delta to all of them in a single event.
+    """
+    realtime = middleware.get_service('stats').realtime
+    while True:
+        await asyncio.sleep(REALTIME_INTERVAL)
+        if not middleware.has_subscribers('stats.realtime'):
+            realtime.reset()
+            continue
+        try:
+            sample = await middleware.threaded(realtime.sample)
+        except Exception:
+            middleware.logger.warn('Failed to sample realtime stats', exc_info=True)
+            continue
+        changed, cleared = dict_delta(realtime.last, sample)
+        realtime.last = sample
+        if changed or cleared:
+            middleware.send_event('stats.realtime', 'CHANGED', fields=changed, cleared=cleared)
+
+
+async def zilstat_loop(middleware):
+    zilstat = middleware.get_service('stats').zilstat
+    while True:
+        try:
+            zilstat.sample()
+        except Exception:
+            middleware.logger.debug('Failed to sample ZIL stats', exc_info=True)
+        await asyncio.sleep(1)
+
+
+def setup(middleware):
+    middleware.register_event_policy('stats.realtime', 'coalesce')
+    asyncio.ensure_future(realtime_loop(middleware))
+    asyncio.ensure_future(zilstat_loop(middleware))
@@ -1,13 +1,69 @@
+from datetime import datetime
+from lockfile import LockFile
+
 import errno
+import logging
+import pickle
 import socket
 import ssl
+import uuid
 
 from middlewared.schema import Dict, Int, Str, accepts
-from middlewared.service import CallError, CRUDService, filterable
+from middlewared.service import CallError, CRUDService, filterable, private
 
-from pyVim import connect
+from pyVim import connect, task as VimTask
 from pyVmomi import vim
 
+logger = logging.getLogger(__name__)
+
+VMWARE_FAILS = '/var/tmp/.vmwaresnap_fails'
+VMWARELOGIN_FAILS = '/var/tmp/.vmwarelogin_fails'
+VMWARESNAPDELETE_FAILS = '/var/tmp/.vmwaresnapdelete_fails'
+
+
+def vm_depends_on_datastore(vm, datastore):
+    """
+    Check if a VM has its configuration or any disk on `datastore`.
+    """
+    try:
+        for i in vm.datastore:
+            if i.info.name.startswith(datastore):
+                return True
+        for device in vm.config.hardware.device:
+            if device.backing is None:
+                continue
+            if hasattr(device.backing, 'fileName'):
+                if device.backing.datastore.info.name == datastore:
+                    return True
+    except Exception:
+        logger.debug('Exception in vm_depends_on_datastore', exc_info=True)
+    return False
+
+
+def vm_can_snapshot(vm):
+    """
+    VMs using PCI pass-through devices cannot be snapshotted.
+    """
+    try:
+        for device in vm.config.hardware.device:
+            if isinstance(device, vim.VirtualPCIPassthrough):
+                return False
+    except Exception:
+        logger.debug('Exception in vm_can_snapshot', exc_info=True)
+    return True
+
+
+def vm_find_snapshot(vm, name):
+    try:
+        tree = vm.snapshot.rootSnapshotList if vm.snapshot else []
+        while tree:
+            if tree[0].name == name:
+                return tree[0].snapshot
+            tree = tree[0].childSnapshotList
+    except Exception:
+        logger.debug('Exception in vm_find_snapshot', exc_info=True)
+    return None
+
 
 class VMWareService(CRUDService):
 
@@ -123,3 +179,154 @@ class VMWareService(CRUDService):
             }
             vms[vm.config.uuid] = data
         return vms
+
+    def _connect(self, item):
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ssl_context.verify_mode = ssl.CERT_NONE
+        return connect.SmartConnect(
+            host=item['hostname'],
+            user=item['username'],
+            pwd=item['password'],
+            sslContext=ssl_context,
+        )
+
+    def _update_fails(self, path, snapname, fails):
+        try:
+            with LockFile(path):
+                with open(path, 'rb') as f:
+                    data = pickle.load(f)
+        except Exception:
+            data = {}
+        data[snapname] = fails
+        with LockFile(path):
+            with open(path, 'wb') as f:
+                pickle.dump(data, f)
+
+    @private
+    def snapshot_begin(self, dataset, snapname, recursive):
+        """
+        Take VMware snapshots of the powered on VMs using the datastores
+        mapped to `dataset` (or any child dataset if `recursive`) before
+        the ZFS snapshot `snapname` is taken.
+
+        Returns a context to be handed to `vmware.snapshot_end` once the ZFS
+        snapshot exists, or None if there is nothing to snapshot.
+        """
+        items = [
+            i for i in self.middleware.call_sync('vmware.query')
+            if i['filesystem'] == dataset or (recursive and i['filesystem'].startswith(f'{dataset}/'))
+        ]
+        if not items:
+            return None
+
+        # Unique name that won't collide with anything on the VMware side and
+        # a description to track down dangling snapshots.
+        context = {
+            'vmsnapname': str(uuid.uuid4()),
+            'snapname': snapname,
+            'hosts': [],
+        }
+        vmsnapdescription = f'{str(datetime.now()).split(".")[0]} FreeNAS Created Snapshot'
+        login_fails = {}
+        for item in items:
+            host = {'item': item, 'vms': [], 'fails': [], 'skips': []}
+            context['hosts'].append(host)
+            try:
+                si = self._connect(item)
+                content = si.RetrieveContent()
+            except Exception as e:
+                self.logger.warn('VMware login failed to %s', item['hostname'], exc_info=True)
+                login_fails[item['id']] = getattr(e, 'msg', str(e))
+                continue
+
+            vm_view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+            for vm in vm_view.view:
+                # There is no point to consider VMs that are paused or powered off.
+                if vm.summary.runtime.powerState != 'poweredOn':
+                    continue
+                if not vm_depends_on_datastore(vm, item['datastore']):
+                    continue
+                try:
+                    if not vm_can_snapshot(vm):
+                        self.logger.info(
+                            'Can\'t snapshot VM %s that depends on datastore %s and dataset %s. '
+                            'Possibly using PT devices. Skipping.', vm.name, item['datastore'], dataset,
+                        )
+                        host['skips'].append(vm.config.uuid)
+                    elif vm_find_snapshot(vm, context['vmsnapname']) is None:
+                        # A VM using two datastores mapped to the same dataset
+                        # has been snapshotted already in this run.
+                        VimTask.WaitForTask(vm.CreateSnapshot_Task(
+                            name=context['vmsnapname'],
+                            description=vmsnapdescription,
+                            memory=False, quiesce=False,
+                        ))
+                except Exception:
+                    self.logger.warn('Snapshot of VM %s failed', vm.name, exc_info=True)
+                    host['fails'].append([vm.config.uuid, vm.name])
+                host['vms'].append(vm.config.uuid)
+            connect.Disconnect(si)
+
+        try:
+            with LockFile(VMWARELOGIN_FAILS):
+                with open(VMWARELOGIN_FAILS, 'wb') as f:
+                    pickle.dump(login_fails, f)
+        except Exception:
+            self.logger.debug('Failed to write vmware login fails file', exc_info=True)
+
+        # Record failures where the alert system can find them.
+        for host in context['hosts']:
+            if not host['fails']:
+                continue
+            fails = [i[1] for i in host['fails']]
+            self._update_fails(VMWARE_FAILS, snapname, fails)
+            self.middleware.call_sync('mail.send', {
+                'subject': f'VMware Snapshot failed! ({snapname})',
+                'text': f'\nHello,\n    The following VM failed to snapshot {snapname}:\n' + '    \n'.join(fails) + '\n',
+                'channel': 'snapvmware',
+            })
+
+        # The ZFS snapshot only has consistent VM snapshots inside it if
+        # every host got some VM snapshotted without any failure.
+        context['vmsynced'] = all(h['vms'] and not h['fails'] for h in context['hosts'])
+        return context
+
+    @private
+    def snapshot_end(self, context):
+        """
+        Remove the VMware snapshots taken by `vmware.snapshot_begin`, having
+        them around impacts the performance of the VMs.
+        """
+        snapname = context['snapname']
+        for host in context['hosts']:
+            try:
+                si = self._connect(host['item'])
+            except Exception:
+                self.logger.warn('VMware login failed to %s', host['item']['hostname'], exc_info=True)
+                continue
+
+            delete_fails = []
+            failed = {i[0] for i in host['fails']}
+            for vm_uuid in host['vms']:
+                if vm_uuid in failed or vm_uuid in host['skips']:
+                    continue
+                vm = si.content.searchIndex.FindByUuid(None, vm_uuid, True)
+                if not vm:
+                    self.logger.debug('Could not find VM %s', vm_uuid)
+                    continue
+                try:
+                    snap = vm_find_snapshot(vm, context['vmsnapname'])
+                    if snap is not None:
+                        VimTask.WaitForTask(snap.RemoveSnapshot_Task(True))
+                except Exception:
+                    self.logger.debug('Exception removing snapshot %s %s', vm.name, context['vmsnapname'], exc_info=True)
+                    delete_fails.append(vm.name)
+
+            if delete_fails:
+                self._update_fails(VMWARESNAPDELETE_FAILS, snapname, delete_fails)
+                self.middleware.call_sync('mail.send', {
+                    'subject': f'VMware Snapshot deletion failed! ({snapname})',
+                    'text': f'\nHello,\n    The following VM snapshot(s) failed to delete {snapname}:\n' + '    \n'.join(delete_fails) + '\n',
+                    'channel': 'snapvmware',
+                })
+            connect.Disconnect(si)
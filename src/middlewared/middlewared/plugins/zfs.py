@@ -1,6 +1,7 @@
 import os
 import errno
 import socket
+import subprocess
 import textwrap
 import threading
 import time
@@ -40,6 +41,8 @@ class ZFSPoolService(Service):
 
     class Config:
         namespace = 'zfs.pool'
+        threadpool = 'zfs'
+        threadpool_workers = 4
         private = True
 
     @accepts(Str('pool'))
@@ -50,7 +53,7 @@ class ZFSPoolService(Service):
         except libzfs.ZFSException as e:
             raise CallError(str(e), errno.ENOENT)
 
-        await self.middleware.threaded(geom.scan)
+        await self.middleware.threaded(geom.scan, pool='zfs')
         labelclass = geom.class_by_name('LABEL')
         for absdev in zpool.disks:
             dev = absdev.replace('/dev/', '').replace('.eli', '')
@@ -183,6 +186,8 @@ class ZFSSnapshot(CRUDService):
 
     class Config:
         namespace = 'zfs.snapshot'
+        threadpool = 'zfs'
+        threadpool_workers = 4
 
     @accepts(Dict(
         'snapshot_create',
@@ -229,6 +234,62 @@ class ZFSSnapshot(CRUDService):
                 self.logger.error("{0}".format(err))
                 return False
 
+    @accepts(List('snapshots', items=[Dict(
+        'snapshot_batch',
+        Str('dataset', required=True),
+        Str('name', required=True),
+        Bool('recursive', default=False),
+        Bool('vmsynced', default=False),
+    )]))
+    def create_batch(self, snapshots):
+        """
+        Take snapshots of many datasets at once.
+
+        Snapshots of the same pool sharing the same `recursive` and `vmsynced`
+        flags are taken by a single `zfs snapshot` (zfs_snapshot_nvl), landing
+        in the same transaction group and thus being crash-consistent with
+        each other.
+        If that fails each snapshot of the group is retried on its own so
+        one bad dataset does not hold back the others.
+
+        Returns:
+            list: {dataset, name, success, error} for every snapshot, in order.
+        """
+        results = [
+            {'dataset': s['dataset'], 'name': s['name'], 'success': False, 'error': None}
+            for s in snapshots
+        ]
+        groups = {}
+        for i, s in enumerate(snapshots):
+            groups.setdefault((s['dataset'].split('/')[0], s['recursive'], s['vmsynced']), []).append(i)
+
+        for (pool, recursive, vmsynced), indexes in groups.items():
+            args = ['/sbin/zfs', 'snapshot']
+            if recursive:
+                args.append('-r')
+            if vmsynced:
+                args += ['-o', 'freenas:vmsynced=Y']
+            args += [f'{snapshots[i]["dataset"]}@{snapshots[i]["name"]}' for i in indexes]
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8')
+            err = proc.communicate()[1]
+            if proc.returncode == 0:
+                for i in indexes:
+                    results[i]['success'] = True
+                continue
+
+            if len(indexes) > 1:
+                self.logger.debug('Batch snapshot failed, retrying one at a time: %s', err)
+            fsopts = {'freenas:vmsynced': 'Y'} if vmsynced else {}
+            zfs = libzfs.ZFS()
+            for i in indexes:
+                name = f'{snapshots[i]["dataset"]}@{snapshots[i]["name"]}'
+                try:
+                    zfs.get_dataset(snapshots[i]['dataset']).snapshot(name, fsopts=fsopts, recursive=recursive)
+                    results[i]['success'] = True
+                except libzfs.ZFSException as e:
+                    results[i]['error'] = str(e)
+        return results
+
     @accepts(Dict(
         'snapshot_remove',
         Str('dataset'),
@@ -315,6 +376,8 @@ class ZFSQuoteService(Service):
 
     class Config:
         namespace = 'zfs.quota'
+        threadpool = 'zfs'
+        threadpool_workers = 4
         private = True
 
     def __init__(self, middleware):
@@ -387,7 +450,7 @@ class ZFSQuoteService(Service):
     async def __get_quota_excess(self):
         excess = []
         zfs = libzfs.ZFS()
-        for properties in await self.middleware.threaded(lambda: [i.properties for i in zfs.datasets]):
+        for properties in await self.middleware.threaded(lambda: [i.properties for i in zfs.datasets], pool='zfs'):
             quota = properties.get("quota")
             # zvols do not have a quota property in libzfs
             if quota is None or quota.value == "none":
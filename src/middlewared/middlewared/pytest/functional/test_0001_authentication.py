@@ -1,4 +1,5 @@
 import pytest
+import requests
 
 
 invalid_users = [['root', '123'], ['test', 'test']]
@@ -27,3 +28,24 @@ def test_generate_token(conn, data_random):
     assert isinstance(generate_token.json(), str) is True
 
     assert conn.ws.call('auth.token', generate_token.json()) is True
+
+
+def test_rest_token_auth(conn):
+    token = conn.ws.call('auth.generate_token')
+    url = conn.rest.uri + conn.rest.base_path + 'core/ping'
+
+    req = requests.get(url, headers={'Authorization': f'Token {token}'})
+    assert req.status_code == 200
+    assert req.json() == 'pong'
+
+    req = requests.get(url, headers={'Authorization': 'Token invalid'})
+    assert req.status_code == 401
+
+
+def test_token_stats(conn):
+    before = conn.ws.call('auth.token_stats')
+    conn.ws.call('auth.generate_token', 60)
+    after = conn.ws.call('auth.token_stats')
+
+    assert after['created'] == before['created'] + 1
+    assert after['tokens'] >= 1
@@ -24,3 +24,39 @@ def test_ping(conn):
 
     assert ping.status_code == 200
     assert ping.json() == 'pong'
+
+
+def test_get_jobs_history_paginated(conn):
+    jobs = conn.ws.call('core.get_jobs', [], {
+        'order_by': ['-id'], 'limit': 2, 'extra': {'history': True},
+    })
+    assert len(jobs) <= 2
+
+    if jobs:
+        older = conn.ws.call('core.get_jobs', [['id', '<', jobs[-1]['id']]], {
+            'order_by': ['-id'], 'limit': 2, 'extra': {'history': True},
+        })
+        assert all(i['id'] < jobs[-1]['id'] for i in older)
+
+
+def test_get_jobs_history_filter_not_indexed(conn):
+    # `state` has an index, `progress` is only in the encoded job
+    jobs = conn.ws.call('core.get_jobs', [['state', '=', 'SUCCESS'], ['progress.percent', '=', 100]], {
+        'order_by': ['-id'], 'limit': 3, 'extra': {'history': True},
+    })
+    assert len(jobs) <= 3
+    assert all(i['state'] == 'SUCCESS' and i['progress']['percent'] == 100 for i in jobs)
+    assert [i['id'] for i in jobs] == sorted((i['id'] for i in jobs), reverse=True)
+
+    count = conn.ws.call('core.get_jobs', [['progress.percent', '=', 100]], {
+        'count': True, 'extra': {'history': True},
+    })
+    assert isinstance(count, int)
+
+
+def test_benchmark_accepts(conn):
+    results = conn.ws.call('core.benchmark_accepts', 10)
+
+    assert isinstance(results, list)
+    assert all(i['usec'] >= 0 for i in results)
+    assert [i['usec'] for i in results] == sorted([i['usec'] for i in results], reverse=True)
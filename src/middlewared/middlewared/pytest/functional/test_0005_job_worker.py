@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import types
+
+import pytest
+
+worker = pytest.importorskip('middlewared.worker')
+
+
+class FakeWorker(object):
+
+    def __init__(self, fail):
+        self.fail = fail
+        self.running = False
+
+    async def start(self):
+        if self.fail:
+            raise OSError('fork failed')
+        self.running = True
+
+    def alive(self):
+        return self.running
+
+    async def stop(self):
+        self.running = False
+
+    def kill(self):
+        self.running = False
+
+
+class FakePool(worker.JobWorkerPool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail = False
+
+    def _worker_factory(self):
+        return FakeWorker(self.fail)
+
+
+def _pool(size=1):
+    return FakePool(types.SimpleNamespace(logger=logging.getLogger(__name__)), size=size)
+
+
+def test_job_worker_pool_spawn_failure_does_not_hang():
+    async def run():
+        pool = _pool()
+        pool.fail = True
+        await pool.start()
+        assert pool.workers == []
+        assert pool.spawn_failures == 1
+        with pytest.raises(worker.JobWorkerUnavailable):
+            await asyncio.wait_for(pool.run(None), 1)
+        await pool.terminate()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_job_worker_pool_wakes_waiters_when_empty():
+    async def run():
+        pool = _pool()
+        await pool.start()
+        # The only worker is busy and dies, its replacement fails to start
+        busy = await pool.idle.get()
+        waiter = asyncio.ensure_future(pool.run(None))
+        await asyncio.sleep(0)
+        pool.fail = True
+        await pool._JobWorkerPool__replace(busy)
+        with pytest.raises(worker.JobWorkerUnavailable):
+            await asyncio.wait_for(waiter, 1)
+        await pool.terminate()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_job_worker_pool_respawns_with_backoff():
+    async def run():
+        pool = _pool()
+        pool.fail = True
+        await pool.start()
+        assert pool.respawn_delay == worker.RESPAWN_DELAY * 2
+        pool.fail = False
+        await asyncio.sleep(worker.RESPAWN_DELAY + 0.2)
+        assert len(pool.workers) == 1
+        assert pool.respawn_delay == worker.RESPAWN_DELAY
+        await pool.terminate()
+
+    asyncio.get_event_loop().run_until_complete(run())
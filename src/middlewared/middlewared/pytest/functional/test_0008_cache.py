@@ -39,3 +39,27 @@ def test_cache_pop(conn, kv):
     key, value = kv
     pop = conn.ws.call('cache.pop', key)
     assert pop == value
+
+
+def test_cache_get_or_set(conn):
+    value = conn.ws.call('cache.get_or_set', 'test.ping', 'core.ping', [])
+    assert value == 'pong'
+    assert conn.ws.call('cache.get', 'test.ping') == 'pong'
+    conn.ws.call('cache.pop', 'test.ping')
+
+
+def test_cache_invalidate(conn):
+    conn.ws.call('cache.put', 'test.key1', 1)
+    conn.ws.call('cache.put', 'test.key2', 2)
+    conn.ws.call('cache.put', 'testing', 3)
+
+    assert conn.ws.call('cache.invalidate', 'test') == 2
+    assert conn.ws.call('cache.has_key', 'test.key1') is False
+    assert conn.ws.call('cache.has_key', 'testing') is True
+    conn.ws.call('cache.pop', 'testing')
+
+
+def test_cache_stats(conn):
+    stats = conn.ws.call('cache.stats')
+    assert stats['hits'] > 0
+    assert stats['misses'] > 0
@@ -36,6 +36,12 @@ def test_disk_sync_all(conn):
     conn.ws.call('disk.sync_all')
 
 
+def test_disk_sync_all_unchanged(conn):
+    before = conn.ws.call('datastore.query', 'storage.disk')
+    conn.ws.call('disk.sync_all')
+    assert conn.ws.call('datastore.query', 'storage.disk') == before
+
+
 def test_disk_multipath_sync(conn):
     conn.ws.call('disk.multipath_sync')
 
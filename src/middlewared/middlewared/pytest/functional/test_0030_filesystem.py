@@ -1,3 +1,7 @@
+import base64
+import hashlib
+
+
 def test_filesystem_listdir(conn):
     req = conn.rest.post('filesystem/listdir', data=['/boot'])
 
@@ -17,9 +21,35 @@ def test_filesystem_listdir(conn):
         raise AssertionError('/boot/kernel not found')
 
 
+def test_filesystem_listdir_paginated(conn):
+    names = sorted(e['name'] for e in conn.ws.call('filesystem.listdir', '/boot', [], {'select': ['name']}))
+
+    page = conn.ws.call('filesystem.listdir', '/boot', [], {'select': ['name', 'type'], 'limit': 2})
+    assert [e['name'] for e in page] == names[:2]
+    assert set(page[0].keys()) == {'name', 'type'}
+
+    page = conn.ws.call('filesystem.listdir', '/boot', [], {
+        'select': ['name'], 'limit': 2, 'extra': {'cursor': page[-1]['name']},
+    })
+    assert [e['name'] for e in page] == names[2:4]
+
+
 def test_filesystem_stat(conn):
     req = conn.rest.post('filesystem/stat', data=['/data/freenas-v1.db'])
 
     assert req.status_code == 200
     stat = req.json()
     assert isinstance(stat, dict) is True
+
+
+def test_filesystem_file_receive_chunks(conn):
+    path = '/tmp/test_filesystem_chunks'
+    conn.ws.call('filesystem.file_receive', path, base64.b64encode(b'foo').decode())
+    conn.ws.call('filesystem.file_receive', path, base64.b64encode(b'bar').decode(), {
+        'offset': 3,
+        'checksum': hashlib.sha256(b'bar').hexdigest(),
+    })
+
+    assert conn.ws.call('filesystem.file_get_contents', path, {'offset': 3}) == base64.b64encode(b'bar').decode()
+    assert conn.ws.call('filesystem.checksum', path) == hashlib.sha256(b'foobar').hexdigest()
+    assert conn.ws.call('filesystem.checksum', path, {'offset': 1, 'length': 2}) == hashlib.sha256(b'oo').hexdigest()
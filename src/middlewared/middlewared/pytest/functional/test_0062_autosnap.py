@@ -0,0 +1,122 @@
+from datetime import datetime, time
+
+from middlewared.snapshot_schedule import (
+    AutoSnapshotIndex, due_snapshots, expire_match, is_matching_time, snap_time,
+)
+
+
+def _task(filesystem, ret_count=1, ret_unit='hour', recursive=False, interval=60, **kwargs):
+    task = {
+        'id': 1,
+        'task_filesystem': filesystem,
+        'task_recursive': recursive,
+        'task_ret_count': ret_count,
+        'task_ret_unit': ret_unit,
+        'task_interval': interval,
+        'task_begin': time(0, 0),
+        'task_end': time(23, 59),
+        'task_repeat_unit': 'daily',
+        'task_byweekday': '1,2,3,4,5,6,7',
+    }
+    task.update(kwargs)
+    return task
+
+
+def test_autosnap_index_stats(conn):
+    conn.ws.call('autosnap.rescan')
+    stats = conn.ws.call('autosnap.index_stats')
+    assert stats['datasets'] >= 0
+    assert stats['snapshots'] >= 0
+
+
+def test_snap_time_rounding():
+    assert snap_time(datetime(2017, 5, 1, 10, 15, 29, 999999)) == datetime(2017, 5, 1, 10, 15)
+    assert snap_time(datetime(2017, 5, 1, 10, 15, 30)) == datetime(2017, 5, 1, 10, 16)
+    # Rounding up crosses hour and day boundaries
+    assert snap_time(datetime(2017, 5, 1, 23, 59, 45)) == datetime(2017, 5, 2, 0, 0)
+
+
+def test_is_matching_time_wraps_midnight():
+    task = _task('tank', task_begin=time(22, 0), task_end=time(2, 0))
+    assert is_matching_time(task, datetime(2017, 5, 1, 22, 0))
+    assert is_matching_time(task, datetime(2017, 5, 1, 23, 30))
+    assert is_matching_time(task, datetime(2017, 5, 2, 0, 30))
+    assert is_matching_time(task, datetime(2017, 5, 2, 2, 0))
+    assert not is_matching_time(task, datetime(2017, 5, 2, 2, 1))
+    assert not is_matching_time(task, datetime(2017, 5, 2, 12, 0))
+
+
+def test_is_matching_time_weekly():
+    # 2017-05-01 is a Monday (1)
+    task = _task('tank', task_repeat_unit='weekly', task_byweekday='1,3')
+    assert is_matching_time(task, datetime(2017, 5, 1, 12, 0))
+    assert not is_matching_time(task, datetime(2017, 5, 2, 12, 0))
+    assert is_matching_time(task, datetime(2017, 5, 3, 12, 0))
+
+
+def test_expired_recursive_parent_hides_children():
+    index = AutoSnapshotIndex([
+        'tank', 'tank/a', 'tank/b',
+        'tank@auto-20170501.1000-1h',
+        'tank/a@auto-20170501.1000-1h',
+        'tank/b@auto-20170501.1000-1h',
+        'tank/b@auto-20170501.0900-1h',
+        'tank/b@manual-20170501.0900',
+    ])
+    pending = index.expired(datetime(2017, 5, 1, 12, 0), expire_match([_task('tank', recursive=True)]))
+    # Children snapshots named like a pending parent one go with its
+    # recursive destroy, only tank/b has one of its own
+    assert pending == {
+        'tank': ['auto-20170501.1000-1h'],
+        'tank/b': ['auto-20170501.0900-1h'],
+    }
+
+
+def test_expired_cutoff_boundary():
+    index = AutoSnapshotIndex([
+        'tank@auto-20170501.1000-1h',
+        'tank@auto-20170501.1001-1h',
+    ])
+    match = expire_match([_task('tank')])
+    # Expires exactly when its retention elapses, not a minute before
+    assert index.expired(datetime(2017, 5, 1, 10, 59), match) == {}
+    assert index.expired(datetime(2017, 5, 1, 11, 0), match) == {'tank': ['auto-20170501.1000-1h']}
+    assert index.expired(datetime(2017, 5, 1, 11, 1), match) == {
+        'tank': ['auto-20170501.1000-1h', 'auto-20170501.1001-1h'],
+    }
+
+
+def test_expired_only_matching_datasets():
+    index = AutoSnapshotIndex([
+        'tank@auto-20170501.1000-1h',
+        'tank/a@auto-20170501.1000-1h',
+        'other@auto-20170501.1000-1h',
+    ])
+    pending = index.expired(datetime(2017, 5, 2, 0, 0), expire_match([_task('tank/a')]))
+    assert pending == {'tank/a': ['auto-20170501.1000-1h']}
+
+
+def test_due_same_retention_is_one_snapshot():
+    index = AutoSnapshotIndex(['tank@auto-20170501.1000-1h'])
+    tasks = [_task('tank', interval=60), _task('tank', interval=15)]
+    # The 15 minutes interval task makes the shared snapshot due
+    assert due_snapshots(tasks, index, datetime(2017, 5, 1, 10, 15)) == [('tank', '1h', False)]
+    assert due_snapshots(tasks[:1], index, datetime(2017, 5, 1, 10, 15)) == []
+    assert due_snapshots(tasks[:1], index, datetime(2017, 5, 1, 11, 0)) == [('tank', '1h', False)]
+
+
+def test_due_recursive_covers_nonrecursive():
+    index = AutoSnapshotIndex(['tank', 'tank/a'])
+    tasks = [
+        _task('tank', recursive=True),
+        _task('tank/a'),
+        _task('tank/a', ret_count=2),
+        _task('tankfoo'),
+    ]
+    # tank/a with the same retention would collide with the recursive one,
+    # a different retention or a sibling sharing the prefix does not
+    assert due_snapshots(tasks, index, datetime(2017, 5, 1, 10, 0)) == [
+        ('tank', '1h', True),
+        ('tank/a', '2h', False),
+        ('tankfoo', '1h', False),
+    ]
@@ -0,0 +1,30 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def pool(conn):
+    pools = conn.ws.call('pool.query')
+    if not pools:
+        pytest.skip('No pool available')
+    return pools[0]['name']
+
+
+def test_snapshot_create_batch(conn, pool):
+    snapshots = [
+        {'dataset': pool, 'name': 'test-batch-a', 'vmsynced': True},
+        {'dataset': f'{pool}/test-batch-missing', 'name': 'test-batch-a', 'vmsynced': True},
+        {'dataset': pool, 'name': 'test-batch-b'},
+    ]
+    try:
+        results = conn.ws.call('zfs.snapshot.create_batch', snapshots)
+
+        assert [(r['dataset'], r['name']) for r in results] == [(s['dataset'], s['name']) for s in snapshots]
+        # The missing dataset fails its batch, the other snapshot in it is
+        # retried on its own
+        assert results[0]['success'] is True
+        assert results[1]['success'] is False
+        assert results[1]['error']
+        assert results[2]['success'] is True
+    finally:
+        for name in ('test-batch-a', 'test-batch-b'):
+            conn.ws.call('zfs.snapshot.remove', {'dataset': pool, 'name': name})
@@ -13,6 +13,23 @@ def test_service_query(conn):
     assert isinstance(req.json(), list) is True
 
 
+def test_service_query_paginated(conn):
+    all_services = conn.ws.call('service.query', [], {'order_by': ['service']})
+    page = conn.ws.call('service.query', [], {
+        'order_by': ['service'], 'offset': 1, 'limit': 2, 'select': ['service'],
+    })
+
+    assert page == [{'service': i['service']} for i in all_services[1:3]]
+
+
+def test_service_query_filters(conn):
+    services = conn.ws.call('service.query', [
+        ['OR', [['service', '~', '^nf'], ['service', 'in', ['afp', 'cifs']]]],
+    ])
+
+    assert sorted(i['service'] for i in services) == ['afp', 'cifs', 'nfs']
+
+
 def test_service_update(conn):
     req = conn.rest.get('service')
 
@@ -38,3 +38,11 @@ def test_stats_get_data(conn):
             ])
             assert req.status_code == 200
             assert isinstance(req.json(), dict) is True
+
+
+def test_stats_get_zilstat(conn):
+    zilstat = conn.ws.call('stats.get_zilstat')
+    assert set(zilstat.keys()) == {'1', '5', '10'}
+    for window in zilstat.values():
+        assert window['ops'] >= 0
+        assert window['bytes'] >= 0
@@ -10,8 +10,17 @@ from .client import ejson as json
 
 
 async def authenticate(middleware, req):
-
+    """
+    Authenticate a request using either HTTP Basic (username and
+    password) or a token from `auth.generate_token`, e.g.
+    "Authorization: Token <token>".
+    """
     auth = req.headers.get('Authorization')
+    if auth is not None and auth.startswith('Token '):
+        if not await middleware.call('auth.check_token', auth[6:].strip()):
+            raise web.HTTPUnauthorized()
+        return
+
     if auth is None or not auth.startswith('Basic '):
         raise web.HTTPUnauthorized()
     try:
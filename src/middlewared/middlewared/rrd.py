@@ -0,0 +1,345 @@
+"""
+In-process reader of RRD files, as written by rrdtool/collectd.
+
+It only supports what the stats plugin needs: reading the header (data
+sources, archives) and exporting data points of a data source in the same
+shape as `rrdtool xport --json` does, without forking rrdtool.
+"""
+from collections import namedtuple
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+RRD_COOKIE = b'RRD\x00'
+RRD_FLOAT_COOKIE = 8.642135E130
+RRD_VERSIONS = (b'0003', b'0004')
+
+# Native layouts of the rrd_format.h structures
+STAT_HEAD = struct.Struct('@4s5sdLLL10d')
+DS_DEF = struct.Struct('@20s20s10d')
+RRA_DEF = struct.Struct('@20sLL10d')
+LIVE_HEAD = struct.Struct('@ll')
+PDP_PREP = struct.Struct('@30s10d')
+CDP_PREP = struct.Struct('@10d')
+RRA_PTR = struct.Struct('@L')
+VALUE = struct.Struct('@d')
+
+RE_TIME_OFFSET = re.compile(r'([+-])\s*(\d+)\s*([a-z]*)')
+TIME_UNITS = {
+    '': 1, 's': 1, 'sec': 1, 'second': 1, 'seconds': 1,
+    'm': 60, 'min': 60, 'minute': 60, 'minutes': 60,
+    'h': 3600, 'hour': 3600, 'hours': 3600,
+    'd': 86400, 'day': 86400, 'days': 86400,
+    'w': 604800, 'week': 604800, 'weeks': 604800,
+    'mon': 2592000, 'month': 2592000, 'months': 2592000,
+    'y': 31536000, 'year': 31536000, 'years': 31536000,
+}
+
+DataSource = namedtuple('DataSource', ['name', 'type'])
+Archive = namedtuple('Archive', ['cf', 'rows', 'pdp_cnt', 'step', 'offset'])
+
+
+class RRDError(Exception):
+    pass
+
+
+def _cstr(value):
+    return value.split(b'\x00', 1)[0].decode()
+
+
+def parse_time(spec, now=None, start=None, end=None):
+    """
+    Parse a subset of the rrdfetch(1) AT-STYLE time specification:
+    an epoch, or "now", "start" or "end" followed by offsets,
+    e.g. "now-1h", "end-1d+30min".
+
+    Raises:
+        RRDError: specification is not supported
+    """
+    spec = spec.strip().lower()
+    if spec.isdigit():
+        return int(spec)
+
+    for name, value in (('now', now or int(time.time())), ('start', start), ('end', end)):
+        if spec.startswith(name):
+            if value is None:
+                raise RRDError(f'Time reference "{name}" is not available')
+            spec = spec[len(name):]
+            break
+    else:
+        raise RRDError(f'Unsupported time specification: {spec}')
+
+    pos = 0
+    for reg in RE_TIME_OFFSET.finditer(spec):
+        if reg.start() != pos or reg.group(3) not in TIME_UNITS:
+            raise RRDError(f'Unsupported time specification: {spec}')
+        offset = int(reg.group(2)) * TIME_UNITS[reg.group(3)]
+        value += offset if reg.group(1) == '+' else -offset
+        pos = reg.end()
+    if spec[pos:].strip():
+        raise RRDError(f'Unsupported time specification: {spec}')
+    return value
+
+
+class RRDHeader(object):
+    """
+    Static and live header of a RRD file.
+    """
+
+    def __init__(self, buf):
+        if len(buf) < STAT_HEAD.size:
+            raise RRDError('File too short')
+        head = STAT_HEAD.unpack_from(buf, 0)
+        cookie, version, float_cookie, ds_cnt, rra_cnt, pdp_step = head[:6]
+        if cookie != RRD_COOKIE:
+            raise RRDError('Not a RRD file')
+        if version[:4] not in RRD_VERSIONS:
+            raise RRDError(f'Unsupported RRD version {version[:4]}')
+        if float_cookie != RRD_FLOAT_COOKIE:
+            raise RRDError('RRD file was created on a different architecture')
+
+        self.step = pdp_step
+        offset = STAT_HEAD.size
+
+        self.datasources = []
+        for i in range(ds_cnt):
+            ds = DS_DEF.unpack_from(buf, offset)
+            self.datasources.append(DataSource(_cstr(ds[0]), _cstr(ds[1])))
+            offset += DS_DEF.size
+
+        rra_defs = []
+        for i in range(rra_cnt):
+            rra_defs.append(RRA_DEF.unpack_from(buf, offset))
+            offset += RRA_DEF.size
+
+        self.last_update = LIVE_HEAD.unpack_from(buf, offset)[0]
+        offset += LIVE_HEAD.size
+        offset += PDP_PREP.size * ds_cnt
+        offset += CDP_PREP.size * ds_cnt * rra_cnt
+
+        self.cur_rows = []
+        for i in range(rra_cnt):
+            self.cur_rows.append(RRA_PTR.unpack_from(buf, offset)[0])
+            offset += RRA_PTR.size
+
+        self.archives = []
+        for cf, rows, pdp_cnt, *par in rra_defs:
+            self.archives.append(Archive(_cstr(cf), rows, pdp_cnt, pdp_cnt * pdp_step, offset))
+            offset += rows * ds_cnt * VALUE.size
+
+        if offset > len(buf):
+            raise RRDError('File is truncated')
+
+    def ds_index(self, name):
+        for i, ds in enumerate(self.datasources):
+            if ds.name == name:
+                return i
+        raise RRDError(f'Unknown data source {name}')
+
+    def choose_archive(self, cf, start, end, step):
+        """
+        Choose the archive to fetch from the same way rrd_fetch does: the one
+        covering the whole interval with step closest to `step`, otherwise
+        the one covering most of it.
+        """
+        best_full = best_partial = None
+        best_full_diff = best_partial_diff = None
+        best_partial_match = None
+        for index, rra in enumerate(self.archives):
+            if rra.cf != cf:
+                continue
+            cal_end = self.last_update - self.last_update % rra.step
+            cal_start = cal_end - rra.step * rra.rows
+            diff = abs(step - rra.step)
+            if cal_start <= start and cal_end >= end:
+                if best_full is None or diff < best_full_diff:
+                    best_full, best_full_diff = index, diff
+            else:
+                match = (end - start) - max(0, cal_start - start) - max(0, end - cal_end)
+                if (
+                    best_partial is None or match > best_partial_match or
+                    (match == best_partial_match and diff < best_partial_diff)
+                ):
+                    best_partial, best_partial_diff, best_partial_match = index, diff, match
+        index = best_full if best_full is not None else best_partial
+        if index is None:
+            raise RRDError(f'No archive with consolidation function {cf}')
+        return index
+
+
+class RRDFile(object):
+    """
+    A memory-mapped RRD file.
+
+    Headers are cached by path and modification time so they are only
+    decoded again after collectd has updated the file.
+    """
+
+    _headers = {}
+    _headers_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            st = os.fstat(self.fd)
+            self.mm = mmap.mmap(self.fd, st.st_size, access=mmap.ACCESS_READ)
+            self.header = self.__header(st)
+        except Exception:
+            if hasattr(self, 'mm'):
+                self.mm.close()
+            os.close(self.fd)
+            raise
+
+    def __header(self, st):
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._headers_lock:
+            cached = self._headers.get(self.path)
+        if cached and cached[0] == key:
+            return cached[1]
+        header = RRDHeader(self.mm)
+        with self._headers_lock:
+            self._headers[self.path] = (key, header)
+        return header
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.close()
+
+    def fetch(self, ds, cf, start, end, step):
+        """
+        Fetch data points of data source `ds` in the interval (`start`, `end`].
+
+        Returns a tuple of (start, end, step, values) where `step` is the step
+        of the chosen archive and values[i] is the consolidated value of the
+        interval ending at start + (i + 1) * step.
+        """
+        header = self.header
+        ds_index = header.ds_index(ds)
+        index = header.choose_archive(cf, start, end, step)
+        rra = header.archives[index]
+        step = rra.step
+        start -= start % step
+        end += (step - end % step) % step
+
+        ds_cnt = len(header.datasources)
+        cur_row = header.cur_rows[index]
+        rra_end = header.last_update - header.last_update % step
+        rra_start = rra_end - step * rra.rows
+
+        # A strided view over the archive ring buffer for our data source,
+        # slicing it decodes only the rows we are interested in.
+        column = memoryview(self.mm)[
+            rra.offset:rra.offset + rra.rows * ds_cnt * VALUE.size
+        ].cast('d')[ds_index::ds_cnt]
+        try:
+            values = self.__read(column, rra, cur_row, rra_start, rra_end, start, end, step)
+        finally:
+            # The file can not be closed while views are exported
+            column.release()
+        return start, end, step, values
+
+    def __read(self, column, rra, cur_row, rra_start, rra_end, start, end, step):
+        values = []
+        t = start + step
+        if t <= rra_start:
+            missing = min((rra_start - t) // step + 1, (end - t) // step + 1)
+            values.extend([math.nan] * missing)
+            t += missing * step
+        if t <= rra_end and t <= end:
+            last = min(end, rra_end)
+            count = (last - t) // step + 1
+            first_row = (cur_row - (rra_end - t) // step) % rra.rows
+            if first_row + count <= rra.rows:
+                values.extend(column[first_row:first_row + count].tolist())
+            else:
+                values.extend(column[first_row:].tolist())
+                values.extend(column[:count - (rra.rows - first_row)].tolist())
+            t += count * step
+        if t <= end:
+            values.extend([math.nan] * ((end - t) // step + 1))
+        return values
+
+
+def consolidate(values, factor, cf):
+    """
+    Consolidate every `factor` values into one using `cf`, ignoring NaNs.
+    """
+    if factor == 1:
+        return values
+    rv = []
+    for i in range(0, len(values) - factor + 1, factor):
+        chunk = [v for v in values[i:i + factor] if not math.isnan(v)]
+        if not chunk:
+            rv.append(math.nan)
+        elif cf == 'AVERAGE':
+            rv.append(sum(chunk) / len(chunk))
+        elif cf == 'MIN':
+            rv.append(min(chunk))
+        elif cf == 'MAX':
+            rv.append(max(chunk))
+        else:
+            rv.append(chunk[-1])
+    return rv
+
+
+def xport(defs, start, end, step=None):
+    """
+    Export data points like `rrdtool xport --json` does.
+
+    `defs` is a list of (path, ds, cf, legend). All series are resampled to a
+    common step, the largest between `step` and the archives steps.
+    """
+    end = parse_time(end)
+    start = parse_time(start, end=end)
+    if start >= end:
+        raise RRDError('Start time must be before end time')
+
+    fetched = []
+    for path, ds, cf, legend in defs:
+        with RRDFile(path) as f:
+            fetched.append(f.fetch(ds, cf, start, end, step or 1))
+
+    out_step = max([step or 1] + [i[2] for i in fetched])
+    for i in fetched:
+        if out_step % i[2]:
+            out_step = out_step * i[2] // math.gcd(out_step, i[2])
+    out_start = start - start % out_step
+    out_end = end + (out_step - end % out_step) % out_step
+    rows = (out_end - out_start) // out_step
+
+    series = []
+    for (path, ds, cf, legend), (fstart, fend, fstep, values) in zip(defs, fetched):
+        # Align fetched values to output rows and consolidate them
+        skip = (out_start - fstart) // fstep
+        if skip > 0:
+            values = values[skip:]
+        elif skip < 0:
+            values = [math.nan] * -skip + values
+        factor = out_step // fstep
+        values = values + [math.nan] * max(0, rows * factor - len(values))
+        series.append(consolidate(values[:rows * factor], factor, cf))
+
+    return {
+        'about': 'RRDtool xport JSON output',
+        'meta': {
+            'start': out_start,
+            'end': out_end,
+            'step': out_step,
+            'legend': [i[3] for i in defs],
+        },
+        'data': [
+            [None if math.isnan(v) else v for v in row]
+            for row in zip(*series)
+        ],
+    }
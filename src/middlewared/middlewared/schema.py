@@ -20,17 +20,17 @@ class EnumMixin(object):
         self.enum = kwargs.pop('enum', None)
         super(EnumMixin, self).__init__(*args, **kwargs)
 
-    def clean(self, value):
+    def _compile_enum(self, validate):
         if self.enum is None:
-            return value
-        if not isinstance(value, (list, tuple)):
-            tmp = [value]
-        else:
-            tmp = value
-        for v in tmp:
-            if v not in self.enum:
-                raise Error(self.name, 'Invalid choice: {0}'.format(value))
-        return value
+            return validate
+        name, enum = self.name, self.enum
+
+        def validate_enum(value):
+            for v in (value if isinstance(value, (list, tuple)) else [value]):
+                if v not in enum:
+                    raise Error(name, 'Invalid choice: {0}'.format(value))
+            return validate(value)
+        return validate_enum
 
 
 class Attribute(object):
@@ -45,7 +45,28 @@ class Attribute(object):
         self.register = register
 
     def clean(self, value):
-        return value
+        return self.compile()(value)
+
+    def compile(self):
+        """
+        Return a function validating a value for this attribute, returning
+        the cleaned value.
+
+        The value passed is never modified, containers are copied only
+        where defaults or cleaned values have to be set. Compile once and
+        reuse the function, it is what `accepts` calls on every request.
+        """
+        return _identity
+
+    def _default(self):
+        """
+        Return a function giving the default value, a fresh copy every
+        time for mutable defaults.
+        """
+        default = self.default
+        if isinstance(default, (list, dict, set)):
+            return lambda: copy.copy(default)
+        return lambda: default
 
     def to_json_schema(self, parent=None):
         """This method should return the json-schema v4 equivalent for the
@@ -81,13 +102,16 @@ class Any(Attribute):
 
 class Str(EnumMixin, Attribute):
 
-    def clean(self, value):
-        value = super(Str, self).clean(value)
-        if value is None and not self.required:
-            return self.default
-        if not isinstance(value, str):
-            raise Error(self.name, 'Not a string')
-        return value
+    def compile(self):
+        name, required, default = self.name, self.required, self._default()
+
+        def validate(value):
+            if not isinstance(value, str):
+                if value is None and not required:
+                    return default()
+                raise Error(name, 'Not a string')
+            return value
+        return self._compile_enum(validate)
 
     def to_json_schema(self, parent=None):
         schema = {}
@@ -109,12 +133,16 @@ class Bool(Attribute):
             kwargs['default'] = False
         super(Bool, self).__init__(*args, **kwargs)
 
-    def clean(self, value):
-        if value is None and not self.required:
-            return self.default
-        if not isinstance(value, bool):
-            raise Error(self.name, 'Not a boolean')
-        return value
+    def compile(self):
+        name, required, default = self.name, self.required, self._default()
+
+        def validate(value):
+            if not isinstance(value, bool):
+                if value is None and not required:
+                    return default()
+                raise Error(name, 'Not a boolean')
+            return value
+        return validate
 
     def to_json_schema(self, parent=None):
         schema = {
@@ -127,14 +155,18 @@ class Bool(Attribute):
 
 class Int(Attribute):
 
-    def clean(self, value):
-        if value is None and not self.required:
-            return self.default
-        if not isinstance(value, int):
-            if isinstance(value, str) and value.isdigit():
-                return int(value)
-            raise Error(self.name, 'Not an integer')
-        return value
+    def compile(self):
+        name, required, default = self.name, self.required, self._default()
+
+        def validate(value):
+            if not isinstance(value, int):
+                if value is None and not required:
+                    return default()
+                if isinstance(value, str) and value.isdigit():
+                    return int(value)
+                raise Error(name, 'Not an integer')
+            return value
+        return validate
 
     def to_json_schema(self, parent=None):
         schema = {
@@ -153,24 +185,29 @@ class List(EnumMixin, Attribute):
             kwargs['default'] = []
         super(List, self).__init__(*args, **kwargs)
 
-    def clean(self, value):
-        value = super(List, self).clean(value)
-        if value is None and not self.required:
-            return copy.copy(self.default)
-        if not isinstance(value, list):
-            raise Error(self.name, 'Not a list')
-        if self.items:
-            for index, v in enumerate(value):
-                for i in self.items:
-                    try:
-                        value[index] = i.clean(v)
-                        found = True
-                    except Error as e:
-                        found = e
-                        break
-                if self.items and found is not True:
-                    raise Error(self.name, 'Item#{0} is not valid per list types: {1}'.format(index, found))
-        return value
+    def compile(self):
+        name, required, default = self.name, self.required, self._default()
+        items = [i.compile() for i in self.items]
+
+        def validate_item(index, v):
+            # Every item type has to accept the value, the last one wins
+            rv = v
+            for i in items:
+                try:
+                    rv = i(v)
+                except Error as e:
+                    raise Error(name, 'Item#{0} is not valid per list types: {1}'.format(index, e))
+            return rv
+
+        def validate(value):
+            if not isinstance(value, list):
+                if value is None and not required:
+                    return default()
+                raise Error(name, 'Not a list')
+            if items:
+                return [validate_item(index, v) for index, v in enumerate(value)]
+            return list(value)
+        return self._compile_enum(validate)
 
     def to_json_schema(self, parent=None):
         schema = {'type': 'array'}
@@ -204,36 +241,43 @@ class Dict(Attribute):
         for i in attrs:
             self.attrs[i.name] = i
 
-    def clean(self, data):
-        if data is None and not self.required:
-            data = {}
-
-        self.errors = []
-        if not isinstance(data, dict):
-            raise Error(self.name, 'A dict was expected')
-
-        for key, value in list(data.items()):
-            if not self.additional_attrs:
-                if key not in self.attrs:
-                    raise Error(key, 'Field was not expected')
+    def compile(self):
+        name, required, additional_attrs = self.name, self.required, self.additional_attrs
+        attrs = {key: attr.compile() for key, attr in self.attrs.items()}
+        # Do not make any field and required and not populate default values
+        if self.update:
+            required_attrs = defaults = ()
+        else:
+            required_attrs = [key for key, attr in self.attrs.items() if attr.required]
+            defaults = [(key, attr._default()) for key, attr in self.attrs.items() if attr.has_default]
 
-            attr = self.attrs.get(key)
-            if not attr:
-                continue
+        def validate(data):
+            if data is None and not required:
+                data = {}
 
-            data[key] = attr.clean(value)
+            if not isinstance(data, dict):
+                raise Error(name, 'A dict was expected')
 
-        # Do not make any field and required and not populate default values
-        if not self.update:
-            for attr in list(self.attrs.values()):
+            rv = {}
+            for key, value in data.items():
+                attr = attrs.get(key)
+                if attr is None:
+                    if not additional_attrs:
+                        raise Error(key, 'Field was not expected')
+                    rv[key] = value
+                else:
+                    rv[key] = attr(value)
 
-                if attr.required and attr.name not in data:
-                    raise Error(attr.name, 'This field is required')
+            for key in required_attrs:
+                if key not in rv:
+                    raise Error(key, 'This field is required')
 
-                if attr.name not in data and attr.has_default:
-                    data[attr.name] = attr.default
+            for key, default in defaults:
+                if key not in rv:
+                    rv[key] = default()
 
-        return data
+            return rv
+        return validate
 
     def to_json_schema(self, parent=None):
         schema = {
@@ -315,6 +359,10 @@ class ResolverError(Exception):
     pass
 
 
+def _identity(value):
+    return value
+
+
 def resolver(middleware, f):
     if not callable(f):
         return
@@ -332,6 +380,9 @@ def resolver(middleware, f):
         f.accepts.pop()
     f.accepts.extend(new_params)
 
+    if hasattr(f, 'compile_accepts'):
+        f.compile_accepts()
+
 
 def accepts(*schema):
     def wrap(f):
@@ -343,24 +394,33 @@ def accepts(*schema):
             args_index += 1
         assert len(schema) == f.__code__.co_argcount - args_index  # -1 for self
 
+        # Validators compiled from the resolved schemas, see `resolver`
+        validators = []
+
+        def compile_accepts():
+            validators[:] = [i.compile() for i in nf.accepts]
+
         def clean_args(args, kwargs):
+            if not validators:
+                compile_accepts()
+
+            # Validators return new containers, arguments are not modified
             args = list(args)
-            args = args[:args_index] + copy.deepcopy(args[args_index:])
-            kwargs = copy.deepcopy(kwargs)
+            kwargs = dict(kwargs)
 
             # Iterate over positional args first, excluding self
             i = 0
             for arg in args[args_index:]:
-                args[i + args_index] = nf.accepts[i].clean(args[i + args_index])
+                args[i + args_index] = validators[i](arg)
                 i += 1
 
             # Use i counter to map keyword argument to rpc positional
             for x in list(range(i + 1, f.__code__.co_argcount)):
                 kwarg = f.__code__.co_varnames[x]
                 if kwarg in kwargs:
-                    kwargs[kwarg] = nf.accepts[i].clean(kwargs[kwarg])
+                    kwargs[kwarg] = validators[i](kwargs[kwarg])
                 elif len(nf.accepts) >= i + args_index:
-                    kwargs[kwarg] = nf.accepts[i].clean(None)
+                    kwargs[kwarg] = validators[i](None)
                 i += 1
             return args, kwargs
 
@@ -383,6 +443,7 @@ def accepts(*schema):
             if i.startswith('_'):
                 setattr(nf, i, getattr(f, i))
         nf.accepts = list(schema)
+        nf.compile_accepts = compile_accepts
 
         return nf
     return wrap
@@ -11,13 +11,32 @@ import sys
 import threading
 import time
 
-from middlewared.schema import accepts, Bool, Dict, Int, List, Ref, Str
+from middlewared.schema import accepts, Attribute, Bool, Dict, Error as SchemaError, Int, List, Ref, Str
 from middlewared.utils import filter_list
 from middlewared.logger import Logger
 
 PeriodicTaskDescriptor = namedtuple("PeriodicTaskDescriptor", ["interval", "run_on_start"])
 
 
+def schema_sample(attr):
+    """
+    Build a value accepted by schema `attr`, with every attribute set.
+    """
+    if isinstance(attr, Dict):
+        return {name: schema_sample(i) for name, i in attr.attrs.items()}
+    if isinstance(attr, List):
+        return [schema_sample(attr.items[0])] if attr.items else []
+    if getattr(attr, 'enum', None):
+        return attr.enum[0]
+    if isinstance(attr, Str):
+        return attr.name
+    if isinstance(attr, Bool):
+        return False
+    if isinstance(attr, Int):
+        return 0
+    return None
+
+
 def item_method(fn):
     """Flag method as an item method.
     That means it operates over a single item in the collection,
@@ -26,13 +45,16 @@ def item_method(fn):
     return fn
 
 
-def job(lock=None, process=False, pipe=False):
-    """Flag method as a long running job."""
+def job(lock=None, process=False, pipe=False, max_concurrency=None):
+    """Flag method as a long running job.
+
+    `max_concurrency` limits how many jobs of the method can run at once."""
     def check_job(fn):
         fn._job = {
             'lock': lock,
             'process': process,
             'pipe': pipe,
+            'max_concurrency': max_concurrency,
         }
         return fn
     return check_job
@@ -141,10 +163,14 @@ class ServiceBase(type):
     Currently the following options are allowed:
       - datastore: name of the datastore mainly used in the service
       - datastore_extend: datastore `extend` option used in common `query` method
+      - datastore_extend_list: datastore `extend_list` option used in common `query` method
       - datastore_prefix: datastore `prefix` option used in helper methods
       - namespace: namespace identifier of the service
       - private: whether or not the service is deemed private
       - verbose_name: human-friendly singular name for the service
+      - threadpool: name of the thread pool used to run the service sync methods
+      - threadpool_workers: number of workers of the thread pool
+      - threadpool_queue: max calls waiting for a worker before rejecting new ones
 
     """
 
@@ -165,9 +191,13 @@ class ServiceBase(type):
             'datastore': None,
             'datastore_prefix': None,
             'datastore_extend': None,
+            'datastore_extend_list': None,
             'namespace': namespace,
             'private': False,
             'verbose_name': klass.__name__.replace('Service', ''),
+            'threadpool': None,
+            'threadpool_workers': 4,
+            'threadpool_queue': None,
         }
 
         if config:
@@ -228,6 +258,8 @@ class CRUDService(Service):
             options['prefix'] = self._config.datastore_prefix
         if self._config.datastore_extend:
             options['extend'] = self._config.datastore_extend
+        if self._config.datastore_extend_list:
+            options['extend_list'] = self._config.datastore_extend_list
         return await self.middleware.call('datastore.query', self._config.datastore, filters, options)
 
     async def create(self, data):
@@ -265,11 +297,44 @@ class CoreService(Service):
 
     @filterable
     def get_jobs(self, filters=None, options=None):
-        """Get the long running jobs."""
-        jobs = filter_list([
-            i.__encode__() for i in list(self.middleware.jobs.all().values())
-        ], filters, options)
-        return jobs
+        """Get the long running jobs.
+
+        Only the most recent jobs are kept in memory. Older finished jobs
+        are also queried from the jobs history if `{"extra": {"history": true}}`
+        is given in `options`. History can be paginated using the job id as
+        key, e.g. `[["id", "<", last_id]]` with `{"order_by": ["-id"], "limit": 50}`.
+        """
+        options = options or {}
+        in_memory = self.middleware.jobs.all()
+        jobs = [i.__encode__() for i in list(in_memory.values())]
+        history = self.middleware.jobs.history
+        if not (options.get('extra') or {}).get('history') or history is None:
+            return filter_list(jobs, filters, options)
+
+        before_id = min(in_memory) if in_memory else self.middleware.jobs.deque.count + 1
+        try:
+            old_jobs = history.query(before_id, filters, {
+                k: options[k] for k in ('order_by', 'limit', 'offset', 'count') if k in options
+            })
+        except ValueError as e:
+            raise CallError(str(e), errno.EINVAL)
+        if options.get('count'):
+            return filter_list(jobs, filters, {'count': True}) + old_jobs
+        return filter_list(filter_list(jobs, filters) + old_jobs, None, options)
+
+    @accepts()
+    def job_worker_stats(self):
+        """
+        Get statistics of the worker processes used to run process jobs.
+        """
+        return self.middleware.job_worker_pool.stats()
+
+    @accepts()
+    def threadpool_stats(self):
+        """
+        Get queue wait time, run time and saturation of every thread pool.
+        """
+        return [pool.stats() for pool in self.middleware.get_threadpools().values()]
 
     @accepts(Int('id'), Dict(
         'job-update',
@@ -290,6 +355,43 @@ class CoreService(Service):
         job = self.middleware.jobs.all()[id]
         return job.abort()
 
+    @private
+    @accepts(Int('iterations', default=1000))
+    def benchmark_accepts(self, iterations):
+        """
+        Measure how long validating arguments takes for every method with
+        a schema, using sample arguments built from the schema.
+
+        Returns the mean time per call in microseconds, slowest first.
+        """
+        rv = []
+        for name, svc in list(self.middleware.get_services().items()):
+            for attr in dir(svc):
+                if attr.startswith('_'):
+                    continue
+                method = getattr(svc, attr, None)
+                schema = getattr(method, 'accepts', None)
+                if not callable(method) or not schema or not all(isinstance(i, Attribute) for i in schema):
+                    continue
+
+                validators = [i.compile() for i in schema]
+                samples = [schema_sample(i) for i in schema]
+                try:
+                    for validate, sample in zip(validators, samples):
+                        validate(sample)
+                except SchemaError:
+                    continue
+
+                start = time.perf_counter()
+                for i in range(iterations):
+                    for validate, sample in zip(validators, samples):
+                        validate(sample)
+                rv.append({
+                    'method': f'{name}.{attr}',
+                    'usec': (time.perf_counter() - start) / iterations * 1000000,
+                })
+        return sorted(rv, key=lambda i: i['usec'], reverse=True)
+
     @accepts()
     def get_services(self):
         """Returns a list of all registered services."""
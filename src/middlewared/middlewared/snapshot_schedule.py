@@ -0,0 +1,194 @@
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+import re
+
+RE_AUTOSNAP = re.compile(r'^auto-(\d{4})(\d{2})(\d{2})\.(\d{2})(\d{2})-(\d+[hdwmy])$')
+
+
+def snap_time(now):
+    """
+    Round `now` to the closest minute, which is the time the snapshots
+    taken in this run are named after.
+    """
+    snaptime = now.replace(second=0, microsecond=0)
+    if now.second >= 30:
+        snaptime += timedelta(minutes=1)
+    return snaptime
+
+
+def retention_delta(retention):
+    count, unit = int(retention[:-1]), retention[-1]
+    if unit == 'h':
+        return timedelta(hours=count)
+    elif unit == 'd':
+        return timedelta(days=count)
+    elif unit == 'w':
+        return timedelta(days=7 * count)
+    elif unit == 'm':
+        return timedelta(days=int(30.436875 * count))
+    elif unit == 'y':
+        return timedelta(days=int(365.2425 * count))
+    raise ValueError(f'Invalid retention unit {unit!r}')
+
+
+def task_retention(task):
+    return f'{task["task_ret_count"]}{task["task_ret_unit"][0]}'
+
+
+def is_matching_time(task, snaptime):
+    curtime = time(snaptime.hour, snaptime.minute)
+    begin, end = task['task_begin'], task['task_end']
+    if begin <= end:
+        if not begin <= curtime <= end:
+            return False
+    elif not (curtime >= begin or curtime <= end):
+        return False
+
+    if task['task_repeat_unit'] == 'daily':
+        return True
+    if task['task_repeat_unit'] == 'weekly':
+        return str(snaptime.weekday() + 1) in task['task_byweekday'].split(',')
+    return False
+
+
+def parse_snapshot(snapname):
+    """
+    Returns (datetime, retention) for an automatic snapshot name or None.
+    """
+    reg = RE_AUTOSNAP.match(snapname)
+    if reg is None:
+        return None
+    try:
+        return datetime(*map(int, reg.groups()[:5])), reg.group(6)
+    except ValueError:
+        return None
+
+
+class AutoSnapshotIndex(object):
+    """
+    In-memory index of the automatic snapshots, keyed by dataset and
+    retention policy and holding the snapshot times sorted.
+
+    Snapshots with the same retention all expire after the same delta so
+    the expired ones of a (dataset, retention) pair are always a prefix of
+    its sorted list, found with a single bisect.
+    """
+
+    def __init__(self, names=None):
+        self.datasets = set()
+        self.snapshots = defaultdict(lambda: defaultdict(list))
+        self.built = datetime.now()
+        for name in names or []:
+            if '@' in name:
+                self.add(*name.split('@', 1))
+            elif name:
+                self.datasets.add(name)
+
+    def add(self, dataset, snapname):
+        parsed = parse_snapshot(snapname)
+        if parsed is None:
+            return
+        self.datasets.add(dataset)
+        times = self.snapshots[dataset][parsed[1]]
+        i = bisect_right(times, parsed[0])
+        if i == 0 or times[i - 1] != parsed[0]:
+            times.insert(i, parsed[0])
+
+    def add_recursive(self, dataset, snapname):
+        self.add(dataset, snapname)
+        prefix = f'{dataset}/'
+        for child in [d for d in self.datasets if d.startswith(prefix)]:
+            self.add(child, snapname)
+
+    def discard_recursive(self, dataset, snapnames):
+        prefix = f'{dataset}/'
+        children = [ds for ds in self.snapshots if ds == dataset or ds.startswith(prefix)]
+        for snapname in snapnames:
+            parsed = parse_snapshot(snapname)
+            if parsed is None:
+                continue
+            for ds in children:
+                times = self.snapshots[ds].get(parsed[1])
+                if not times:
+                    continue
+                i = bisect_right(times, parsed[0])
+                if i and times[i - 1] == parsed[0]:
+                    del times[i - 1]
+
+    def latest(self, dataset, retention):
+        times = self.snapshots.get(dataset, {}).get(retention)
+        return times[-1] if times else None
+
+    def expired(self, snaptime, match):
+        """
+        Returns {dataset: [snapname]} of the expired snapshots of datasets
+        for which `match(dataset)` is true, only keeping the topmost dataset
+        of a recursive destroy.
+        """
+        pending = {}
+        for dataset in sorted(self.snapshots):
+            if not match(dataset):
+                continue
+            for retention, times in self.snapshots[dataset].items():
+                i = bisect_right(times, snaptime - retention_delta(retention))
+                for t in times[:i]:
+                    snapname = f'auto-{t.strftime("%Y%m%d.%H%M")}-{retention}'
+                    # Destroy is recursive, skip if any parent is already pending
+                    parent = dataset
+                    while '/' in parent:
+                        parent = parent.rsplit('/', 1)[0]
+                        if snapname in pending.get(parent, ()):
+                            break
+                    else:
+                        pending.setdefault(dataset, []).append(snapname)
+        return pending
+
+    def stats(self):
+        return {
+            'age': int((datetime.now() - self.built).total_seconds()),
+            'datasets': len(self.snapshots),
+            'snapshots': sum(len(t) for r in self.snapshots.values() for t in r.values()),
+        }
+
+
+def due_snapshots(tasks, index, snaptime):
+    """
+    Returns the (dataset, retention, recursive) snapshots to take at
+    `snaptime` for the matching `tasks`.
+
+    Since the snapshot name only depends on dataset and retention tasks
+    sharing both are a single snapshot, due if any of them is.
+    """
+    due = []
+    for task in tasks:
+        key = (task['task_filesystem'], task_retention(task), task['task_recursive'])
+        if key in due:
+            continue
+        latest = index.latest(key[0], key[1])
+        if latest is None or latest + timedelta(minutes=task['task_interval']) <= snaptime:
+            due.append(key)
+
+    # A recursive snapshot of a parent dataset with the same retention
+    # already covers the non-recursive ones, taking both would collide.
+    recursive = [k for k in due if k[2]]
+    return [
+        key for key in due
+        if key[2] or not any(
+            (key[0] + '/').startswith(r[0] + '/') and key[1] == r[1] for r in recursive
+        )
+    ]
+
+
+def expire_match(tasks):
+    """
+    Returns a predicate telling whether expired snapshots of a dataset may
+    be destroyed, only datasets matching one of `tasks` qualify.
+    """
+    nonrecursive = {t['task_filesystem'] for t in tasks if not t['task_recursive']}
+    recursive = tuple(t['task_filesystem'] for t in tasks if t['task_recursive'])
+    prefixes = tuple(f'{r}/' for r in recursive)
+
+    def match(dataset):
+        return dataset in nonrecursive or dataset in recursive or dataset.startswith(prefixes)
+    return match
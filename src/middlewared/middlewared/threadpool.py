@@ -0,0 +1,95 @@
+import asyncio
+import concurrent.futures
+import errno
+import threading
+import time
+
+from middlewared.service import CallError
+
+
+class ThreadPool(object):
+    """
+    Named thread pool used by `Middleware.threaded`.
+
+    Every pool has its own worker limit so slow calls of one kind (e.g. disk
+    or ZFS) cannot starve the others. Calls are rejected with EBUSY once
+    `max_queue` calls are already waiting for a free worker.
+    """
+
+    def __init__(self, name, max_workers, max_queue=None):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time = 0
+        self.wait_time_max = 0
+        self.run_time = 0
+        self.run_time_max = 0
+
+    async def run(self, method, *args):
+        if self.max_queue is not None and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise CallError(f'Thread pool "{self.name}" is saturated', errno.EBUSY)
+
+        queued_at = time.monotonic()
+        started = False
+        with self.lock:
+            self.queued += 1
+
+        def wrapper():
+            nonlocal started
+            started_at = time.monotonic()
+            wait = started_at - queued_at
+            with self.lock:
+                started = True
+                self.queued -= 1
+                self.running += 1
+                self.wait_time += wait
+                self.wait_time_max = max(self.wait_time_max, wait)
+            try:
+                return method(*args)
+            finally:
+                run = time.monotonic() - started_at
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.run_time += run
+                    self.run_time_max = max(self.run_time_max, run)
+
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, wrapper)
+        except asyncio.CancelledError:
+            # A call cancelled before a worker picked it up never runs
+            with self.lock:
+                if not started:
+                    self.queued -= 1
+            raise
+
+    def stats(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'saturation': self.running / self.max_workers,
+                'wait_time': {
+                    'total': self.wait_time,
+                    'average': self.wait_time / self.completed if self.completed else 0,
+                    'max': self.wait_time_max,
+                },
+                'run_time': {
+                    'total': self.run_time,
+                    'average': self.run_time / self.completed if self.completed else 0,
+                    'max': self.run_time_max,
+                },
+            }
@@ -1,7 +1,11 @@
 import asyncio
+import heapq
+import operator
+import re
 import sys
 import subprocess
-from datetime import datetime, timedelta
+import time
+from datetime import timedelta
 from functools import wraps
 from threading import Lock
 
@@ -13,7 +17,13 @@ from freenasOS import Configuration
 VERSION = None
 
 
-async def django_modelobj_serialize(middleware, obj, extend=None, field_prefix=None):
+def django_modelobj_to_dict(obj, field_prefix=None):
+    """
+    Serialize a django model instance into a dict, following foreign keys.
+
+    This is a blocking call since following a foreign key which has not been
+    fetched with `select_related` queries the database.
+    """
     from django.db.models.fields.related import ForeignKey
     from freenasUI.contrib.IPAddressField import (
         IPAddressField, IP4AddressField, IP6AddressField
@@ -36,9 +46,14 @@ async def django_modelobj_serialize(middleware, obj, extend=None, field_prefix=N
         )):
             data[name] = str(value)
         elif isinstance(field, ForeignKey):
-            data[name] = await django_modelobj_serialize(middleware, value) if value is not None else value
+            data[name] = django_modelobj_to_dict(value) if value is not None else value
         else:
             data[name] = value
+    return data
+
+
+async def django_modelobj_serialize(middleware, obj, extend=None, field_prefix=None):
+    data = await middleware.threaded(django_modelobj_to_dict, obj, field_prefix)
     if extend:
         data = await middleware.call(extend, data)
     return data
@@ -65,53 +80,182 @@ async def run(*args, **kwargs):
     return cp
 
 
-def filter_list(_list, filters=None, options=None):
+def filter_getter(name):
+    """
+    Returns a function to get the value of attribute `name` of an item.
+
+    `name` may be a dotted path (e.g. "pool.name") to reach nested
+    dicts/objects. Missing attributes are returned as None.
+    """
+    def get(i, key):
+        if isinstance(i, dict):
+            return i.get(key)
+        return getattr(i, key, None)
+
+    if '.' not in name:
+        return lambda i: get(i, name)
+
+    path = name.split('.')
+
+    def get_path(i):
+        for key in path:
+            if i is None:
+                break
+            i = get(i, key)
+        return i
+    return get_path
+
+
+def _regex_op(x, y):
+    if x is None:
+        return False
+    return re.search(y, x) is not None
+
+
+FILTER_OPMAP = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '~': _regex_op,
+    'in': lambda x, y: x in y,
+    'nin': lambda x, y: x not in y,
+}
+
+
+def filter_compile(filters):
+    """
+    Compile a list of filters into a single predicate function.
+
+    Filters use the same syntax as `datastore.query`:
+
+        entry: simple_filter | conjunction
+        simple_filter: '[' attribute_name, OPERATOR, value ']'
+        conjunction: '[' CONJUNCTION, '[' simple_filter (',' simple_filter)* ']]'
 
-    opmap = {
-        '=': lambda x, y: x == y,
-        '!=': lambda x, y: x != y,
-    }
+        OPERATOR: ('=' | '!=' | '>' | '>=' | '<' | '<=' | '~' | 'in' | 'nin')
+        CONJUNCTION: 'OR'
+    """
+    predicates = []
+    for f in filters:
+        if not isinstance(f, (list, tuple)):
+            raise ValueError('Filter must be a list: {0}'.format(f))
+        if len(f) == 3:
+            name, op, value = f
+            if op not in FILTER_OPMAP:
+                raise ValueError('Invalid operation: {}'.format(op))
+            if op == '~':
+                value = re.compile(value)
+            getter = filter_getter(name)
+            opfunc = FILTER_OPMAP[op]
+            predicates.append(
+                lambda i, getter=getter, opfunc=opfunc, value=value: opfunc(getter(i), value)
+            )
+        elif len(f) == 2:
+            op, value = f
+            if op != 'OR':
+                raise ValueError('Invalid operation: {}'.format(op))
+            or_predicates = [filter_compile([i]) for i in value]
+            predicates.append(
+                lambda i, or_predicates=or_predicates: any(p(i) for p in or_predicates)
+            )
+        else:
+            raise ValueError('Invalid filter {0}'.format(f))
+
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda i: all(p(i) for p in predicates)
+
+
+def _order_key(getter):
+    # None values are sorted last instead of breaking comparison
+    def key(i):
+        value = getter(i)
+        return (value is None, value)
+    return key
+
+
+def _select(i, select):
+    rv = {}
+    for name in select:
+        value = filter_getter(name)(i)
+        path = name.split('.')
+        target = rv
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+    return rv
 
+
+def filter_list(_list, filters=None, options=None):
+    """
+    Filter, sort and paginate a list of items (dicts or objects).
+
+    `filters` follow the `filter_compile` syntax and `options` are the same
+    as in `datastore.query`: `order_by`, `count`, `get`, `limit`, `offset`
+    and `select`.
+    """
     if filters is None:
-        filters = {}
+        filters = []
     if options is None:
         options = {}
 
-    rv = []
+    order_by = options.get('order_by') or []
+    offset = options.get('offset') or 0
+    limit = options.get('limit')
+
     if filters:
-        for i in _list:
-            valid = True
-            for f in filters:
-                if len(f) == 3:
-                    name, op, value = f
-                    if op not in opmap:
-                        raise ValueError('Invalid operation: {}'.format(op))
-                    if isinstance(i, dict):
-                        source = i[name]
-                    else:
-                        source = getattr(i, name)
-                    if not opmap[op](source, value):
-                        valid = False
-                        break
-            if not valid:
-                continue
-            rv.append(i)
-            if options.get('get') is True:
-                return i
+        predicate = filter_compile(filters)
+        if options.get('get') is True and not order_by and not options.get('count'):
+            # Stop at the first match past `offset`
+            skip = offset
+            for i in _list:
+                if predicate(i):
+                    if skip:
+                        skip -= 1
+                        continue
+                    return _select(i, options['select']) if options.get('select') else i
+            raise IndexError('list index out of range')
+        rv = [i for i in _list if predicate(i)]
     else:
-        rv = _list
+        rv = list(_list)
 
     if options.get('count') is True:
         return len(rv)
 
-    if options.get('order_by'):
-        for o in options.get('order_by'):
+    if order_by:
+        keys = []
+        for o in order_by:
             if o.startswith('-'):
-                o = o[1:]
-                reverse = True
+                keys.append((_order_key(filter_getter(o[1:])), True))
             else:
-                reverse = False
-            rv = sorted(rv, key=lambda x: x[o], reverse=reverse)
+                keys.append((_order_key(filter_getter(o)), False))
+
+        top = offset + limit if limit else None
+        reverse = {r for k, r in keys}
+        if top is not None and top < len(rv) // 4 and len(reverse) == 1:
+            # Only a few items are wanted, a heap is cheaper than a full sort
+            getters = [k for k, r in keys]
+
+            def key(i):
+                return tuple(k(i) for k in getters)
+
+            if True in reverse:
+                rv = heapq.nlargest(top, rv, key=key)
+            else:
+                rv = heapq.nsmallest(top, rv, key=key)
+        else:
+            # Sort by the least significant key first, sort is stable
+            for key, reverse in reversed(keys):
+                rv.sort(key=key, reverse=reverse)
+
+    if offset or limit:
+        rv = rv[offset:offset + limit if limit else None]
+
+    if options.get('select'):
+        rv = [_select(i, options['select']) for i in rv]
 
     if options.get('get') is True:
         return rv[0]
@@ -159,32 +303,51 @@ class Nid(object):
 
 class cache_with_autorefresh(object):
     """
-    A decorator which caches the result of a function (with no arguments as yet)
-    and returns the cache untill the autorefresh timeout is hit, upon which it
-    call the function again and caches the result for future calls.
+    A decorator which caches the result of a function for each set of
+    arguments and returns the cache untill the autorefresh timeout is hit,
+    upon which it calls the function again and caches the result for future
+    calls.
+
+    While a result is being refreshed other callers get the previous result
+    instead of waiting for the refresh to finish.
     """
 
     def __init__(self, seconds=0, minutes=0, hours=0):
         self.refresh_period = timedelta(
             seconds=seconds, minutes=minutes, hours=hours
-        )
-        self.cached_return = None
-        self.first = True
-        self.time_of_last_call = datetime.min
+        ).total_seconds()
+        self.cached = {}
+        self.locks = {}
         self.lock = Lock()
 
     def __call__(self, fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            now = datetime.now()
-            time_since_last_call = now - self.time_of_last_call
+            key = (args, tuple(sorted(kwargs.items())))
+            cached = self.cached.get(key)
+            if cached is not None and time.monotonic() - cached[0] <= self.refresh_period:
+                return cached[1]
 
             with self.lock:
-                if time_since_last_call > self.refresh_period or self.first:
-                    self.first = False
-                    self.time_of_last_call = now
-                    self.cached_return = fn(*args, **kwargs)
+                key_lock = self.locks.setdefault(key, Lock())
 
-            return self.cached_return
+            if cached is not None:
+                if not key_lock.acquire(blocking=False):
+                    # Someone else is refreshing it
+                    return cached[1]
+            else:
+                key_lock.acquire()
+                cached = self.cached.get(key)
+                if cached is not None and time.monotonic() - cached[0] <= self.refresh_period:
+                    key_lock.release()
+                    return cached[1]
+
+            try:
+                now = time.monotonic()
+                result = fn(*args, **kwargs)
+                self.cached[key] = (now, result)
+            finally:
+                key_lock.release()
+            return result
 
         return wrapper
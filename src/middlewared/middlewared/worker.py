@@ -0,0 +1,259 @@
+import asyncio
+import json
+import os
+import subprocess
+import time
+
+import psutil
+
+from middlewared.utils import Popen
+
+JOB_PROCESS = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'job_process.py')
+JOB_PROCESS_ENV = {
+    'LOGNAME': 'root',
+    'USER': 'root',
+    'GROUP': 'wheel',
+    'HOME': '/root',
+    'PATH': '/sbin:/bin:/usr/sbin:/usr/bin:/usr/local/sbin:/usr/local/bin',
+    'TERM': 'xterm',
+}
+# Job results are read back as a single JSON line, allow it to be large
+JOB_RESULT_LIMIT = 64 * 1024 * 1024
+
+
+# Seconds to wait before retrying to spawn a worker, doubled on every
+# failure up to the maximum
+RESPAWN_DELAY = 1
+RESPAWN_DELAY_MAX = 60
+
+
+class JobWorkerError(Exception):
+    pass
+
+
+class JobWorkerUnavailable(Exception):
+    """
+    The pool has no worker alive, the job has to be run some other way.
+    """
+    pass
+
+
+class JobWorker(object):
+    """
+    A pre-forked `job_process.py --worker` process.
+
+    The worker loads every plugin and connects back to middlewared once,
+    then runs jobs sequentially. Job ids are written one per line to its
+    stdin and results are read back as one JSON document per line.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.proc = None
+        self.job = None
+        self.jobs_run = 0
+        self.time_started = None
+
+    @property
+    def pid(self):
+        return self.proc.pid if self.proc else None
+
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    def rss(self):
+        try:
+            return psutil.Process(self.pid).memory_info().rss
+        except (psutil.Error, TypeError):
+            return None
+
+    async def start(self):
+        self.proc = await Popen(
+            ['/usr/bin/env', 'python3', JOB_PROCESS, '--worker'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True, env=JOB_PROCESS_ENV,
+            limit=JOB_RESULT_LIMIT,
+        )
+        self.time_started = time.time()
+
+    async def run(self, job):
+        """
+        Run `job` in this worker and return the decoded result.
+
+        Raises:
+            JobWorkerError: the worker died while running the job or its
+                output could not be read, leaving it in an unknown state
+        """
+        self.job = job
+        try:
+            self.proc.stdin.write(f'{job.id}\n'.encode())
+            await self.proc.stdin.drain()
+            line = await self.proc.stdout.readline()
+            if not line:
+                raise JobWorkerError(f'Job worker {self.pid} exited unexpectedly')
+            return json.loads(line.decode())
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise JobWorkerError(f'Job worker {self.pid} is gone: {e}')
+        except (ValueError, asyncio.LimitOverrunError, asyncio.IncompleteReadError) as e:
+            # Includes results over JOB_RESULT_LIMIT and undecodable output
+            raise JobWorkerError(f'Failed to read result from job worker {self.pid}: {e}')
+        finally:
+            self.job = None
+            self.jobs_run += 1
+
+    def should_recycle(self):
+        if not self.alive():
+            return True
+        if self.pool.max_jobs and self.jobs_run >= self.pool.max_jobs:
+            return True
+        if self.pool.max_rss:
+            rss = self.rss()
+            if rss is not None and rss > self.pool.max_rss:
+                return True
+        return False
+
+    async def stop(self):
+        if not self.alive():
+            return
+        # Closing stdin makes an idle worker exit on its own
+        self.proc.stdin.close()
+        try:
+            await asyncio.wait_for(self.proc.wait(), 5)
+        except asyncio.TimeoutError:
+            self.kill()
+
+    def kill(self):
+        if self.alive():
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass
+
+    def __encode__(self):
+        return {
+            'pid': self.pid,
+            'job': self.job.id if self.job else None,
+            'jobs_run': self.jobs_run,
+            'rss': self.rss(),
+            'time_started': self.time_started,
+        }
+
+
+class JobWorkerPool(object):
+    """
+    Pool of warm job worker processes used for `@job(process=True)` methods.
+
+    Workers are recycled once they have run `max_jobs` jobs or their resident
+    memory grows over `max_rss` bytes. A size of 0 disables the pool.
+
+    Workers failing to start are retried with an exponential backoff, while
+    the pool has no worker at all `run` raises JobWorkerUnavailable instead
+    of waiting.
+    """
+
+    def __init__(self, middleware, size=2, max_jobs=50, max_rss=None):
+        self.middleware = middleware
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.workers = []
+        self.idle = asyncio.Queue()
+        self.recycled = 0
+        self.spawn_failures = 0
+        self.terminated = False
+        # Number of `run` calls waiting for an idle worker
+        self.waiting = 0
+        self.respawn_delay = RESPAWN_DELAY
+
+    def enabled(self):
+        return self.size > 0
+
+    async def start(self):
+        for i in range(self.size):
+            await self.__spawn()
+
+    def _worker_factory(self):
+        return JobWorker(self)
+
+    async def __spawn(self):
+        if self.terminated:
+            return
+        worker = self._worker_factory()
+        try:
+            await worker.start()
+        except Exception:
+            self.spawn_failures += 1
+            self.middleware.logger.error(
+                'Failed to start job worker, retrying in %d seconds', self.respawn_delay, exc_info=True,
+            )
+            if not self.workers:
+                # Nothing will ever be put back in the idle queue, wake up
+                # everyone waiting so they run their jobs some other way
+                for i in range(self.waiting):
+                    self.idle.put_nowait(None)
+            asyncio.get_event_loop().call_later(
+                self.respawn_delay, lambda: asyncio.ensure_future(self.__spawn()),
+            )
+            self.respawn_delay = min(self.respawn_delay * 2, RESPAWN_DELAY_MAX)
+            return
+        self.respawn_delay = RESPAWN_DELAY
+        self.workers.append(worker)
+        self.idle.put_nowait(worker)
+
+    async def __replace(self, worker):
+        self.workers.remove(worker)
+        self.recycled += 1
+        await worker.stop()
+        await self.__spawn()
+
+    async def run(self, job):
+        """
+        Run `job` in the first idle worker, waiting for one if all are busy.
+
+        Raises:
+            JobWorkerUnavailable: there is no worker alive to run the job
+        """
+        while True:
+            if not self.workers:
+                raise JobWorkerUnavailable('No job worker available')
+            self.waiting += 1
+            try:
+                worker = await self.idle.get()
+            finally:
+                self.waiting -= 1
+            if worker is None:
+                # Woken up because the pool ran out of workers
+                continue
+            if worker.alive():
+                break
+            await self.__replace(worker)
+
+        try:
+            result = await worker.run(job)
+        except (asyncio.CancelledError, Exception):
+            # There is no telling what state the worker is in, replace it.
+            # A killed worker is not reaped yet so it still looks alive.
+            worker.kill()
+            await self.__replace(worker)
+            raise
+
+        if worker.should_recycle():
+            asyncio.ensure_future(self.__replace(worker))
+        else:
+            self.idle.put_nowait(worker)
+        return result
+
+    async def terminate(self):
+        self.terminated = True
+        for worker in list(self.workers):
+            await worker.stop()
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'max_jobs': self.max_jobs,
+            'max_rss': self.max_rss,
+            'idle': self.idle.qsize(),
+            'recycled': self.recycled,
+            'spawn_failures': self.spawn_failures,
+            'workers': [worker.__encode__() for worker in self.workers],
+        }
@@ -0,0 +1,75 @@
+"""
+In-process sampler of ZIL statistics.
+
+It replaces running zilstat(1) (a DTrace script) once per window: ZIL
+kstat counters are read once per second and the activity over the last
+N seconds is the difference between the newest sample and the one N
+seconds older.
+"""
+from collections import deque
+import time
+
+import sysctl
+
+ZIL_KSTAT = 'kstat.zfs.misc.zil'
+ZIL_WINDOWS = (1, 5, 10)
+
+
+def read_zil_kstat():
+    """
+    Read the ZIL kstat counters, e.g. {"zil_commit_count": 42, ...}.
+    """
+    prefix = f'{ZIL_KSTAT}.'
+    return {
+        node.name[len(prefix):]: node.value
+        for node in sysctl.filter(ZIL_KSTAT)
+        if node.name.startswith(prefix)
+    }
+
+
+class ZilStat(object):
+    """
+    Ring buffer of ZIL kstat samples.
+
+    `sample()` is meant to be called once per second. The buffer holds
+    enough samples for the largest of `windows`.
+    """
+
+    def __init__(self, windows=ZIL_WINDOWS, read=read_zil_kstat):
+        self.windows = windows
+        self.read = read
+        self.samples = deque(maxlen=max(windows) + 1)
+
+    def sample(self, now=None):
+        self.samples.append((time.monotonic() if now is None else now, self.read()))
+
+    def window(self, seconds):
+        """
+        ZIL activity over the last `seconds` seconds, or since the oldest
+        sample if there are not enough of them yet.
+
+        `ops` and `bytes` are the log records written to ZIL blocks, on
+        both the main pool and log devices, like zilstat "ops".
+        """
+        if len(self.samples) < 2:
+            return {'interval': 0, 'ops': 0, 'bytes': 0, 'commits': 0}
+
+        newest_time, newest = self.samples[-1]
+        oldest_time, oldest = self.samples[max(len(self.samples) - 1 - seconds, 0)]
+
+        def delta(*names):
+            # Counters may be reset (module reload), never report negative
+            return max(sum(newest.get(n, 0) - oldest.get(n, 0) for n in names), 0)
+
+        return {
+            'interval': round(newest_time - oldest_time, 2),
+            'ops': delta('zil_itx_metaslab_normal_count', 'zil_itx_metaslab_slog_count'),
+            'bytes': delta('zil_itx_metaslab_normal_bytes', 'zil_itx_metaslab_slog_bytes'),
+            'commits': delta('zil_commit_count'),
+        }
+
+    def get(self):
+        """
+        Activity for every window, e.g. {"1": {...}, "5": {...}, "10": {...}}.
+        """
+        return {str(seconds): self.window(seconds) for seconds in self.windows}